@@ -6,11 +6,13 @@ import logging
 import json
 import os
 import re
+import time
 from datetime import datetime
 from typing import Dict, List, Optional
 from telegram import Update, Message
 from telegram.ext import Application, MessageHandler, CommandHandler, ContextTypes, filters, CallbackQueryHandler
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 import sqlite3
 
@@ -46,13 +48,144 @@ def escape_markdown_v2(text: str) -> str:
     return re. sub(f'([{re.escape(escape_chars)}])', r'\\\1', str(text))
 
 
+# 1.0.0/listen_bot.py、4.0.2/bot.py、5.1.0/telegram.py 各有一份相同的 Metrics：
+# 各版本都是单文件脚本、单独部署，不共享模块，修改时三处同步
+class Metrics:
+    """Prometheus 文本格式指标 - 计数器/仪表/直方图，可选本地 /metrics 端点"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, default_port: int = 9464, logger=None):
+        # 各版本的默认端口不同；logger 为 None 时直接 print
+        self.default_port = default_port
+        self.logger = logger
+        self.meta = {}
+        self.values = {}
+        self.server = None
+        self.lag_task = None
+
+    def _log(self, level: str, message: str):
+        if self.logger:
+            getattr(self.logger, level)(message)
+        else:
+            print(message)
+
+    def describe(self, name: str, kind: str, help_text: str, buckets=None):
+        """登记指标，kind 为 counter / gauge / histogram"""
+        self.meta[name] = (kind, help_text, tuple(buckets or self.DEFAULT_BUCKETS))
+        self.values.setdefault(name, {})
+
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self.values[name]
+        key = self._labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self.values[name][self._labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self.meta[name][2]
+        series = self.values[name]
+        key = self._labels(labels)
+        state = series.get(key)
+        if state is None:
+            state = series[key] = [[0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                state[0][i] += 1
+        state[1] += value
+        state[2] += 1
+
+    @staticmethod
+    def _format_labels(pairs) -> str:
+        if not pairs:
+            return ''
+        escaped = []
+        for k, v in pairs:
+            v = v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{k}="{v}"')
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self) -> str:
+        """输出 Prometheus 文本格式"""
+        lines = []
+        for name, (kind, help_text, buckets) in self.meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in list(self.values[name].items()):
+                if kind != 'histogram':
+                    lines.append(f"{name}{self._format_labels(key)} {value}")
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{self._format_labels(key + (('le', str(bound)),))} {bucket_count}")
+                lines.append(f"{name}_bucket{self._format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self._format_labels(key)} {total}")
+                lines.append(f"{name}_count{self._format_labels(key)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # 读完请求头，忽略内容
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=5)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def monitor_loop_lag(self, interval: float = 1.0):
+        """定时休眠并测量实际唤醒延迟，作为事件循环阻塞程度"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - started - interval)
+            self.observe('tg_event_loop_lag_seconds', lag)
+            self.set('tg_event_loop_lag_last_seconds', lag)
+
+    async def start(self, settings: dict):
+        """按配置启动 /metrics 端点和事件循环延迟监测"""
+        if not settings.get('enabled', False) or self.server is not None:
+            return
+        host = settings.get('host', '127.0.0.1')
+        port = settings.get('port', self.default_port)
+        try:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        except OSError as e:
+            self._log('error', f"❌ 指标端点启动失败 {host}:{port}: {e}")
+            return
+        self.lag_task = asyncio.create_task(self.monitor_loop_lag(settings.get('loop_lag_interval', 1.0)))
+        self._log('info', f"📈 指标端点已启动: http://{host}:{port}/metrics")
+
+
 class KeywordMonitorBot:
     def __init__(self, token: str):
         self.token = token
-        self.application = Application.builder(). token(token).build()
+        self.application = Application.builder(). token(token).post_init(self._post_init).build()
         self.db_path = os. path.join(SCRIPT_DIR, "keyword_bot.db")
         self.config_file = os.path.join(SCRIPT_DIR, "keyword_config.json")
 
+        self.metrics = self.create_metrics()
         self.init_database()
         self.config = self.load_config()
 
@@ -65,6 +198,26 @@ class KeywordMonitorBot:
 
         self.register_handlers()
 
+    @staticmethod
+    def create_metrics() -> Metrics:
+        """创建指标集合"""
+        metrics = Metrics(default_port=9466, logger=logger)
+        metrics.describe('tg_updates_received_total', 'counter', '收到的消息更新数')
+        metrics.describe('tg_keywords_matched_total', 'counter', '关键词命中的用户数')
+        metrics.describe('tg_alerts_sent_total', 'counter', '成功发送的提醒数')
+        metrics.describe('tg_alerts_failed_total', 'counter', '发送失败的提醒数')
+        metrics.describe('tg_alert_fanout', 'histogram', '单条消息触发的提醒人数',
+                         buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+        metrics.describe('tg_flood_wait_seconds_total', 'counter', 'RetryAfter 限流累计秒数')
+        metrics.describe('tg_sqlite_write_seconds', 'histogram', 'SQLite 日志写入耗时')
+        metrics.describe('tg_event_loop_lag_seconds', 'histogram', '事件循环调度延迟')
+        metrics.describe('tg_event_loop_lag_last_seconds', 'gauge', '最近一次事件循环调度延迟')
+        return metrics
+
+    async def _post_init(self, application: Application):
+        """事件循环启动后开启指标端点"""
+        await self.metrics.start(self.config.get('metrics', {}))
+
     def init_database(self):
         """初始化数据库"""
         conn = sqlite3.connect(self.db_path)
@@ -103,6 +256,11 @@ class KeywordMonitorBot:
                 "include_source_info": True,
                 "max_message_length": 500,
             },
+            "metrics": {
+                "enabled": False,
+                "host": "127.0.0.1",
+                "port": 9466,
+            },
         }
 
         if os.path.exists(self. config_file):
@@ -690,6 +848,7 @@ class KeywordMonitorBot:
         message = update.message
         if not message:
             return
+        self.metrics.inc('tg_updates_received_total')
 
         # 过滤机器人消息
         if message.from_user and message.from_user.is_bot:
@@ -962,6 +1121,7 @@ class KeywordMonitorBot:
 
         if matched_results:
             self.stats['keywords_matched'] += len(matched_results)
+            self.metrics.inc('tg_keywords_matched_total', len(matched_results))
             logger.info(f"检测到关键词匹配: {len(matched_results)} 个用户")
             await self._send_alerts(message, text, matched_results, source_info)
 
@@ -1100,6 +1260,7 @@ class KeywordMonitorBot:
         text_preview = text[:max_length] + '...' if len(text) > max_length else text
 
         source_id = source_info.get('chat_id') or source_info. get('user_id')
+        self.metrics.observe('tg_alert_fanout', len(matched_results))
 
         for uid, keywords in matched_results.items():
             try:
@@ -1149,16 +1310,23 @@ class KeywordMonitorBot:
                     reply_markup=reply_markup
                 )
                 self.stats['alerts_sent'] += 1
+                self.metrics.inc('tg_alerts_sent_total')
                 logger.info(f"已发送关键词提醒到用户 {uid}")
 
             except Exception as e:
                 logger.error(f"发送提醒到用户 {uid} 失败: {e}")
+                self.metrics.inc('tg_alerts_failed_total')
+                if isinstance(e, RetryAfter):
+                    retry_after = e.retry_after
+                    seconds = retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after
+                    self.metrics.inc('tg_flood_wait_seconds_total', seconds)
 
         # 记录日志
         self._log_match(matched_results, text, source_info)
 
     def _log_match(self, matched_results: Dict[int, List[str]], text: str, source_info: dict):
         """记录匹配日志"""
+        started = time.monotonic()
         try:
             conn = sqlite3.connect(self. db_path)
             cursor = conn.cursor()
@@ -1188,6 +1356,8 @@ class KeywordMonitorBot:
             conn.close()
         except Exception as e:
             logger.error(f"记录匹配日志失败: {e}")
+        finally:
+            self.metrics.observe('tg_sqlite_write_seconds', time.monotonic() - started)
 
     def run(self):
         """运行机器人"""
@@ -1219,6 +1389,11 @@ if __name__ == "__main__":
                 "case_sensitive": False,
                 "include_source_info": True,
                 "max_message_length": 500
+            },
+            "metrics": {
+                "enabled": False,
+                "host": "127.0.0.1",
+                "port": 9466
             }
         }
         with open(config_file, 'w', encoding='utf-8') as f:
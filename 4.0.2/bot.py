@@ -10,13 +10,16 @@ from typing import Dict, List, Set, Optional
 from telegram import Update, Message, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
 from telegram.ext import Application, MessageHandler, CommandHandler, ContextTypes, filters, CallbackQueryHandler
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 import sqlite3
 from pathlib import Path
 import html
+import time
 import re
 from collections import defaultdict
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from openai import AsyncOpenAI
+import httpx
 
 # 版本信息
 VERSION = "4.0. 1"
@@ -45,6 +48,136 @@ def escape_markdown_v2(text: str) -> str:
     return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
 
 
+# 1.0.0/listen_bot.py、4.0.2/bot.py、5.1.0/telegram.py 各有一份相同的 Metrics：
+# 各版本都是单文件脚本、单独部署，不共享模块，修改时三处同步
+class Metrics:
+    """Prometheus 文本格式指标 - 计数器/仪表/直方图，可选本地 /metrics 端点"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, default_port: int = 9464, logger=None):
+        # 各版本的默认端口不同；logger 为 None 时直接 print
+        self.default_port = default_port
+        self.logger = logger
+        self.meta = {}
+        self.values = {}
+        self.server = None
+        self.lag_task = None
+
+    def _log(self, level: str, message: str):
+        if self.logger:
+            getattr(self.logger, level)(message)
+        else:
+            print(message)
+
+    def describe(self, name: str, kind: str, help_text: str, buckets=None):
+        """登记指标，kind 为 counter / gauge / histogram"""
+        self.meta[name] = (kind, help_text, tuple(buckets or self.DEFAULT_BUCKETS))
+        self.values.setdefault(name, {})
+
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self.values[name]
+        key = self._labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self.values[name][self._labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self.meta[name][2]
+        series = self.values[name]
+        key = self._labels(labels)
+        state = series.get(key)
+        if state is None:
+            state = series[key] = [[0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                state[0][i] += 1
+        state[1] += value
+        state[2] += 1
+
+    @staticmethod
+    def _format_labels(pairs) -> str:
+        if not pairs:
+            return ''
+        escaped = []
+        for k, v in pairs:
+            v = v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{k}="{v}"')
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self) -> str:
+        """输出 Prometheus 文本格式"""
+        lines = []
+        for name, (kind, help_text, buckets) in self.meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in list(self.values[name].items()):
+                if kind != 'histogram':
+                    lines.append(f"{name}{self._format_labels(key)} {value}")
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{self._format_labels(key + (('le', str(bound)),))} {bucket_count}")
+                lines.append(f"{name}_bucket{self._format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self._format_labels(key)} {total}")
+                lines.append(f"{name}_count{self._format_labels(key)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # 读完请求头，忽略内容
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=5)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def monitor_loop_lag(self, interval: float = 1.0):
+        """定时休眠并测量实际唤醒延迟，作为事件循环阻塞程度"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - started - interval)
+            self.observe('tg_event_loop_lag_seconds', lag)
+            self.set('tg_event_loop_lag_last_seconds', lag)
+
+    async def start(self, settings: dict):
+        """按配置启动 /metrics 端点和事件循环延迟监测"""
+        if not settings.get('enabled', False) or self.server is not None:
+            return
+        host = settings.get('host', '127.0.0.1')
+        port = settings.get('port', self.default_port)
+        try:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        except OSError as e:
+            self._log('error', f"❌ 指标端点启动失败 {host}:{port}: {e}")
+            return
+        self.lag_task = asyncio.create_task(self.monitor_loop_lag(settings.get('loop_lag_interval', 1.0)))
+        self._log('info', f"📈 指标端点已启动: http://{host}:{port}/metrics")
+
+
 class MediaGroupHandler:
     """媒体组处理器"""
 
@@ -83,35 +216,87 @@ class MediaGroupHandler:
                 del self.group_timers[group_id]
 
 
+# 影响连接池的配置项，变化时需要重建客户端
+LLM_HTTP_KEYS = ('http_max_connections', 'http_max_keepalive', 'http_keepalive_seconds',
+                 'http_timeout_seconds', 'http_connect_timeout_seconds', 'http_max_retries')
+
+
+def build_llm_client(api_key: str, base_url: str, settings: dict) -> AsyncOpenAI:
+    """创建带连接池的 AsyncOpenAI 客户端，长连接在请求之间复用"""
+    timeout = httpx.Timeout(settings.get('http_timeout_seconds', 60),
+                            connect=settings.get('http_connect_timeout_seconds', 5))
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=settings.get('http_max_connections', 10),
+                            max_keepalive_connections=settings.get('http_max_keepalive', 5),
+                            keepalive_expiry=settings.get('http_keepalive_seconds', 60)),
+        timeout=timeout,
+    )
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, timeout=timeout,
+                       max_retries=settings.get('http_max_retries', 2))
+
+
+async def close_llm_client(client: AsyncOpenAI, delay: float = 0):
+    """等进行中的请求结束后关闭旧客户端的连接池"""
+    await asyncio.sleep(delay)
+    try:
+        await client.close()
+    except Exception as e:
+        logger.warning(f"关闭 LLM 客户端失败: {e}")
+
+
 class DeepSeekRewriter:
     """DeepSeek AI 文本重写器"""
 
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, metrics: Metrics):
         self.config = config
+        self.metrics = metrics
         self.client = None
+        # 当前客户端对应的 (api_key, base_url, 连接池配置)
+        self.client_key = None
         self._init_client()
 
     def _init_client(self):
-        """初始化 OpenAI 客户端"""
+        """初始化 OpenAI 客户端，凭据和连接池配置不变时沿用现有客户端"""
         settings = self.config.get('deepseek_settings', {})
         api_key = settings.get('api_key', '')
         base_url = settings.get('base_url', 'https://api.deepseek.com')
+        if not (api_key and api_key not in ['', 'put your api key here', 'your_api_key']):
+            api_key = None
+        client_key = (api_key, base_url, tuple(settings.get(key) for key in LLM_HTTP_KEYS))
+        if client_key == self.client_key:
+            return
 
-        if api_key and api_key not in ['', 'put your api key here', 'your_api_key']:
-            self.client = AsyncOpenAI(
-                api_key=api_key,
-                base_url=base_url
-            )
+        old_client = self.client
+        self.client_key = client_key
+        if api_key:
+            self.client = build_llm_client(api_key, base_url, settings)
             logger.info("✅ DeepSeek 客户端已初始化")
         else:
             self.client = None
             logger.info("ℹ️ DeepSeek API Key 未配置")
+        if old_client:
+            self._retire(old_client, settings.get('http_timeout_seconds', 60))
+
+    @staticmethod
+    def _retire(client: AsyncOpenAI, grace: float):
+        """进行中的请求仍在使用旧客户端，超时时间过后再关闭"""
+        try:
+            asyncio.get_running_loop().create_task(close_llm_client(client, grace))
+        except RuntimeError:
+            pass
 
     def update_config(self, config: dict):
         """更新配置"""
         self.config = config
         self._init_client()
 
+    async def close(self):
+        """关闭客户端"""
+        if self.client:
+            await close_llm_client(self.client)
+            self.client = None
+            self.client_key = None
+
     async def rewrite_text(self, text: str) -> str:
         """使用 DeepSeek 重写文本"""
         settings = self.config.get('deepseek_settings', {})
@@ -135,6 +320,7 @@ class DeepSeekRewriter:
 
             logger.info(f"开始 DeepSeek 重写...")
 
+            started = time.monotonic()
             response = await self.client.chat.completions.create(
                 model=model,
                 messages=[
@@ -144,6 +330,11 @@ class DeepSeekRewriter:
                 max_tokens=max_tokens,
                 temperature=temperature
             )
+            self.metrics.observe('tg_llm_request_seconds', time.monotonic() - started)
+            usage = getattr(response, 'usage', None)
+            if usage:
+                self.metrics.inc('tg_llm_tokens_total', usage.prompt_tokens or 0, kind='prompt')
+                self.metrics.inc('tg_llm_tokens_total', usage.completion_tokens or 0, kind='completion')
 
             rewritten_text = response.choices[0].message.content.strip()
             logger.info(f"✅ DeepSeek 重写成功")
@@ -157,14 +348,15 @@ class DeepSeekRewriter:
 class TelegramForwardBot:
     def __init__(self, token: str):
         self.token = token
-        self.application = Application.builder().token(token).build()
+        self.application = Application.builder().token(token).post_init(self._post_init).post_shutdown(self._post_shutdown).build()
         self.db_path = "forward_bot.db"
         self.config_file = "bot_config.json"
 
         self.media_group_handler = MediaGroupHandler()
+        self.metrics = self.create_metrics()
         self.init_database()
         self.config = self.load_config()
-        self.deepseek_rewriter = DeepSeekRewriter(self.config)
+        self.deepseek_rewriter = DeepSeekRewriter(self.config, self.metrics)
 
         self.stats = {
             'messages_received': 0,
@@ -176,6 +368,38 @@ class TelegramForwardBot:
 
         self.register_handlers()
 
+    @staticmethod
+    def create_metrics() -> Metrics:
+        """创建指标集合"""
+        metrics = Metrics(default_port=9465, logger=logger)
+        metrics.describe('tg_updates_received_total', 'counter', '收到的消息更新数')
+        metrics.describe('tg_forwards_sent_total', 'counter', '成功转发的消息数')
+        metrics.describe('tg_forwards_failed_total', 'counter', '转发失败的消息数')
+        metrics.describe('tg_media_groups_total', 'counter', '转发的媒体组数')
+        metrics.describe('tg_flood_wait_seconds_total', 'counter', 'RetryAfter 限流累计秒数')
+        metrics.describe('tg_llm_request_seconds', 'histogram', 'DeepSeek 请求耗时')
+        metrics.describe('tg_llm_tokens_total', 'counter', 'DeepSeek 消耗的 token 数')
+        metrics.describe('tg_sqlite_write_seconds', 'histogram', 'SQLite 日志写入耗时')
+        metrics.describe('tg_event_loop_lag_seconds', 'histogram', '事件循环调度延迟')
+        metrics.describe('tg_event_loop_lag_last_seconds', 'gauge', '最近一次事件循环调度延迟')
+        return metrics
+
+    async def _post_init(self, application: Application):
+        """事件循环启动后开启指标端点"""
+        await self.metrics.start(self.config.get('metrics_settings', {}))
+
+    async def _post_shutdown(self, application: Application):
+        """退出时关闭 LLM 连接池"""
+        await self.deepseek_rewriter.close()
+
+    def record_forward_error(self, target_id: int, count: int, error: Exception):
+        """记录转发失败指标"""
+        self.metrics.inc('tg_forwards_failed_total', count, target=target_id)
+        if isinstance(error, RetryAfter):
+            retry_after = error.retry_after
+            seconds = retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after
+            self.metrics.inc('tg_flood_wait_seconds_total', seconds)
+
     def init_database(self):
         """初始化数据库"""
         conn = sqlite3.connect(self.db_path)
@@ -265,7 +489,18 @@ class TelegramForwardBot:
                 "model": "deepseek-chat",
                 "system_prompt": "你是一个专业的文本重写助手。请将用户提供的文本进行重写，保持原意但使用不同的表达方式。保持原文的语言。只返回重写后的文本，不要添加任何解释。",
                 "max_tokens": 2000,
-                "temperature": 0.7
+                "temperature": 0.7,
+                "http_max_connections": 10,
+                "http_max_keepalive": 5,
+                "http_keepalive_seconds": 60,
+                "http_timeout_seconds": 60,
+                "http_connect_timeout_seconds": 5,
+                "http_max_retries": 2
+            },
+            "metrics_settings": {
+                "enabled": False,
+                "host": "127.0.0.1",
+                "port": 9465
             }
         }
 
@@ -783,6 +1018,7 @@ API 地址: {base_url}
         message = update.message
         if not message:
             return
+        self.metrics.inc('tg_updates_received_total')
 
         chat_id = message.chat_id
         user_id = message.from_user.id if message.from_user else None
@@ -1122,6 +1358,8 @@ API 地址: {base_url}
 
                     self.stats['messages_forwarded'] += len(messages)
                     self.stats['media_groups_forwarded'] += 1
+                    self.metrics.inc('tg_forwards_sent_total', len(messages), target=target_id)
+                    self.metrics.inc('tg_media_groups_total')
                     logger.info(f"媒体组已转发: -> {target_id} ({len(messages)}条)")
 
                     # 记录日志
@@ -1133,6 +1371,7 @@ API 地址: {base_url}
                 error_msg = str(e)
                 logger.error(f"媒体组转发失败 -> {target_id}: {error_msg}")
                 self.stats['failed_forwards'] += len(messages)
+                self.record_forward_error(target_id, len(messages), e)
 
                 for msg in messages:
                     self.log_forward(msg.chat_id, target_id, msg.message_id, None,
@@ -1191,6 +1430,7 @@ API 地址: {base_url}
                     )
 
                 self.stats['messages_forwarded'] += 1
+                self.metrics.inc('tg_forwards_sent_total', target=target_id)
                 logger.info(f"消息已转发: -> {target_id}")
                 self.log_forward(message.chat_id, target_id, message.message_id, None,
                                  content_type, None, False, True, None)
@@ -1199,6 +1439,7 @@ API 地址: {base_url}
                 error_msg = str(e)
                 logger.error(f"转发失败 -> {target_id}: {error_msg}")
                 self.stats['failed_forwards'] += 1
+                self.record_forward_error(target_id, 1, e)
                 self.log_forward(message.chat_id, target_id, message.message_id, None,
                                  content_type, None, False, False, error_msg)
 
@@ -1228,6 +1469,7 @@ API 地址: {base_url}
                     content_type: str, media_group_id: str, is_media_group: bool,
                     success: bool, error_msg: str):
         """记录转发日志"""
+        started = time.monotonic()
         try:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
@@ -1244,6 +1486,8 @@ API 地址: {base_url}
             conn.close()
         except Exception as e:
             logger.error(f"记录转发日志失败: {e}")
+        finally:
+            self.metrics.observe('tg_sqlite_write_seconds', time.monotonic() - started)
 
     async def notify_admins_error(self, message: Message, target_id: int, error_msg: str):
         """通知管理员转发错误"""
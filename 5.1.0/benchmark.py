@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+监听器压测脚本 - 用进程内的模拟 Telethon 客户端驱动 telegram.py 的消息流水线
+
+示例:
+    python benchmark.py --messages 5000 --sources 4 --targets 2 --album-ratio 0.2
+    python benchmark.py --rpc-latency-ms 80 --flood-rate 0.01 --json result.json
+
+在临时目录中生成配置并通过 TG_LISTENER_HOME 加载 telegram.py，不会读写真实配置和会话。
+输出吞吐量、转发延迟 p50/p99 和内存增长，可用 --json 保存结果以便前后对比。
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from types import SimpleNamespace
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+LISTENER_FILE = os.path.join(SCRIPT_DIR, 'telegram.py')
+
+SOURCE_BASE_ID = -1001000000000
+SELF_USER_ID = 10000
+# 群聊里高度重复的短消息
+CHATTER = ['哈哈哈', '哈哈哈哈哈', '在吗', '在吗？', '早上好', '666', '牛', '确实']
+
+
+class FakeSender:
+    """模拟消息发送者"""
+
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = f"user{user_id}"
+        self.last_name = None
+        self.username = f"user{user_id}"
+
+
+class FakeMessage:
+    """模拟 Telethon Message，只提供流水线用到的字段"""
+
+    def __init__(self, chat_id: int, msg_id: int, text: str, sender_id: int, grouped_id=None, photo=None):
+        self.chat_id = chat_id
+        self.id = msg_id
+        self.message = text
+        self.text = text
+        self.caption = None
+        self.sender_id = sender_id
+        self.grouped_id = grouped_id
+        self.photo = photo
+        self.document = None
+        self.reply_to_msg_id = None
+        self.date = None
+
+    async def get_reply_message(self):
+        return None
+
+
+class FakeEvent:
+    """模拟 NewMessage.Event"""
+
+    def __init__(self, fake_client, message: FakeMessage, sender: FakeSender):
+        self.client = fake_client
+        self.message = message
+        self.chat_id = message.chat_id
+        self.sender_id = sender.id
+        self.sender = sender
+        self.is_private = False
+        self.is_group = True
+
+    async def get_sender(self):
+        return self.sender
+
+    async def reply(self, text: str):
+        return await self.client.send_message(self.chat_id, text)
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeTelegramClient:
+    """模拟 TelegramClient - 可配置 RPC 延迟和 FloodWait 注入，并记录每条消息的投递延迟"""
+
+    def __init__(self, listener, args):
+        self.listener = listener
+        self.latency = args.rpc_latency_ms / 1000
+        self.jitter = args.rpc_jitter_ms / 1000
+        self.flood_rate = args.flood_rate
+        self.flood_seconds = args.flood_seconds
+        self.sent_at = {}
+        self.latencies = []
+        self.delivered = 0
+        self.forward_calls = 0
+        self.flood_waits = 0
+        self.messages_sent = 0
+        self.last_delivery = None
+
+    async def _rpc(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)
+
+    async def __call__(self, request):
+        await self._rpc()
+        return True
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def get_me(self):
+        await self._rpc()
+        return SimpleNamespace(id=SELF_USER_ID, username='bench_self', first_name='bench', last_name=None)
+
+    async def get_input_entity(self, key):
+        await self._rpc()
+        listener = self.listener
+        if isinstance(key, int):
+            real_id, peer_type = listener.utils.resolve_id(key)
+            if peer_type.__name__ == 'PeerChannel':
+                return listener.InputPeerChannel(real_id, 0)
+            if peer_type.__name__ == 'PeerChat':
+                return listener.InputPeerChat(real_id)
+            return listener.InputPeerUser(real_id, 0)
+        # 用户名映射为稳定的用户 ID
+        return listener.InputPeerUser(zlib.crc32(str(key).encode('utf-8')) + 1, 0)
+
+    async def get_entity(self, key):
+        return await self.get_input_entity(key)
+
+    async def forward_messages(self, entity, messages, from_peer=None):
+        await self._rpc()
+        self.forward_calls += 1
+        if self.flood_rate and random.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise self.listener.FloodWaitError(request=None, capture=self.flood_seconds)
+        now = time.monotonic()
+        ids = messages if isinstance(messages, (list, tuple)) else [messages]
+        for msg_id in ids:
+            sent_at = self.sent_at.get((from_peer, msg_id))
+            if sent_at is not None:
+                self.latencies.append(now - sent_at)
+        self.delivered += len(ids)
+        self.last_delivery = now
+        return [SimpleNamespace(id=msg_id) for msg_id in ids]
+
+    async def send_message(self, entity, message, **kwargs):
+        await self._rpc()
+        self.messages_sent += 1
+        return SimpleNamespace(id=self.messages_sent)
+
+    async def get_messages(self, *args, **kwargs):
+        return []
+
+    async def iter_messages(self, *args, **kwargs):
+        return
+        yield
+
+    def action(self, entity, action):
+        return FakeTyping()
+
+
+class FakeLLM:
+    """模拟 AsyncOpenAI 客户端"""
+
+    def __init__(self, latency: float, tail_ratio: float = 0.0):
+        self.latency = latency
+        # 以该概率出现 10 倍延迟的长尾请求
+        self.tail_ratio = tail_ratio
+        self.requests = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, stream: bool = False, **kwargs):
+        self.requests += 1
+        content = random.choice(['哈哈', '确实', '有道理', '[SKIP]'])
+        usage = SimpleNamespace(prompt_tokens=200, completion_tokens=8)
+        latency = self.latency * 10 if random.random() < self.tail_ratio else self.latency
+        if stream:
+            return FakeStream(content, usage, latency)
+        await asyncio.sleep(latency)
+        message = SimpleNamespace(content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+class FakeStream:
+    """模拟流式响应：首块在一半延迟后到达，其余均匀分布"""
+
+    def __init__(self, content: str, usage, latency: float):
+        self.pieces = [content[i:i + 2] for i in range(0, len(content), 2)]
+        self.usage = usage
+        self.latency = latency
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.latency / 2)
+        for piece in self.pieces:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))], usage=None)
+            await asyncio.sleep(self.latency / 2 / len(self.pieces))
+        yield SimpleNamespace(choices=[], usage=self.usage)
+
+    async def close(self):
+        pass
+
+
+def build_config(args) -> dict:
+    """生成压测配置"""
+    mappings = []
+    for s in range(args.sources):
+        for t in range(args.targets):
+            mappings.append({"source_chat": str(SOURCE_BASE_ID - s), "target_bot": f"@bench_target_{t}"})
+    ai_chats = [SOURCE_BASE_ID - s for s in range(min(args.ai_chats, args.sources))]
+    return {
+        "api_id": 1,
+        "api_hash": "benchmark",
+        "master_account_id": SELF_USER_ID,
+        "admin_ids": [],
+        "bot_mappings": mappings,
+        "proxy": {},
+        "ai_chat": {
+            "enabled": bool(ai_chats),
+            "api_key": "",
+            "chats": ai_chats,
+            "reply_probability": 100,
+            "cooldown_seconds": 0,
+            "min_active_users": 0,
+            "typing_simulation": False,
+            "stream_replies": args.stream,
+            "reply_cache_enabled": args.reply_cache,
+            "alert_enabled": False,
+        },
+        "forwarding": {
+            # 重复短消息会被内容去重拦下，按条数统计投递时关闭
+            "dedupe_enabled": not args.chatter_ratio,
+            "target_rate_per_second": args.target_rate,
+            "target_burst": max(1, int(args.target_rate)),
+            "global_rate_per_second": args.global_rate,
+            "global_burst": max(1, int(args.global_rate)),
+            "catchup_enabled": False,
+            "max_queued_messages": args.max_queued,
+        },
+        "metrics": {"enabled": False},
+    }
+
+
+def load_listener(data_dir: str):
+    """在临时目录下加载 telegram.py（模块名避免与 python-telegram-bot 冲突）"""
+    os.environ['TG_LISTENER_HOME'] = data_dir
+    spec = importlib.util.spec_from_file_location('tg_listener_bench', LISTENER_FILE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def bind_client(listener, fake_client):
+    """用模拟客户端替换模块和各组件持有的 TelegramClient"""
+    listener.client = fake_client
+    for value in list(vars(listener).values()):
+        if hasattr(value, 'tg_client') and not isinstance(value, type):
+            value.tg_client = fake_client
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def failed_ids(listener) -> int:
+    """从指标中读取转发失败和被丢弃的消息数"""
+    return int(sum(sum(listener.metrics.values.get(name, {}).values())
+                   for name in ('tg_forwards_failed_total', 'tg_forwards_dropped_total')))
+
+
+async def generate_events(listener, fake_client, args):
+    """按配置生成文本和媒体组消息，依次交给 handler"""
+    next_ids = {SOURCE_BASE_ID - s: 1 for s in range(args.sources)}
+    sources = list(next_ids)
+    interval = 1 / args.rate if args.rate > 0 else 0
+    started = time.monotonic()
+    produced = 0
+    grouped_seq = 0
+
+    while produced < args.messages:
+        source_id = sources[produced % len(sources)]
+        if args.album_ratio and random.random() < args.album_ratio:
+            grouped_seq += 1
+            size = min(args.album_size, args.messages - produced)
+            batch = [("", grouped_seq, SimpleNamespace(id=grouped_seq * 100 + i)) for i in range(size)]
+        elif args.chatter_ratio and random.random() < args.chatter_ratio:
+            batch = [(random.choice(CHATTER), None, None)]
+        else:
+            batch = [(f"bench message {produced} from {source_id} {random.random()}", None, None)]
+
+        for text, grouped_id, photo in batch:
+            msg_id = next_ids[source_id]
+            next_ids[source_id] += 1
+            sender = FakeSender(random.randint(1, args.senders))
+            message = FakeMessage(source_id, msg_id, text, sender.id, grouped_id, photo)
+            fake_client.sent_at[(source_id, msg_id)] = time.monotonic()
+            await listener.handler(FakeEvent(fake_client, message, sender))
+            produced += 1
+            if interval:
+                delay = started + produced * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+    return time.monotonic() - started
+
+
+async def run(args) -> dict:
+    random.seed(args.seed)
+    data_dir = tempfile.mkdtemp(prefix='tg_listener_bench_')
+    with open(os.path.join(data_dir, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(build_config(args), f, ensure_ascii=False, indent=4)
+
+    listener = load_listener(data_dir)
+    fake_client = FakeTelegramClient(listener, args)
+    bind_client(listener, fake_client)
+    fake_llms = []
+    if args.ai_chats:
+        router = listener.ai_manager.router
+        for i in range(max(1, args.llm_endpoints)):
+            fake_llm = FakeLLM(args.llm_latency_ms / 1000, args.llm_tail_ratio)
+            fake_llms.append(fake_llm)
+            router.endpoints.append(listener.LLMEndpoint(f"bench{i}", fake_llm, 'bench-model'))
+
+    me = await listener.identity_cache.get_me(refresh=True)
+    listener.ai_manager.my_user_id = me.id
+    await listener.rebuild_forwarding_map()
+    listener.forward_scheduler.start()
+    listener.media_group_aggregator.start()
+    listener.event_pipeline.start()
+
+    tracemalloc.start()
+    mem_before, _ = tracemalloc.get_traced_memory()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started = time.monotonic()
+    produce_seconds = await generate_events(listener, fake_client, args)
+
+    expected = args.messages * args.targets
+    deadline = time.monotonic() + args.drain_timeout
+    while fake_client.delivered + failed_ids(listener) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    await listener.event_pipeline.ai_queue.join()
+    finished = fake_client.last_delivery or time.monotonic()
+
+    mem_after, mem_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    elapsed = max(finished - started, 1e-9)
+    latencies = fake_client.latencies
+    return {
+        'messages': args.messages,
+        'targets_per_source': args.targets,
+        'expected_deliveries': expected,
+        'delivered': fake_client.delivered,
+        'failed': failed_ids(listener),
+        'forward_calls': fake_client.forward_calls,
+        'flood_waits_injected': fake_client.flood_waits,
+        'produce_seconds': round(produce_seconds, 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_msgs_per_second': round(args.messages / elapsed, 1),
+        'deliveries_per_second': round(fake_client.delivered / elapsed, 1),
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'latency_max_ms': round(max(latencies, default=0) * 1000, 2),
+        'llm_requests': sum(fake_llm.requests for fake_llm in fake_llms),
+        'llm_router': listener.ai_manager.router.summary(),
+        'ai_replies_sent': fake_client.messages_sent,
+        'reply_cache': listener.ai_manager.reply_cache.summary(),
+        'memory_growth_kb': round((mem_after - mem_before) / 1024, 1),
+        'memory_peak_kb': round((mem_peak - mem_before) / 1024, 1),
+        'max_rss_growth_kb': rss_after - rss_before,
+        'pipeline': listener.event_pipeline.summary(),
+        'scheduler': listener.forward_scheduler.summary(),
+    }
+
+
+def print_report(result: dict):
+    print("=" * 60)
+    print("📊 压测结果")
+    print("=" * 60)
+    print(f"📨 消息: {result['messages']} 条，投递 {result['delivered']}/{result['expected_deliveries']}，"
+          f"失败 {result['failed']}，转发调用 {result['forward_calls']} 次")
+    print(f"⏳ 注入 FloodWait: {result['flood_waits_injected']} 次")
+    print(f"🚀 吞吐量: {result['throughput_msgs_per_second']} 条/秒（投递 {result['deliveries_per_second']} 次/秒），"
+          f"总耗时 {result['elapsed_seconds']} 秒")
+    print(f"⏱️ 转发延迟: p50 {result['latency_p50_ms']}ms，p99 {result['latency_p99_ms']}ms，"
+          f"最大 {result['latency_max_ms']}ms")
+    print(f"🤖 LLM 请求: {result['llm_requests']} 次，AI 回复 {result['ai_replies_sent']} 条，"
+          f"回复缓存 {result['reply_cache']}")
+    if result['llm_requests']:
+        print(f"🔀 LLM 端点: {result['llm_router']}")
+    print(f"💾 内存: 增长 {result['memory_growth_kb']}KB，峰值 +{result['memory_peak_kb']}KB，"
+          f"RSS 峰值 +{result['max_rss_growth_kb']}KB")
+    print(f"🚦 流水线: {result['pipeline']}")
+    print(f"📤 调度: {result['scheduler']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='telegram.py 消息流水线压测')
+    parser.add_argument('--messages', type=int, default=5000, help='消息总数')
+    parser.add_argument('--sources', type=int, default=4, help='源数量')
+    parser.add_argument('--targets', type=int, default=2, help='每个源的目标数量')
+    parser.add_argument('--senders', type=int, default=50, help='每个源的发送者数量')
+    parser.add_argument('--rate', type=float, default=0, help='每秒产生的消息数，0 表示不限速')
+    parser.add_argument('--album-ratio', type=float, default=0.1, help='以媒体组形式出现的比例')
+    parser.add_argument('--album-size', type=int, default=4, help='每个媒体组的消息数')
+    parser.add_argument('--rpc-latency-ms', type=float, default=20, help='模拟 RPC 基础延迟')
+    parser.add_argument('--rpc-jitter-ms', type=float, default=10, help='模拟 RPC 随机抖动')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='转发调用触发 FloodWait 的概率')
+    parser.add_argument('--flood-seconds', type=int, default=1, help='注入的 FloodWait 秒数')
+    parser.add_argument('--target-rate', type=float, default=1000, help='每个目标的限速（次/秒）')
+    parser.add_argument('--global-rate', type=float, default=5000, help='全局限速（次/秒）')
+    parser.add_argument('--max-queued', type=int, default=20000, help='调度队列最多排队的消息数')
+    parser.add_argument('--ai-chats', type=int, default=0, help='开启 AI 炒群的源数量')
+    parser.add_argument('--llm-latency-ms', type=float, default=500, help='模拟 LLM 响应延迟')
+    parser.add_argument('--llm-endpoints', type=int, default=1, help='模拟的 LLM 端点数，多于 1 个时启用对冲')
+    parser.add_argument('--llm-tail-ratio', type=float, default=0.0, help='LLM 请求出现 10 倍长尾延迟的概率')
+    parser.add_argument('--stream', action='store_true', help='AI 回复使用流式生成')
+    parser.add_argument('--reply-cache', action='store_true', help='启用 AI 回复缓存')
+    parser.add_argument('--chatter-ratio', type=float, default=0.0, help='重复短消息（哈哈、在吗等）的比例')
+    parser.add_argument('--drain-timeout', type=float, default=120, help='等待全部投递完成的最长秒数')
+    parser.add_argument('--seed', type=int, default=1, help='随机种子')
+    parser.add_argument('--json', help='将结果保存为 JSON 文件')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+        print(f"✅ 结果已保存到 {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,20 +6,30 @@ from telethon.tl.functions.channels import JoinChannelRequest, LeaveChannelReque
 from telethon.tl.functions.account import UpdateProfileRequest
 from telethon.tl.functions.photos import UploadProfilePhotoRequest, DeletePhotosRequest
 from telethon.tl.functions.users import GetFullUserRequest
+from telethon.tl.functions.messages import SetTypingRequest
 from telethon.events import NewMessage
+from telethon.errors import FloodWaitError
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser, SendMessageTypingAction
+from telethon import utils
 import asyncio
+import hashlib
+import heapq
 import json
+import math
+import multiprocessing
+import queue
+import signal
 import os
 import sys
 import random
 import re
+import time
+from copy import deepcopy
+from types import MappingProxyType
 from datetime import datetime, timedelta
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 from openai import AsyncOpenAI
-
-# 用于处理媒体组的缓存和锁
-media_group_cache = {}
-media_group_lock = asyncio.Lock()
+import httpx
 
 # 版本信息
 VERSION = "5.1.0"
@@ -32,7 +42,16 @@ BANNER = f"""
 
 # 获取脚本所在目录
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-CONFIG_FILE = os.path.join(SCRIPT_DIR, 'config.json')
+# 配置、会话和状态文件所在目录，可通过环境变量指向其他目录（如压测时使用临时目录）
+DATA_DIR = os.environ.get('TG_LISTENER_HOME', SCRIPT_DIR)
+CONFIG_FILE = os.path.join(DATA_DIR, 'config.json')
+ENTITY_CACHE_FILE = os.path.join(DATA_DIR, 'entity_cache.json')
+DEDUPE_BLOOM_FILE = os.path.join(DATA_DIR, 'dedupe_bloom.bin')
+CHECKPOINT_FILE = os.path.join(DATA_DIR, 'checkpoints.json')
+BACKFILL_STATE_FILE = os.path.join(DATA_DIR, 'backfill_state.json')
+
+# 启动时并发解析实体的最大并发数
+ENTITY_RESOLVE_CONCURRENCY = 8
 
 
 def load_config():
@@ -72,7 +91,67 @@ def load_config():
                 "active_check_minutes": 10,
                 "reply_delay_min": 2,
                 "reply_delay_max": 5,
-            }
+                "state_max_chats": 2000,
+                "state_idle_minutes": 120,
+                "state_max_mb": 32,
+                "llm_max_inflight": 4,
+                "llm_requests_per_minute": 60,
+                "llm_ambient_ttl_seconds": 15,
+                "stream_replies": False,
+                "reply_cache_enabled": False,
+                "reply_cache_ttl_seconds": 1800,
+                "reply_cache_max_entries": 500,
+                "reply_cache_per_chat": 100,
+                "reply_cache_variants": 4,
+                "reply_cache_max_trigger_len": 12,
+                "http_max_connections": 20,
+                "http_max_keepalive": 10,
+                "http_keepalive_seconds": 60,
+                "http_timeout_seconds": 30,
+                "http_connect_timeout_seconds": 5,
+                "http_max_retries": 2,
+                "endpoints": [],
+                "hedge_enabled": True,
+                "hedge_min_seconds": 1.0,
+                "hedge_default_seconds": 3.0,
+                "breaker_failures": 3,
+                "breaker_cooldown_seconds": 60,
+            },
+            "forwarding": {
+                "workers": 4,
+                "target_rate_per_second": 1.0,
+                "target_burst": 5,
+                "global_rate_per_second": 5.0,
+                "global_burst": 10,
+                "max_flood_retries": 5,
+                "coalesce_window_ms": 500,
+                "coalesce_max_ids": 100,
+                "media_group_timeout": 1.5,
+                "dedupe_enabled": True,
+                "dedupe_ttl_seconds": 900,
+                "dedupe_max_entries": 50000,
+                "dedupe_bloom": False,
+                "dedupe_bloom_bits": 8388608,
+                "catchup_enabled": True,
+                "catchup_max_messages": 2000,
+                "checkpoint_interval": 5,
+                "max_queued_messages": 20000,
+            },
+            "pipeline": {
+                "intake_queue_size": 1000,
+                "forward_queue_size": 5000,
+                "ai_queue_size": 100,
+                "forward_workers": 1,
+                "ai_workers": 2,
+                "ai_max_age_seconds": 60,
+                "ai_processes": 0,
+            },
+            "metrics": {
+                "enabled": False,
+                "host": "127.0.0.1",
+                "port": 9464,
+            },
+            "accounts": []
         }
         with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
             json.dump(default_config, f, ensure_ascii=False, indent=4)
@@ -83,14 +162,113 @@ def load_config():
         return json.load(f)
 
 
+def atomic_write(path: str, content):
+    """先写临时文件再原子替换，避免写入中途崩溃留下半截文件"""
+    mode = 'wb' if isinstance(content, (bytes, bytearray)) else 'w'
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode, **({} if mode == 'wb' else {'encoding': 'utf-8'})) as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def thaw(value):
+    """只读快照转回普通字典和列表（用于传给子进程）"""
+    if isinstance(value, (dict, MappingProxyType)):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(v) for v in value]
+    return value
+
+
+def freeze(value):
+    """递归转换为只读结构"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class ConfigStore:
+    """配置持久化 - 合并短时间内的多次修改、后台原子写入、版本号和只读快照"""
+
+    def __init__(self, path: str, debounce_seconds: float = 0.5):
+        self.path = path
+        self.debounce_seconds = debounce_seconds
+        self.version = 0
+        self.written_version = 0
+        self.snapshot = MappingProxyType({})
+        # 快照更新后的回调，参数为只读快照
+        self.listeners = []
+        self._pending = None
+        self._handle = None
+        self._write_lock = None
+
+    def commit(self, cfg: dict):
+        """提交配置修改：立即发布新快照，写盘合并后异步执行"""
+        self.version += 1
+        self._pending = cfg
+        self.snapshot = freeze(deepcopy(cfg))
+        for listener in self.listeners:
+            listener(self.snapshot)
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 事件循环启动前（如启动时补全配置）直接同步写入
+            self.flush_now()
+            return
+        if self._handle is None:
+            self._handle = loop.call_later(self.debounce_seconds, self._flush)
+
+    def _serialize(self):
+        return json.dumps(self._pending, ensure_ascii=False, indent=4), self.version
+
+    def _flush(self):
+        self._handle = None
+        if self._pending is None or self.written_version >= self.version:
+            return
+        # 在事件循环中序列化，避免线程读取正在被修改的字典
+        content, version = self._serialize()
+        asyncio.create_task(self._write(content, version))
+
+    async def _write(self, content: str, version: int):
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            if version <= self.written_version:
+                return
+            try:
+                await asyncio.to_thread(atomic_write, self.path, content)
+                self.written_version = version
+            except Exception as e:
+                print(f"❌ 保存配置文件失败: {e}")
+
+    def flush_now(self):
+        """同步写入尚未保存的修改（启动和退出时使用）"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._pending is None or self.written_version >= self.version:
+            return
+        content, version = self._serialize()
+        atomic_write(self.path, content)
+        self.written_version = version
+
+
+config_store = ConfigStore(CONFIG_FILE)
+
+
 def save_config(cfg):
     """保存配置文件"""
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(cfg, f, ensure_ascii=False, indent=4)
+    config_store.commit(cfg)
 
 
 # 加载配置
 config = load_config()
+config_store.snapshot = freeze(deepcopy(config))
 
 api_id = config['api_id']
 api_hash = config['api_hash']
@@ -106,7 +284,8 @@ def is_admin(user_id: int) -> bool:
         return True
     return user_id in admin_ids
 
-# 确保 ai_chat 配置存在
+# 确保 ai_chat 配置存在（补全后统一写入一次）
+config_changed = False
 if 'ai_chat' not in config:
     config['ai_chat'] = {
         "enabled": False,
@@ -129,8 +308,33 @@ if 'ai_chat' not in config:
         "active_check_minutes": 10,
         "reply_delay_min": 2,
         "reply_delay_max": 5,
+        "state_max_chats": 2000,
+        "state_idle_minutes": 120,
+        "state_max_mb": 32,
+        "llm_max_inflight": 4,
+        "llm_requests_per_minute": 60,
+        "llm_ambient_ttl_seconds": 15,
+        "stream_replies": False,
+        "reply_cache_enabled": False,
+        "reply_cache_ttl_seconds": 1800,
+        "reply_cache_max_entries": 500,
+        "reply_cache_per_chat": 100,
+        "reply_cache_variants": 4,
+        "reply_cache_max_trigger_len": 12,
+        "http_max_connections": 20,
+        "http_max_keepalive": 10,
+        "http_keepalive_seconds": 60,
+        "http_timeout_seconds": 30,
+        "http_connect_timeout_seconds": 5,
+        "http_max_retries": 2,
+        "endpoints": [],
+        "hedge_enabled": True,
+        "hedge_min_seconds": 1.0,
+        "hedge_default_seconds": 3.0,
+        "breaker_failures": 3,
+        "breaker_cooldown_seconds": 60,
     }
-    save_config(config)
+    config_changed = True
 
 # 确保新增配置项存在
 ai_chat_defaults = {
@@ -142,85 +346,2778 @@ ai_chat_defaults = {
     "active_check_minutes": 10,
     "reply_delay_min": 2,
     "reply_delay_max": 5,
+    "state_max_chats": 2000,
+    "state_idle_minutes": 120,
+    "state_max_mb": 32,
+    "llm_max_inflight": 4,
+    "llm_requests_per_minute": 60,
+    "llm_ambient_ttl_seconds": 15,
+    "stream_replies": False,
+    "reply_cache_enabled": False,
+    "reply_cache_ttl_seconds": 1800,
+    "reply_cache_max_entries": 500,
+    "reply_cache_per_chat": 100,
+    "reply_cache_variants": 4,
+    "reply_cache_max_trigger_len": 12,
+    "http_max_connections": 20,
+    "http_max_keepalive": 10,
+    "http_keepalive_seconds": 60,
+    "http_timeout_seconds": 30,
+    "http_connect_timeout_seconds": 5,
+    "http_max_retries": 2,
+    "endpoints": [],
+    "hedge_enabled": True,
+    "hedge_min_seconds": 1.0,
+    "hedge_default_seconds": 3.0,
+    "breaker_failures": 3,
+    "breaker_cooldown_seconds": 60,
 }
 for key, value in ai_chat_defaults.items():
     if key not in config['ai_chat']:
         config['ai_chat'][key] = value
-        save_config(config)
+        config_changed = True
+
+# 确保转发调度、流水线与指标配置存在
+section_defaults = {
+    "forwarding": {
+        "workers": 4,
+        "target_rate_per_second": 1.0,
+        "target_burst": 5,
+        "global_rate_per_second": 5.0,
+        "global_burst": 10,
+        "max_flood_retries": 5,
+        "coalesce_window_ms": 500,
+        "coalesce_max_ids": 100,
+        "media_group_timeout": 1.5,
+        "dedupe_enabled": True,
+        "dedupe_ttl_seconds": 900,
+        "dedupe_max_entries": 50000,
+        "dedupe_bloom": False,
+        "dedupe_bloom_bits": 8388608,
+        "catchup_enabled": True,
+        "catchup_max_messages": 2000,
+        "checkpoint_interval": 5,
+        "max_queued_messages": 20000,
+    },
+    "pipeline": {
+        "intake_queue_size": 1000,
+        "forward_queue_size": 5000,
+        "ai_queue_size": 100,
+        "forward_workers": 1,
+        "ai_workers": 2,
+        "ai_max_age_seconds": 60,
+        "ai_processes": 0,
+    },
+    "metrics": {
+        "enabled": False,
+        "host": "127.0.0.1",
+        "port": 9464,
+    },
+}
+for section, defaults in section_defaults.items():
+    config.setdefault(section, {})
+    for key, value in defaults.items():
+        if key not in config[section]:
+            config[section][key] = value
+            config_changed = True
+if config_changed:
+    save_config(config)
 
-# 配置代理
-proxy = None
-if proxy_config and proxy_config.get('proxy_type'):
-    proxy_type = proxy_config['proxy_type']
-    proxy_addr = proxy_config['addr']
-    proxy_port = proxy_config['port']
-    proxy_username = proxy_config.get('username')
-    proxy_password = proxy_config.get('password')
+
+def build_proxy(proxy_settings):
+    """根据配置生成 Telethon 代理参数"""
+    if not proxy_settings or not proxy_settings.get('proxy_type'):
+        return None
+    proxy_type = proxy_settings['proxy_type']
+    proxy_addr = proxy_settings['addr']
+    proxy_port = proxy_settings['port']
+    proxy_username = proxy_settings.get('username')
+    proxy_password = proxy_settings.get('password')
 
     if proxy_type.lower() == 'socks5':
-        proxy = ('socks5', proxy_addr, proxy_port, proxy_username, proxy_password)
+        return ('socks5', proxy_addr, proxy_port, proxy_username, proxy_password)
     elif proxy_type.lower() == 'http':
-        proxy = ('http', proxy_addr, proxy_port, proxy_username, proxy_password)
-    else:
-        print(f"⚠️ 不支持的代理类型: {proxy_type}")
-        proxy = None
+        return ('http', proxy_addr, proxy_port, proxy_username, proxy_password)
+    print(f"⚠️ 不支持的代理类型: {proxy_type}")
+    return None
+
+
+# 配置代理
+proxy = build_proxy(proxy_config)
 
 # 创建客户端
-client = TelegramClient(os.path.join(SCRIPT_DIR, 'anon'), api_id, api_hash, proxy=proxy)
+client = TelegramClient(os.path.join(DATA_DIR, 'anon'), api_id, api_hash, proxy=proxy)
 
 # forwarding_map 将在 main 函数中初始化
 forwarding_map = {}
+# 串行化对 forwarding_map 的异步修改（增量更新与后台校验），避免后完成的覆盖先完成的
+mapping_lock = asyncio.Lock()
 
 # 机器人运行状态
 bot_running = True
 
+# 发送者名称缓存容量与过期时间（秒）
+SENDER_CACHE_SIZE = 5000
+SENDER_CACHE_TTL = 600
+
+
+# 1.0.0/listen_bot.py、4.0.2/bot.py、5.1.0/telegram.py 各有一份相同的 Metrics：
+# 各版本都是单文件脚本、单独部署，不共享模块，修改时三处同步
+class Metrics:
+    """Prometheus 文本格式指标 - 计数器/仪表/直方图，可选本地 /metrics 端点"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, default_port: int = 9464, logger=None):
+        # 各版本的默认端口不同；logger 为 None 时直接 print
+        self.default_port = default_port
+        self.logger = logger
+        self.meta = {}
+        self.values = {}
+        self.server = None
+        self.lag_task = None
+
+    def _log(self, level: str, message: str):
+        if self.logger:
+            getattr(self.logger, level)(message)
+        else:
+            print(message)
+
+    def describe(self, name: str, kind: str, help_text: str, buckets=None):
+        """登记指标，kind 为 counter / gauge / histogram"""
+        self.meta[name] = (kind, help_text, tuple(buckets or self.DEFAULT_BUCKETS))
+        self.values.setdefault(name, {})
+
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self.values[name]
+        key = self._labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self.values[name][self._labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self.meta[name][2]
+        series = self.values[name]
+        key = self._labels(labels)
+        state = series.get(key)
+        if state is None:
+            state = series[key] = [[0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                state[0][i] += 1
+        state[1] += value
+        state[2] += 1
+
+    @staticmethod
+    def _format_labels(pairs) -> str:
+        if not pairs:
+            return ''
+        escaped = []
+        for k, v in pairs:
+            v = v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{k}="{v}"')
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self) -> str:
+        """输出 Prometheus 文本格式"""
+        lines = []
+        for name, (kind, help_text, buckets) in self.meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in list(self.values[name].items()):
+                if kind != 'histogram':
+                    lines.append(f"{name}{self._format_labels(key)} {value}")
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{self._format_labels(key + (('le', str(bound)),))} {bucket_count}")
+                lines.append(f"{name}_bucket{self._format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self._format_labels(key)} {total}")
+                lines.append(f"{name}_count{self._format_labels(key)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # 读完请求头，忽略内容
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=5)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def monitor_loop_lag(self, interval: float = 1.0):
+        """定时休眠并测量实际唤醒延迟，作为事件循环阻塞程度"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - started - interval)
+            self.observe('tg_event_loop_lag_seconds', lag)
+            self.set('tg_event_loop_lag_last_seconds', lag)
+
+    async def start(self, settings: dict):
+        """按配置启动 /metrics 端点和事件循环延迟监测"""
+        if not settings.get('enabled', False) or self.server is not None:
+            return
+        host = settings.get('host', '127.0.0.1')
+        port = settings.get('port', self.default_port)
+        try:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        except OSError as e:
+            self._log('error', f"❌ 指标端点启动失败 {host}:{port}: {e}")
+            return
+        self.lag_task = asyncio.create_task(self.monitor_loop_lag(settings.get('loop_lag_interval', 1.0)))
+        self._log('info', f"📈 指标端点已启动: http://{host}:{port}/metrics")
+
+
+metrics = Metrics()
+metrics.describe('tg_updates_received_total', 'counter', '收到的新消息数')
+metrics.describe('tg_forwards_sent_total', 'counter', '成功转发的消息数')
+metrics.describe('tg_forwards_failed_total', 'counter', '转发失败的消息数')
+metrics.describe('tg_forwards_dropped_total', 'counter', '调度队列超过硬上限被丢弃的消息数')
+metrics.describe('tg_forward_latency_seconds', 'histogram', '从入队到转发完成的耗时')
+metrics.describe('tg_media_groups_total', 'counter', '提交的媒体组数')
+metrics.describe('tg_flood_wait_seconds_total', 'counter', 'FloodWait 累计等待秒数')
+metrics.describe('tg_llm_request_seconds', 'histogram', 'LLM 请求耗时')
+metrics.describe('tg_llm_tokens_total', 'counter', 'LLM 消耗的 token 数')
+metrics.describe('tg_llm_first_token_seconds', 'histogram', '流式生成首个有效内容的耗时')
+metrics.describe('tg_llm_stream_aborted_total', 'counter', '开头即 [SKIP] 而提前中止的流式请求数')
+metrics.describe('tg_llm_prompt_cached_ratio', 'histogram', '每次 LLM 请求中命中服务端提示缓存的 token 比例',
+                 buckets=(0, 0.1, 0.25, 0.5, 0.75, 0.9, 1))
+metrics.describe('tg_llm_hedges_total', 'counter', 'LLM 对冲请求数（result=sent/won）')
+metrics.describe('tg_llm_endpoint_errors_total', 'counter', '各 LLM 端点的失败请求数')
+metrics.describe('tg_llm_breaker_open_total', 'counter', '各 LLM 端点的熔断次数')
+metrics.describe('tg_llm_reply_cache_total', 'counter', 'AI 回复缓存查询次数（result=hit/miss）')
+metrics.describe('tg_llm_queue_seconds', 'histogram', 'LLM 请求在调度器中的排队时间')
+metrics.describe('tg_llm_queue_expired_total', 'counter', '排队过久被放弃的 LLM 请求数')
+metrics.describe('tg_alerts_sent_total', 'counter', '发送的报警通知数')
+metrics.describe('tg_event_loop_lag_seconds', 'histogram', '事件循环调度延迟')
+metrics.describe('tg_event_loop_lag_last_seconds', 'gauge', '最近一次事件循环调度延迟')
+
+
+class IdentityCache:
+    """账号身份与发送者名称缓存"""
+
+    def __init__(self, tg_client, max_size: int = SENDER_CACHE_SIZE, ttl_seconds: int = SENDER_CACHE_TTL):
+        self.tg_client = tg_client
+        self.me = None
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # sender_id -> (显示名称, 过期时间)
+        self.sender_names = OrderedDict()
+        self.stats = {
+            'me_hits': 0,
+            'me_misses': 0,
+            'name_hits': 0,
+            'name_misses': 0,
+            'name_rpcs': 0,
+        }
+
+    async def get_me(self, refresh: bool = False):
+        """获取当前账号，仅在首次或要求刷新时请求服务器"""
+        if self.me is None or refresh:
+            self.stats['me_misses'] += 1
+            self.me = await self.tg_client.get_me()
+        else:
+            self.stats['me_hits'] += 1
+        return self.me
+
+    @staticmethod
+    def format_name(sender) -> str:
+        """根据实体生成显示名称"""
+        if not sender:
+            return "某人"
+        name = getattr(sender, 'first_name', None) or getattr(sender, 'title', None) or "某人"
+        last_name = getattr(sender, 'last_name', None)
+        if last_name:
+            name += f" {last_name}"
+        return name
+
+    def remember(self, sender_id: int, sender) -> str:
+        """缓存发送者名称，超出容量时淘汰最久未使用的条目"""
+        name = self.format_name(sender)
+        self.sender_names[sender_id] = (name, time.monotonic() + self.ttl_seconds)
+        self.sender_names.move_to_end(sender_id)
+        while len(self.sender_names) > self.max_size:
+            self.sender_names.popitem(last=False)
+        return name
+
+    async def get_sender_name(self, event) -> str:
+        """获取消息发送者名称，优先使用缓存和更新自带的实体"""
+        sender_id = event.sender_id
+        if sender_id is None:
+            return "某人"
+
+        cached = self.sender_names.get(sender_id)
+        if cached and cached[1] > time.monotonic():
+            self.sender_names.move_to_end(sender_id)
+            self.stats['name_hits'] += 1
+            return cached[0]
+
+        self.stats['name_misses'] += 1
+        # 更新中通常已携带发送者实体，无需额外请求
+        sender = event.sender
+        if sender is None:
+            self.stats['name_rpcs'] += 1
+            try:
+                sender = await event.get_sender()
+            except Exception:
+                sender = None
+            if sender is None:
+                return "某人"
+        return self.remember(sender_id, sender)
+
+    def summary(self) -> str:
+        """缓存命中统计"""
+        return (f"账号 命中{self.stats['me_hits']}/未命中{self.stats['me_misses']}，"
+                f"名称 命中{self.stats['name_hits']}/未命中{self.stats['name_misses']}"
+                f"(RPC {self.stats['name_rpcs']})，缓存 {len(self.sender_names)} 条")
+
+
+identity_cache = IdentityCache(client)
+
+
+class EntityResolver:
+    """实体解析器 - 并发解析、FloodWait 重试、本地持久化"""
+
+    def __init__(self, tg_client, cache_file: str, concurrency: int = ENTITY_RESOLVE_CONCURRENCY):
+        self.tg_client = tg_client
+        self.cache_file = cache_file
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.pending = {}
+        self.cache = self._load()
+
+    def _load(self) -> dict:
+        """加载本地实体缓存"""
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"⚠️ 实体缓存读取失败，将重新解析: {e}")
+            return {}
+
+    def save(self):
+        """保存实体缓存"""
+        try:
+            atomic_write(self.cache_file, json.dumps(self.cache, ensure_ascii=False, indent=4))
+        except Exception as e:
+            print(f"❌ 实体缓存保存失败: {e}")
+
+    @staticmethod
+    def _to_record(peer) -> dict:
+        """InputPeer 转为可序列化记录"""
+        if isinstance(peer, InputPeerChannel):
+            return {'type': 'channel', 'id': peer.channel_id, 'access_hash': peer.access_hash}
+        if isinstance(peer, InputPeerUser):
+            return {'type': 'user', 'id': peer.user_id, 'access_hash': peer.access_hash}
+        if isinstance(peer, InputPeerChat):
+            return {'type': 'chat', 'id': peer.chat_id, 'access_hash': 0}
+        return None
+
+    @staticmethod
+    def _from_record(record: dict):
+        """记录还原为 InputPeer"""
+        peer_type = record.get('type')
+        if peer_type == 'channel':
+            return InputPeerChannel(record['id'], record['access_hash'])
+        if peer_type == 'user':
+            return InputPeerUser(record['id'], record['access_hash'])
+        if peer_type == 'chat':
+            return InputPeerChat(record['id'])
+        return None
+
+    @staticmethod
+    def normalize(key):
+        """配置中的数字ID转为 int，用户名保持字符串"""
+        try:
+            return int(key)
+        except (TypeError, ValueError):
+            return str(key)
+
+    def cached(self, key):
+        """从本地缓存获取 InputPeer"""
+        record = self.cache.get(str(key))
+        return self._from_record(record) if record else None
+
+    async def resolve(self, key):
+        """解析实体，同一 key 的并发请求只发起一次"""
+        cache_key = str(key)
+        task = self.pending.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(self._resolve(key))
+            self.pending[cache_key] = task
+            task.add_done_callback(lambda _: self.pending.pop(cache_key, None))
+        return await task
+
+    async def _resolve(self, key, max_retries: int = 3):
+        async with self.semaphore:
+            for attempt in range(max_retries):
+                try:
+                    peer = await self.tg_client.get_input_entity(self.normalize(key))
+                    break
+                except FloodWaitError as e:
+                    if attempt == max_retries - 1:
+                        raise
+                    print(f"⏳ 解析 {key} 触发 FloodWait，等待 {e.seconds} 秒")
+                    metrics.inc('tg_flood_wait_seconds_total', e.seconds)
+                    await asyncio.sleep(e.seconds + 1)
+
+        record = self._to_record(peer)
+        if record:
+            self.cache[str(key)] = record
+        return peer
+
+
+entity_resolver = EntityResolver(client, ENTITY_CACHE_FILE)
+
+
+class AccountShard:
+    """一个监听账号：独立的客户端、实体缓存和健康状态"""
+
+    def __init__(self, name: str, tg_client, resolver: EntityResolver, primary: bool = False):
+        self.name = name
+        self.tg_client = tg_client
+        self.resolver = resolver
+        self.primary = primary
+        self.connected = True
+        # 冻结/封禁等账号级错误，重启前不再分配
+        self.frozen_reason = None
+        # 该账号能访问的源，None 表示不限制（主账号）
+        self.accessible = None if primary else set()
+
+    @property
+    def healthy(self) -> bool:
+        return self.connected and self.frozen_reason is None
+
+    def can_access(self, source_id: int) -> bool:
+        return self.accessible is None or source_id in self.accessible
+
+
+class ShardManager:
+    """多账号分片 - 按源做最高随机权重哈希分配监听账号，账号断线或冻结时自动重新分配"""
+
+    # 视为账号不可用的错误
+    ACCOUNT_ERRORS = ('AuthKeyUnregisteredError', 'AuthKeyDuplicatedError', 'SessionRevokedError',
+                      'UserDeactivatedError', 'UserDeactivatedBanError')
+
+    def __init__(self, tg_client, resolver: EntityResolver):
+        self.shards = OrderedDict()
+        self.shards['main'] = AccountShard('main', tg_client, resolver, primary=True)
+        # source_id -> 负责的账号名
+        self.assignments = {}
+        self.rebalance_callbacks = []
+        self.stats = {'rebalances': 0, 'moved': 0, 'rerouted': 0}
+
+    @property
+    def sharded(self) -> bool:
+        return len(self.shards) > 1
+
+    @property
+    def primary(self) -> AccountShard:
+        return self.shards['main']
+
+    async def start_accounts(self, accounts: list, handler):
+        """登录配置中的其他账号并注册消息处理器"""
+        for account in accounts:
+            if not account.get('enabled', True):
+                continue
+            name = str(account.get('name') or account.get('session'))
+            if not name or name in self.shards:
+                print(f"⚠️ 账号配置缺少名称或重复: {account}")
+                continue
+            session = account.get('session', name)
+            tg_client = TelegramClient(os.path.join(DATA_DIR, session),
+                                       account.get('api_id', api_id), account.get('api_hash', api_hash),
+                                       proxy=build_proxy(account.get('proxy') or proxy_config))
+            try:
+                print(f"🔐 登录分片账号 {name}...")
+                await tg_client.start(password=lambda: input(f'请输入 {name} 的两步验证密码 (如果没有请直接回车): '))
+            except Exception as e:
+                print(f"❌ 分片账号 {name} 启动失败: {e}")
+                continue
+            tg_client.add_event_handler(handler, NewMessage())
+            resolver = EntityResolver(tg_client, os.path.join(DATA_DIR, f'entity_cache_{name}.json'))
+            self.shards[name] = AccountShard(name, tg_client, resolver)
+            print(f"✅ 分片账号 {name} 已启动")
+
+    async def refresh_access(self, source_keys: dict):
+        """按各分片账号的对话列表确认其已加入的源（source_id -> 配置中的源），主账号不受限制"""
+        for shard in self.shards.values():
+            if shard.primary:
+                continue
+            # 能解析到公开群组不代表已加入，只有对话列表里的源才能收到消息
+            try:
+                joined = {dialog.id async for dialog in shard.tg_client.iter_dialogs()}
+            except Exception as e:
+                print(f"⚠️ 分片账号 {shard.name} 读取对话列表失败，保留原有访问范围: {e}")
+                continue
+            shard.accessible = {source_id for source_id in source_keys if source_id in joined}
+        self.rebalance(list(source_keys), reason='启动')
+
+    @staticmethod
+    def _weight(name: str, source_id: int) -> int:
+        return int.from_bytes(hashlib.sha1(f"{name}|{source_id}".encode('utf-8')).digest()[:8], 'big')
+
+    def _pick(self, source_id: int) -> str:
+        """按权重从高到低选第一个健康且能访问该源的账号，都不可用时退回主账号"""
+        ranked = sorted(self.shards.values(), key=lambda shard: self._weight(shard.name, source_id), reverse=True)
+        for shard in ranked:
+            if shard.healthy and shard.can_access(source_id):
+                return shard.name
+        return 'main'
+
+    def owner(self, source_id: int) -> AccountShard:
+        name = self.assignments.get(source_id)
+        if name is None:
+            name = self.assignments[source_id] = self._pick(source_id)
+        return self.shards[name]
+
+    def rebalance(self, source_ids=None, reason: str = ''):
+        """重新计算分配，返回发生迁移的源"""
+        if source_ids is None:
+            source_ids = list(self.assignments)
+        moved = []
+        for source_id in source_ids:
+            new_owner = self._pick(source_id)
+            old_owner = self.assignments.get(source_id)
+            self.assignments[source_id] = new_owner
+            if old_owner is not None and old_owner != new_owner:
+                moved.append(source_id)
+        self.stats['rebalances'] += 1
+        self.stats['moved'] += len(moved)
+        if self.sharded:
+            print(f"🧭 分片重新分配（{reason}）: {self.distribution()}，迁移 {len(moved)} 个源")
+        for callback in self.rebalance_callbacks:
+            callback(moved)
+        return moved
+
+    def distribution(self) -> str:
+        counts = {name: 0 for name in self.shards}
+        for name in self.assignments.values():
+            counts[name] = counts.get(name, 0) + 1
+        return '，'.join(f"{name} {count}" for name, count in counts.items())
+
+    def accepts(self, event) -> bool:
+        """事件是否来自负责该源的账号（多个账号都在源里时只处理一次）"""
+        if not self.sharded:
+            return True
+        return self.owner(event.chat_id).tg_client is event.client
+
+    def is_primary_event(self, event) -> bool:
+        return not self.sharded or event.client is self.primary.tg_client
+
+    def client_for(self, source_id: int):
+        """负责该源的客户端，主账号返回 None 由调用方使用默认客户端"""
+        if not self.sharded:
+            return None
+        shard = self.owner(source_id)
+        return None if shard.primary else shard.tg_client
+
+    def _sender(self, source_id: int, target_key):
+        """实际发送的分片，由主账号发送时返回 None"""
+        if not self.sharded:
+            return None
+        shard = self.owner(source_id)
+        # 没有配置写法的目标无法由其他账号解析（裸 ID 缺少该账号的 access_hash），交给主账号发送
+        if shard.primary or target_key is None:
+            return None
+        return shard
+
+    def sender_client(self, source_id: int, target_key):
+        """实际发送该任务的客户端，主账号返回 None"""
+        shard = self._sender(source_id, target_key)
+        return shard.tg_client if shard else None
+
+    async def route(self, job, target_key):
+        """转发调度器的路由：非主账号按配置中的目标写法用自己的实体缓存解析目标"""
+        shard = self._sender(job.source_id, target_key)
+        if shard is None:
+            return None
+        return shard.tg_client, await shard.resolver.resolve(target_key)
+
+    def report_error(self, job, error: Exception) -> bool:
+        """转发失败时检查是否为账号级错误，是则冻结该账号并重新分配，返回是否应重试"""
+        if not self.sharded:
+            return False
+        name = type(error).__name__
+        if name not in self.ACCOUNT_ERRORS and 'FROZEN' not in str(error).upper():
+            return False
+        shard = self.owner(job.source_id)
+        if shard.frozen_reason is not None:
+            return True
+        shard.frozen_reason = name
+        print(f"🧊 分片账号 {shard.name} 不可用（{error}），重新分配其负责的源")
+        self.stats['rerouted'] += 1
+        self.rebalance(reason=f"{shard.name} 冻结")
+        return True
+
+    async def monitor(self, interval: float = 10):
+        """定时检查各账号连接状态，变化时重新分配"""
+        while True:
+            await asyncio.sleep(interval)
+            changed = []
+            for shard in self.shards.values():
+                connected = shard.tg_client.is_connected()
+                if connected != shard.connected:
+                    shard.connected = connected
+                    changed.append(f"{shard.name} {'恢复' if connected else '断线'}")
+            if changed:
+                self.rebalance(reason='，'.join(changed))
+
+    def summary(self) -> str:
+        """分片状态"""
+        states = []
+        for shard in self.shards.values():
+            state = '✅' if shard.healthy else ('🧊' if shard.frozen_reason else '🔌')
+            states.append(f"{state}{shard.name}")
+        return (f"{' '.join(states)}，分配 {self.distribution()}，"
+                f"重分配 {self.stats['rebalances']} 次/迁移 {self.stats['moved']} 个源")
+
+
+shard_manager = ShardManager(client, entity_resolver)
+
+
+class TokenBucket:
+    """令牌桶限速器"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def configure(self, rate: float, burst: float):
+        """更新速率和容量"""
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = min(self.tokens, burst)
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+
+    def delay(self, now: float = None) -> float:
+        """距离下一个可用令牌还需等待的秒数"""
+        now = now or time.monotonic()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        if self.rate <= 0:
+            return 1.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        """消耗一个令牌"""
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        """FloodWait 期间暂停发放令牌"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class ForwardJob:
+    """一次 forward_messages 调用"""
+
+    __slots__ = ('source_id', 'target', 'target_id', 'flow_key', 'message_ids', 'tag', 'checkpoint', 'enqueued_at',
+                 'attempts', 'error', 'future')
+
+    def __init__(self, source_id: int, target, message_ids: list, tag: float, checkpoint: bool = True):
+        self.source_id = source_id
+        self.target = target
+        self.target_id = utils.get_peer_id(target)
+        self.flow_key = (source_id, self.target_id)
+        self.message_ids = message_ids
+        self.tag = tag
+        # 是否计入转发检查点（历史回填不计入）
+        self.checkpoint = checkpoint
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        # 最终失败的原因（队列满丢弃时为 None）
+        self.error = None
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class ForwardScheduler:
+    """转发调度器 - 目标令牌桶 + 全局限速 + 加权公平队列 + FloodWait 自动重试"""
+
+    def __init__(self, tg_client, cfg: dict):
+        self.tg_client = tg_client
+        self.config = cfg
+        # 每个 (源, 目标) 一条队列，按源的虚拟完成时间做加权公平调度
+        self.flows = {}
+        # 正在发送的队列，同一队列同时只发一个任务以保持顺序，不同目标互不影响
+        self.busy_flows = set()
+        self.last_tags = defaultdict(float)
+        self.virtual_time = 0.0
+        self.target_buckets = {}
+        self.global_bucket = TokenBucket(1, 1)
+        # target_id -> 发送统计；target_id -> 配置中的目标名称
+        self.target_stats = defaultdict(lambda: {'sent': 0, 'failed': 0, 'latency_total': 0.0, 'latency_max': 0.0})
+        self.target_labels = {}
+        # 多账号分片时的路由与账号错误回调，见 ShardManager
+        self.router = None
+        self.account_error_handler = None
+        # (源, 目标名称) -> 实际发送的客户端（主账号为 None）；FloodWait 按账号暂停：客户端 -> 解除时间
+        self.sender_for = None
+        self.account_blocked = {}
+        # 发送成功/最终失败后的回调，参数为 ForwardJob
+        self.delivered_callbacks = []
+        self.failed_callbacks = []
+        self.wakeup = asyncio.Event()
+        # 排队中的消息数；达到上限时转发阶段等待，超过两倍上限时直接丢弃
+        self.queued_messages = 0
+        self.has_space = asyncio.Event()
+        self.has_space.set()
+        self.workers = []
+        self.stats = {
+            'submitted': 0,
+            'sent': 0,
+            'failed': 0,
+            'dropped': 0,
+            'splits': 0,
+            'flood_waits': 0,
+            'flood_wait_seconds': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+        }
+        self.update_config(cfg)
+
+    def update_config(self, cfg: dict):
+        """更新限速配置"""
+        self.config = cfg
+        fwd_config = cfg.get('forwarding', {})
+        self.target_rate = fwd_config.get('target_rate_per_second', 1.0)
+        self.target_burst = fwd_config.get('target_burst', 5)
+        self.max_flood_retries = fwd_config.get('max_flood_retries', 5)
+        # 0 表示不限制
+        self.max_queued = fwd_config.get('max_queued_messages', 20000)
+        self._update_space()
+        self.global_bucket.configure(fwd_config.get('global_rate_per_second', 5.0),
+                                     fwd_config.get('global_burst', 10))
+        for bucket in self.target_buckets.values():
+            bucket.configure(self.target_rate, self.target_burst)
+
+    def start(self):
+        """启动发送协程"""
+        worker_count = self.config.get('forwarding', {}).get('workers', 4)
+        while len(self.workers) < worker_count:
+            self.workers.append(asyncio.create_task(self._worker()))
+
+    def queue_depth(self) -> int:
+        """当前排队的任务数"""
+        return sum(len(flow) for flow in self.flows.values())
+
+    def _update_space(self):
+        if not self.max_queued or self.queued_messages < self.max_queued:
+            self.has_space.set()
+        else:
+            self.has_space.clear()
+
+    async def wait_for_space(self):
+        """排队消息达到上限时等待，由转发阶段在交给合并器前调用（背压）"""
+        while not self.has_space.is_set():
+            await self.has_space.wait()
+
+    def submit(self, source_id: int, target, message_ids, weight: float = 1.0,
+               checkpoint: bool = True) -> asyncio.Future:
+        """提交转发任务，返回发送结果的 Future（True 为成功）；checkpoint=False 的任务不推进转发检查点"""
+        if not isinstance(message_ids, list):
+            message_ids = [message_ids]
+        tag = max(self.virtual_time, self.last_tags[source_id]) + 1.0 / max(weight, 0.01)
+        self.last_tags[source_id] = tag
+        job = ForwardJob(source_id, target, message_ids, tag, checkpoint)
+        self.stats['submitted'] += 1
+        if self.max_queued and self.queued_messages >= 2 * self.max_queued:
+            self._drop(job)
+            return job.future
+        self.flows.setdefault(job.flow_key, deque()).append(job)
+        self.queued_messages += len(message_ids)
+        self._update_space()
+        self.wakeup.set()
+        return job.future
+
+    def _bucket(self, target_id: int) -> TokenBucket:
+        bucket = self.target_buckets.get(target_id)
+        if bucket is None:
+            bucket = TokenBucket(self.target_rate, self.target_burst)
+            self.target_buckets[target_id] = bucket
+        return bucket
+
+    def _next_job(self):
+        """选出虚拟完成时间最小且目标可发送的任务，返回 (任务, 需等待秒数)"""
+        if not self.flows:
+            return None, None
+
+        now = time.monotonic()
+        global_delay = self.global_bucket.delay(now)
+        if global_delay > 0:
+            return None, global_delay
+
+        best = None
+        min_delay = None
+        for flow_key, flow in self.flows.items():
+            if flow_key in self.busy_flows:
+                continue
+            job = flow[0]
+            delay = self._bucket(job.target_id).delay(now)
+            if self.account_blocked:
+                delay = max(delay, self.account_blocked.get(self._account(job), 0.0) - now)
+            if delay > 0:
+                min_delay = delay if min_delay is None else min(min_delay, delay)
+            elif best is None or job.tag < best.tag:
+                best = job
+
+        if best is None:
+            return None, min_delay
+
+        flow = self.flows[best.flow_key]
+        flow.popleft()
+        if not flow:
+            del self.flows[best.flow_key]
+        self.queued_messages -= len(best.message_ids)
+        self._update_space()
+        self.virtual_time = max(self.virtual_time, best.tag)
+        self.busy_flows.add(best.flow_key)
+        self.global_bucket.consume()
+        self._bucket(best.target_id).consume()
+        return best, 0
+
+    def _account(self, job: ForwardJob):
+        """发送该任务的账号客户端"""
+        if self.sender_for:
+            return self.sender_for(job.source_id, self.target_labels.get(job.target_id)) or self.tg_client
+        return self.tg_client
+
+    def _block_account(self, account, seconds: float):
+        """FloodWait 是账号级的限流，暂停该账号的全部发送"""
+        now = time.monotonic()
+        for key in [k for k, until in self.account_blocked.items() if until <= now]:
+            del self.account_blocked[key]
+        self.account_blocked[account] = max(self.account_blocked.get(account, 0.0), now + seconds)
+
+    def _requeue(self, job: ForwardJob):
+        """FloodWait 后放回队首，保持队列内顺序"""
+        self.flows.setdefault(job.flow_key, deque()).appendleft(job)
+        self.queued_messages += len(job.message_ids)
+        self._update_space()
+        self.wakeup.set()
+
+    async def _worker(self):
+        while True:
+            job, delay = self._next_job()
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._send(job)
+            finally:
+                self.busy_flows.discard(job.flow_key)
+                self.wakeup.set()
+
+    async def _send(self, job: ForwardJob):
+        if job.attempts == 0:
+            waited = time.monotonic() - job.enqueued_at
+            self.stats['wait_total'] += waited
+            self.stats['wait_max'] = max(self.stats['wait_max'], waited)
+        job.attempts += 1
+
+        # 路由解析目标时也可能触发 FloodWait，先按预期的发送账号记录
+        tg_client = self._account(job)
+        try:
+            routed = None
+            if self.router:
+                routed = await self.router(job, self.target_labels.get(job.target_id))
+            tg_client, target = routed or (self.tg_client, job.target)
+            await tg_client.forward_messages(target, job.message_ids, from_peer=job.source_id)
+            self.stats['sent'] += 1
+            target_stats = self.target_stats[job.target_id]
+            latency = time.monotonic() - job.enqueued_at
+            target_stats['sent'] += 1
+            target_stats['latency_total'] += latency
+            target_stats['latency_max'] = max(target_stats['latency_max'], latency)
+            metrics.inc('tg_forwards_sent_total', len(job.message_ids), target=job.target_id)
+            metrics.observe('tg_forward_latency_seconds', latency, target=job.target_id)
+            for callback in self.delivered_callbacks:
+                callback(job)
+            if not job.future.done():
+                job.future.set_result(True)
+        except FloodWaitError as e:
+            self.stats['flood_waits'] += 1
+            self.stats['flood_wait_seconds'] += e.seconds
+            metrics.inc('tg_flood_wait_seconds_total', e.seconds)
+            self._bucket(job.target_id).block(e.seconds)
+            self._block_account(tg_client, e.seconds)
+            if job.attempts <= self.max_flood_retries:
+                print(f"⏳ 转发触发 FloodWait，{e.seconds} 秒后重试 -> {job.target_id}")
+                self._requeue(job)
+            else:
+                self._fail(job, e)
+        except Exception as e:
+            if (self.account_error_handler and self.account_error_handler(job, e)
+                    and job.attempts <= self.max_flood_retries):
+                self._requeue(job)
+            elif len(job.message_ids) > 1:
+                self._split(job, e)
+            else:
+                self._fail(job, e)
+
+    def _split(self, job: ForwardJob, error: Exception):
+        """合并的任务失败时拆成两半放回队首分别重试，逐步缩小到出错的那条，其余消息照常送达"""
+        self.stats['splits'] += 1
+        print(f"⚠️ 批量转发 {len(job.message_ids)} 条失败，拆分重试 -> "
+              f"{self.target_labels.get(job.target_id, job.target_id)}: {error}")
+        half = len(job.message_ids) // 2
+        parts = [ForwardJob(job.source_id, job.target, ids, job.tag, job.checkpoint)
+                 for ids in (job.message_ids[:half], job.message_ids[half:])]
+        for part in parts:
+            # 沿用原任务的入队时间，等待时间不重复统计
+            part.enqueued_at = job.enqueued_at
+            part.attempts = 1
+        asyncio.gather(*(part.future for part in parts)).add_done_callback(
+            lambda done: job.future.done() or job.future.set_result(all(done.result())))
+        flow = self.flows.setdefault(job.flow_key, deque())
+        for part in reversed(parts):
+            flow.appendleft(part)
+        self.queued_messages += len(job.message_ids)
+        self._update_space()
+        self.wakeup.set()
+
+    def _fail(self, job: ForwardJob, error: Exception):
+        self.stats['failed'] += 1
+        self.target_stats[job.target_id]['failed'] += 1
+        metrics.inc('tg_forwards_failed_total', len(job.message_ids), target=job.target_id)
+        print(f"❌ 转发失败 -> {self.target_labels.get(job.target_id, job.target_id)}: {error}")
+        job.error = error
+        for callback in self.failed_callbacks:
+            callback(job)
+        if not job.future.done():
+            job.future.set_result(False)
+
+    def _drop(self, job: ForwardJob):
+        """队列超过硬上限时丢弃任务（正常情况下转发阶段的背压不会让队列涨到这里）"""
+        self.stats['dropped'] += 1
+        metrics.inc('tg_forwards_dropped_total', len(job.message_ids), target=job.target_id)
+        if self.stats['dropped'] % 100 == 1:
+            print(f"⚠️ 转发队列已满（{self.queued_messages} 条），丢弃任务 -> "
+                  f"{self.target_labels.get(job.target_id, job.target_id)}，累计丢弃 {self.stats['dropped']} 个")
+        for callback in self.failed_callbacks:
+            callback(job)
+        if not job.future.done():
+            job.future.set_result(False)
+
+    def summary(self) -> str:
+        """调度统计"""
+        sent_or_failed = self.stats['sent'] + self.stats['failed']
+        avg_wait = self.stats['wait_total'] / sent_or_failed if sent_or_failed else 0
+        return (f"排队 {self.queue_depth()}（{self.queued_messages} 条），成功 {self.stats['sent']}，"
+                f"失败 {self.stats['failed']}，丢弃 {self.stats['dropped']}，拆分 {self.stats['splits']}，"
+                f"FloodWait {self.stats['flood_waits']}次/{self.stats['flood_wait_seconds']}秒，"
+                f"平均等待 {avg_wait:.2f}秒，最长 {self.stats['wait_max']:.2f}秒")
+
+    def target_summary(self, limit: int = 10) -> str:
+        """各目标的延迟与失败统计"""
+        lines = []
+        for target_id, target_stats in list(self.target_stats.items())[:limit]:
+            label = self.target_labels.get(target_id, target_id)
+            avg = target_stats['latency_total'] / target_stats['sent'] if target_stats['sent'] else 0
+            lines.append(f"• `{label}`: 成功 {target_stats['sent']}，失败 {target_stats['failed']}，"
+                         f"平均延迟 {avg:.2f}秒，最长 {target_stats['latency_max']:.2f}秒")
+        return "\n".join(lines) if lines else "• 暂无数据"
+
+
+forward_scheduler = ForwardScheduler(client, config_store.snapshot)
+forward_scheduler.router = shard_manager.route
+forward_scheduler.account_error_handler = shard_manager.report_error
+forward_scheduler.sender_for = shard_manager.sender_client
+config_store.listeners.append(forward_scheduler.update_config)
+
+
+class ForwardCoalescer:
+    """转发合并器 - 短窗口内同一源/目标的单条消息合并为一次 forward_messages"""
+
+    # Telegram 单次 forward_messages 最多 100 条
+    MAX_IDS_PER_CALL = 100
+
+    def __init__(self, scheduler: ForwardScheduler, cfg: dict):
+        self.scheduler = scheduler
+        # (source_id, target_id) -> {'target': 目标, 'ids': [消息ID], 'handle': 定时器}
+        self.buffers = {}
+        self.stats = {'messages': 0, 'batches': 0}
+        self.update_config(cfg)
+
+    def update_config(self, cfg: dict):
+        """更新合并窗口配置"""
+        fwd_config = cfg.get('forwarding', {})
+        self.window = fwd_config.get('coalesce_window_ms', 500) / 1000
+        self.max_ids = max(1, min(self.MAX_IDS_PER_CALL, fwd_config.get('coalesce_max_ids', 100)))
+
+    def add(self, source_id: int, target, message_id: int):
+        """加入一条待转发消息，窗口结束或达到上限时统一提交"""
+        self.stats['messages'] += 1
+        if self.window <= 0:
+            self.stats['batches'] += 1
+            self.scheduler.submit(source_id, target, [message_id])
+            return
+
+        key = (source_id, utils.get_peer_id(target))
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = {
+                'target': target,
+                'ids': [],
+                'handle': asyncio.get_running_loop().call_later(self.window, self.flush_key, key),
+            }
+            self.buffers[key] = buffer
+        buffer['ids'].append(message_id)
+
+        if len(buffer['ids']) >= self.max_ids:
+            self.flush_key(key)
+
+    def flush_key(self, key: tuple):
+        """提交指定源/目标的缓冲消息"""
+        buffer = self.buffers.pop(key, None)
+        if not buffer:
+            return
+        buffer['handle'].cancel()
+        self.stats['batches'] += 1
+        self.scheduler.submit(key[0], buffer['target'], buffer['ids'])
+
+    def flush_source(self, source_id: int):
+        """提交某个源的全部缓冲消息（用于保证与媒体组的先后顺序）"""
+        for key in [k for k in self.buffers if k[0] == source_id]:
+            self.flush_key(key)
+
+    def summary(self) -> str:
+        """合并统计"""
+        return f"{self.stats['messages']} 条消息合并为 {self.stats['batches']} 次调用"
+
+
+forward_coalescer = ForwardCoalescer(forward_scheduler, config_store.snapshot)
+config_store.listeners.append(forward_coalescer.update_config)
+
+
+class BloomFilter:
+    """布隆过滤器"""
+
+    def __init__(self, bits: int, hashes: int = 7, data: bytes = None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data and len(data) == (bits + 7) // 8 else bytearray((bits + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.data[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.data[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class DuplicateFilter:
+    """重复内容过滤 - 按规范化文本和媒体ID去重，内存 LRU + 可选落盘布隆过滤器"""
+
+    def __init__(self, cfg: dict, bloom_file: str):
+        self.bloom_file = bloom_file
+        # (target_id, 指纹) -> 过期时间
+        self.recent = OrderedDict()
+        # 关闭去重的 (source_id, target_id)
+        self.opt_out = set()
+        self.bloom_current = None
+        self.bloom_previous = None
+        self.bloom_rotated_at = time.time()
+        self.bloom_dirty = False
+        self.stats = {'checked': 0, 'suppressed': 0, 'bloom_hits': 0}
+        self.update_config(cfg)
+
+    def update_config(self, cfg: dict):
+        """更新去重配置"""
+        fwd_config = cfg.get('forwarding', {})
+        self.enabled = fwd_config.get('dedupe_enabled', True)
+        self.ttl = fwd_config.get('dedupe_ttl_seconds', 900)
+        self.max_entries = fwd_config.get('dedupe_max_entries', 50000)
+        self.bloom_bits = fwd_config.get('dedupe_bloom_bits', 8388608)
+        if fwd_config.get('dedupe_bloom', False):
+            if self.bloom_current is None:
+                self._load_bloom()
+        else:
+            self.bloom_current = self.bloom_previous = None
+
+    def _load_bloom(self):
+        """加载落盘的布隆过滤器（当前代和上一代）"""
+        size = (self.bloom_bits + 7) // 8
+        current = previous = None
+        try:
+            if os.path.exists(self.bloom_file):
+                with open(self.bloom_file, 'rb') as f:
+                    self.bloom_rotated_at = int.from_bytes(f.read(8), 'little')
+                    current = f.read(size)
+                    previous = f.read(size)
+        except Exception as e:
+            print(f"⚠️ 去重过滤器读取失败，将重新创建: {e}")
+            self.bloom_rotated_at = time.time()
+        self.bloom_current = BloomFilter(self.bloom_bits, data=current)
+        self.bloom_previous = BloomFilter(self.bloom_bits, data=previous)
+        self._rotate_bloom()
+
+    def _rotate_bloom(self):
+        """每个 TTL 周期轮换一代，使布隆过滤器同样有时间边界"""
+        now = time.time()
+        if now - self.bloom_rotated_at < self.ttl:
+            return
+        if now - self.bloom_rotated_at >= 2 * self.ttl:
+            self.bloom_previous = BloomFilter(self.bloom_bits)
+        else:
+            self.bloom_previous = self.bloom_current
+        self.bloom_current = BloomFilter(self.bloom_bits)
+        self.bloom_rotated_at = now
+        self.bloom_dirty = True
+
+    def save_bloom(self):
+        """保存布隆过滤器"""
+        if self.bloom_current is None or not self.bloom_dirty:
+            return
+        self.bloom_dirty = False
+        try:
+            atomic_write(self.bloom_file, int(self.bloom_rotated_at).to_bytes(8, 'little')
+                         + bytes(self.bloom_current.data) + bytes(self.bloom_previous.data))
+        except Exception as e:
+            print(f"❌ 去重过滤器保存失败: {e}")
+
+    async def run_persistence(self, interval: float = 60):
+        """定期在线程中保存布隆过滤器"""
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.save_bloom)
+
+    def set_opt_out(self, source_id: int, target_id: int, opt_out: bool):
+        """设置某个映射是否跳过去重"""
+        if opt_out:
+            self.opt_out.add((source_id, target_id))
+        else:
+            self.opt_out.discard((source_id, target_id))
+
+    @staticmethod
+    def fingerprint(message) -> str:
+        """根据规范化文本和媒体ID生成指纹，无内容的消息返回 None"""
+        text = ' '.join((getattr(message, 'message', None) or '').lower().split())
+        photo = getattr(message, 'photo', None)
+        document = getattr(message, 'document', None)
+        photo_id = photo.id if photo else ''
+        document_id = document.id if document else ''
+        if not text and not photo_id and not document_id:
+            return None
+        raw = f"{text}|{photo_id}|{document_id}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def combine(fingerprints: list) -> str:
+        """合并媒体组各条消息的指纹"""
+        if not fingerprints or any(fp is None for fp in fingerprints):
+            return None
+        return hashlib.sha1('|'.join(sorted(fingerprints)).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def unit_fingerprint(cls, fingerprints: list) -> str:
+        """一个转发单元（单条消息或媒体组）的去重键，单条消息与实时转发一样使用原始指纹"""
+        if len(fingerprints) == 1:
+            return fingerprints[0]
+        return cls.combine(fingerprints)
+
+    def is_duplicate(self, source_id: int, target_id: int, fingerprint: str) -> bool:
+        """判断该内容是否已发送给该目标，未发送则记录下来"""
+        if not self.enabled or fingerprint is None or (source_id, target_id) in self.opt_out:
+            return False
+
+        self.stats['checked'] += 1
+        key = f"{target_id}:{fingerprint}"
+        now = time.monotonic()
+
+        expires = self.recent.get(key)
+        if expires is not None and expires > now:
+            self.recent.move_to_end(key)
+            self.stats['suppressed'] += 1
+            return True
+
+        if self.bloom_current is not None:
+            self._rotate_bloom()
+            if key in self.bloom_current or key in self.bloom_previous:
+                self.stats['suppressed'] += 1
+                self.stats['bloom_hits'] += 1
+                return True
+            self.bloom_current.add(key)
+            self.bloom_dirty = True
+
+        self.recent[key] = now + self.ttl
+        self.recent.move_to_end(key)
+        while len(self.recent) > self.max_entries:
+            self.recent.popitem(last=False)
+        return False
+
+    def summary(self) -> str:
+        """去重统计"""
+        bloom = "开启" if self.bloom_current is not None else "关闭"
+        return (f"检查 {self.stats['checked']}，拦截重复 {self.stats['suppressed']}"
+                f"（布隆命中 {self.stats['bloom_hits']}），缓存 {len(self.recent)} 条，布隆过滤器{bloom}")
+
+
+duplicate_filter = DuplicateFilter(config_store.snapshot, DEDUPE_BLOOM_FILE)
+config_store.listeners.append(duplicate_filter.update_config)
+
+
+class MediaGroupAggregator:
+    """媒体组聚合器 - 按 grouped_id 独立聚合，由单一时间轮统一定时提交"""
+
+    # Telegram 媒体组最多 10 条
+    ALBUM_LIMIT = 10
+
+    def __init__(self, scheduler: ForwardScheduler, dedupe: DuplicateFilter, cfg: dict,
+                 tick: float = 0.25, slots: int = 64):
+        self.scheduler = scheduler
+        self.dedupe = dedupe
+        self.tick = tick
+        # grouped_id -> {'source_id', 'targets', 'ids', 'fingerprints', 'deadline'}
+        self.groups = {}
+        self.wheel = [set() for _ in range(slots)]
+        self.current_tick = 0
+        self.task = None
+        self.stats = {'groups': 0, 'early_flushes': 0}
+        # 转发检查点，见 CheckpointStore
+        self.checkpoints = None
+        self.update_config(cfg)
+
+    def update_config(self, cfg: dict):
+        """更新媒体组等待时间"""
+        self.timeout = cfg.get('forwarding', {}).get('media_group_timeout', 1.5)
+
+    def start(self):
+        """启动时间轮"""
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    def _schedule(self, grouped_id, delay: float):
+        ticks = min(max(1, int(delay / self.tick + 0.999)), len(self.wheel) - 1)
+        self.wheel[(self.current_tick + ticks) % len(self.wheel)].add(grouped_id)
+
+    def add(self, grouped_id, source_id: int, targets: list, message_id: int, fingerprint: str = None):
+        """加入一条媒体组消息，静默超时或达到 10 条时提交"""
+        group = self.groups.get(grouped_id)
+        if group is None:
+            group = {'source_id': source_id, 'targets': targets, 'ids': [], 'fingerprints': [], 'deadline': 0.0}
+            self.groups[grouped_id] = group
+            self._schedule(grouped_id, self.timeout)
+        if self.checkpoints:
+            for target in targets:
+                self.checkpoints.track(source_id, utils.get_peer_id(target), [message_id])
+        group['ids'].append(message_id)
+        group['fingerprints'].append(fingerprint)
+        # 截止时间顺延即可，到期时由时间轮惰性重新排入
+        group['deadline'] = time.monotonic() + self.timeout
+
+        if len(group['ids']) >= self.ALBUM_LIMIT:
+            self.stats['early_flushes'] += 1
+            self.flush(grouped_id)
+
+    def flush(self, grouped_id):
+        """将媒体组交给转发调度器"""
+        group = self.groups.pop(grouped_id, None)
+        if not group:
+            return
+        self.stats['groups'] += 1
+        metrics.inc('tg_media_groups_total')
+        message_ids = sorted(group['ids'])
+        fingerprint = self.dedupe.unit_fingerprint(group['fingerprints'])
+        for target in group['targets']:
+            target_id = utils.get_peer_id(target)
+            if self.dedupe.is_duplicate(group['source_id'], target_id, fingerprint):
+                if self.checkpoints:
+                    self.checkpoints.resolve(group['source_id'], target_id, message_ids)
+                continue
+            self.scheduler.submit(group['source_id'], target, message_ids)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.current_tick += 1
+            index = self.current_tick % len(self.wheel)
+            due, self.wheel[index] = self.wheel[index], set()
+            now = time.monotonic()
+            for grouped_id in due:
+                group = self.groups.get(grouped_id)
+                if group is None:
+                    continue
+                if group['deadline'] <= now:
+                    self.flush(grouped_id)
+                else:
+                    self._schedule(grouped_id, group['deadline'] - now)
+
+    def summary(self) -> str:
+        """媒体组统计"""
+        return f"已提交 {self.stats['groups']} 组（满10条提前提交 {self.stats['early_flushes']} 组），聚合中 {len(self.groups)} 组"
+
+
+media_group_aggregator = MediaGroupAggregator(forward_scheduler, duplicate_filter, config_store.snapshot)
+config_store.listeners.append(media_group_aggregator.update_config)
+
+
+class CheckpointStore:
+    """转发检查点 - 按 (源, 目标) 记录已投递或跳过的连续最高消息ID，批量落盘
+
+    每条消息交给某个目标前先登记为待完成，投递成功或被去重跳过后才算完成；
+    检查点只推进到最小待完成ID之前，仍在合并窗口、媒体组或调度队列里的消息不会被越过。
+    """
+
+    # 旧版按源记录的检查点，作为该源各目标的初始位置
+    ANY_TARGET = '*'
+    # 文件中保存失败次数的键
+    FAILURES_KEY = '_failures'
+    # 同一条消息失败这么多次后跳过，不再卡住检查点
+    MAX_FAILURES = 3
+
+    def __init__(self, path: str):
+        self.path = path
+        # (source_id, target_id, message_id) -> 连续失败次数
+        self.failures = {}
+        # source_id -> {target_id 或 '*': 消息ID}
+        self.positions = self._load()
+        # (source_id, target_id) -> 待完成的消息ID集合，以及用于取最小值的堆（惰性删除）
+        self.pending = {}
+        self.pending_heaps = {}
+        # (source_id, target_id) -> 已完成的最大消息ID
+        self.completed = {}
+        # (source_id, target_id) -> 检查点上限（发送失败或补发截断处），下次补发时解除
+        self.caps = {}
+        self.dirty = False
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"⚠️ 检查点读取失败: {e}")
+            return {}
+        positions = {}
+        for name, count in data.pop(self.FAILURES_KEY, {}).items():
+            source, target, message_id = map(int, name.split(':'))
+            self.failures[(source, target, message_id)] = count
+        for source, value in data.items():
+            if isinstance(value, dict):
+                positions[int(source)] = {(k if k == self.ANY_TARGET else int(k)): v for k, v in value.items()}
+            else:
+                positions[int(source)] = {self.ANY_TARGET: value}
+        return positions
+
+    def get(self, source_id: int, target_id: int):
+        """获取 (源, 目标) 的检查点，没有记录时返回 None"""
+        entry = self.positions.get(source_id)
+        if not entry:
+            return None
+        return entry.get(target_id, entry.get(self.ANY_TARGET))
+
+    def has_source(self, source_id: int) -> bool:
+        """该源是否有任一目标的检查点"""
+        return bool(self.positions.get(source_id))
+
+    def track(self, source_id: int, target_id: int, message_ids: list):
+        """登记交给目标的消息，完成前检查点不会越过它们"""
+        key = (source_id, target_id)
+        pending = self.pending.setdefault(key, set())
+        heap = self.pending_heaps.setdefault(key, [])
+        for message_id in message_ids:
+            if message_id not in pending:
+                pending.add(message_id)
+                heapq.heappush(heap, message_id)
+
+    def resolve(self, source_id: int, target_id: int, message_ids: list):
+        """消息已投递或被跳过，推进检查点（未登记的消息如历史回填不影响检查点）"""
+        key = (source_id, target_id)
+        done = self._untrack(key, message_ids)
+        if done:
+            if self.failures:
+                for message_id in done:
+                    if self.failures.pop((source_id, target_id, message_id), None) is not None:
+                        self.dirty = True
+            self.completed[key] = max(self.completed.get(key, 0), max(done))
+            self._advance(key)
+
+    def fail(self, source_id: int, target_id: int, message_ids: list, error: Exception = None):
+        """消息发送失败，检查点停在它们之前，重启或重连补发时重试
+
+        请求本身有误（RPC 400）或累计失败 MAX_FAILURES 次的消息记为跳过，检查点越过它继续前进；
+        队列满丢弃（error 为 None）不计入失败次数。
+        """
+        key = (source_id, target_id)
+        done = self._untrack(key, message_ids)
+        if not done:
+            return
+        retry = []
+        skipped = []
+        for message_id in done:
+            failure_key = (source_id, target_id, message_id)
+            if error is None:
+                retry.append(message_id)
+                continue
+            count = self.failures.get(failure_key, 0) + 1
+            if getattr(error, 'code', None) == 400 or count >= self.MAX_FAILURES:
+                self.failures.pop(failure_key, None)
+                skipped.append(message_id)
+            else:
+                self.failures[failure_key] = count
+                retry.append(message_id)
+            self.dirty = True
+        if skipped:
+            print(f"⚠️ 消息 {skipped} 无法转发到 {target_id}，已跳过: {error}")
+            self.completed[key] = max(self.completed.get(key, 0), max(skipped))
+        if retry:
+            self.cap(source_id, target_id, min(retry) - 1)
+        elif skipped:
+            self._advance(key)
+
+    def cap(self, source_id: int, target_id: int, message_id: int):
+        """检查点不超过 message_id"""
+        key = (source_id, target_id)
+        self.caps[key] = min(self.caps.get(key, message_id), message_id)
+
+    def release(self, source_id: int):
+        """补发开始时解除该源的检查点上限"""
+        for key in [k for k in self.caps if k[0] == source_id]:
+            del self.caps[key]
+            self._advance(key)
+
+    def _untrack(self, key: tuple, message_ids: list) -> list:
+        pending = self.pending.get(key)
+        if not pending:
+            return []
+        done = [message_id for message_id in message_ids if message_id in pending]
+        pending.difference_update(done)
+        if not pending:
+            del self.pending[key]
+            del self.pending_heaps[key]
+        return done
+
+    def _advance(self, key: tuple):
+        """检查点推进到最小待完成ID之前（无待完成时为已完成的最大ID），只前进不后退"""
+        pending = self.pending.get(key)
+        if pending:
+            heap = self.pending_heaps[key]
+            while heap[0] not in pending:
+                heapq.heappop(heap)
+            candidate = heap[0] - 1
+        else:
+            candidate = self.completed.get(key)
+            if candidate is None:
+                return
+        if key in self.caps:
+            candidate = min(candidate, self.caps[key])
+        source_id, target_id = key
+        current = self.get(source_id, target_id)
+        if current is None or candidate > current:
+            self.positions.setdefault(source_id, {})[target_id] = candidate
+            self.dirty = True
+
+    def save(self):
+        """保存检查点"""
+        if not self.dirty:
+            return
+        self.dirty = False
+        data = {str(source): {str(target): v for target, v in entry.items()}
+                for source, entry in self.positions.items()}
+        if self.failures:
+            data[self.FAILURES_KEY] = {f"{source}:{target}:{message_id}": count
+                                       for (source, target, message_id), count in self.failures.items()}
+        try:
+            atomic_write(self.path, json.dumps(data, indent=4))
+        except Exception as e:
+            self.dirty = True
+            print(f"❌ 检查点保存失败: {e}")
+
+    async def run_persistence(self, interval: float):
+        """定期批量落盘"""
+        while True:
+            await asyncio.sleep(interval)
+            if self.dirty:
+                await asyncio.to_thread(self.save)
+
+
+checkpoint_store = CheckpointStore(CHECKPOINT_FILE)
+media_group_aggregator.checkpoints = checkpoint_store
+
+
+def checkpoint_delivered(job: ForwardJob):
+    """投递成功后推进检查点（跳过历史回填任务）"""
+    if job.checkpoint:
+        checkpoint_store.resolve(job.source_id, job.target_id, job.message_ids)
+
+
+def checkpoint_failed(job: ForwardJob):
+    """发送失败后让检查点停在失败的消息之前（跳过历史回填任务）"""
+    if job.checkpoint:
+        checkpoint_store.fail(job.source_id, job.target_id, job.message_ids, job.error)
+
+
+forward_scheduler.delivered_callbacks.append(checkpoint_delivered)
+forward_scheduler.failed_callbacks.append(checkpoint_failed)
+
+
+def pack_message_batches(messages: list, max_ids: int = ForwardCoalescer.MAX_IDS_PER_CALL) -> list:
+    """按顺序把消息打包成不超过 max_ids 的批次，媒体组不拆分"""
+    units = []
+    for message in messages:
+        if message.grouped_id and units and units[-1][0] == message.grouped_id:
+            units[-1][1].append(message)
+        else:
+            units.append((message.grouped_id, [message]))
+
+    batches = []
+    current = []
+    for _, unit in units:
+        if current and len(current) + len(unit) > max_ids:
+            batches.append(current)
+            current = []
+        current.extend(unit)
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def forward_message_batch(scheduler: ForwardScheduler, dedupe: DuplicateFilter, source_id: int,
+                                targets: list, batch: list, weight: float = 1.0,
+                                checkpoints: CheckpointStore = None):
+    """转发一个批次（每个目标一次调用，跳过重复内容），等待调度器完成；传入 checkpoints 时登记检查点"""
+    fingerprints = {}
+    for message in batch:
+        key = message.grouped_id or message.id
+        fingerprints.setdefault(key, []).append(dedupe.fingerprint(message))
+
+    futures = []
+    for target in targets:
+        target_id = utils.get_peer_id(target)
+        skipped = {key for key, fps in fingerprints.items()
+                   if dedupe.is_duplicate(source_id, target_id, dedupe.unit_fingerprint(fps))}
+        message_ids = [m.id for m in batch if (m.grouped_id or m.id) not in skipped]
+        if checkpoints:
+            checkpoints.track(source_id, target_id, [m.id for m in batch])
+            checkpoints.resolve(source_id, target_id, [m.id for m in batch if (m.grouped_id or m.id) in skipped])
+        if message_ids:
+            await scheduler.wait_for_space()
+            futures.append(scheduler.submit(source_id, target, message_ids, weight=weight,
+                                            checkpoint=checkpoints is not None))
+    if futures:
+        await asyncio.gather(*futures)
+
+
+class CatchUpManager:
+    """断线补发 - 重启或重连后按检查点拉取漏掉的消息批量转发，完成前暂存实时消息"""
+
+    def __init__(self, tg_client, scheduler: ForwardScheduler, checkpoints: CheckpointStore,
+                 dedupe: DuplicateFilter, cfg: dict, concurrency: int = 4):
+        self.tg_client = tg_client
+        self.scheduler = scheduler
+        self.checkpoints = checkpoints
+        self.dedupe = dedupe
+        self.config = cfg
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # source_id -> 补发期间暂存的实时消息
+        self.holds = {}
+        self.replay = None
+        # 多账号分片时按源选择客户端，返回 None 使用默认客户端
+        self.client_for = None
+        self.stats = {'runs': 0, 'messages': 0, 'batches': 0}
+
+    def update_config(self, cfg: dict):
+        """更新补发配置，下次补发时生效"""
+        self.config = cfg
+
+    def hold(self, event) -> bool:
+        """该源正在补发时暂存实时消息，返回是否已暂存"""
+        held = self.holds.get(event.chat_id)
+        if held is None:
+            return False
+        held.append(event)
+        return True
+
+    def start(self, sources: dict, replay):
+        """对有检查点的源开始补发，replay 用于补发完成后放行暂存的实时消息"""
+        fwd_config = self.config.get('forwarding', {})
+        if not fwd_config.get('catchup_enabled', True):
+            return None
+        self.replay = replay
+        pending = {}
+        for source_id, targets in sources.items():
+            if self.checkpoints.has_source(source_id) and source_id not in self.holds:
+                self.holds[source_id] = []
+                pending[source_id] = list(targets)
+        if not pending:
+            return None
+        self.stats['runs'] += 1
+        return asyncio.create_task(self._catch_up_all(pending))
+
+    async def _catch_up_all(self, pending: dict):
+        await asyncio.gather(*(self._catch_up_source(source_id, targets)
+                               for source_id, targets in pending.items()))
+
+    async def _catch_up_source(self, source_id: int, targets: list):
+        # 每个目标从自己的检查点继续，没有检查点的目标（新加的映射）不补发
+        positions = {utils.get_peer_id(target): self.checkpoints.get(source_id, utils.get_peer_id(target))
+                     for target in targets}
+        targets = [target for target in targets if positions[utils.get_peer_id(target)] is not None]
+        limit = self.config.get('forwarding', {}).get('catchup_max_messages', 2000)
+        caught_up_to = None
+        self.checkpoints.release(source_id)
+        try:
+            if targets:
+                last_id = min(positions[utils.get_peer_id(target)] for target in targets)
+                caught_up_to = last_id
+                async with self.semaphore:
+                    tg_client = (self.client_for(source_id) if self.client_for else None) or self.tg_client
+                    fetched = [m async for m in tg_client.iter_messages(source_id, min_id=last_id,
+                                                                        reverse=True, limit=limit + 1)]
+                    truncated = len(fetched) > limit
+                    if truncated:
+                        fetched = fetched[:limit]
+                        # 截断处的媒体组可能不完整，留到下次补发
+                        trailing = fetched[-1].grouped_id
+                        if trailing and any(m.grouped_id != trailing for m in fetched):
+                            while fetched[-1].grouped_id == trailing:
+                                fetched.pop()
+                    messages = [m for m in fetched if not getattr(m, 'action', None)]
+                    if messages:
+                        print(f"🔁 补发 {source_id}: {len(messages)} 条漏掉的消息")
+                    for batch in pack_message_batches(messages):
+                        await self._forward_batch(source_id, targets, positions, batch)
+                        caught_up_to = batch[-1].id
+                    if fetched:
+                        caught_up_to = fetched[-1].id
+                if truncated:
+                    # 超出上限的部分未补发，检查点停在最后补发的消息，下次补发从这里继续
+                    print(f"⚠️ 补发 {source_id} 超过上限 {limit} 条，消息 {caught_up_to} 之后的历史未补发")
+                    for target in targets:
+                        self.checkpoints.cap(source_id, utils.get_peer_id(target), caught_up_to)
+        except Exception as e:
+            print(f"❌ 补发失败 {source_id}: {e}")
+            if caught_up_to is not None:
+                for target in targets:
+                    self.checkpoints.cap(source_id, utils.get_peer_id(target), caught_up_to)
+        finally:
+            held = self.holds.pop(source_id, [])
+            for event in held:
+                if caught_up_to is None or event.message.id > caught_up_to:
+                    self.replay(event)
+
+    async def _forward_batch(self, source_id: int, targets: list, positions: dict, batch: list):
+        """转发一个批次，每个目标只补发其检查点之后的消息，检查点随投递推进"""
+        await asyncio.gather(*(
+            forward_message_batch(self.scheduler, self.dedupe, source_id, [target],
+                                  [m for m in batch if m.id > positions[utils.get_peer_id(target)]],
+                                  checkpoints=self.checkpoints)
+            for target in targets))
+        self.stats['messages'] += len(batch)
+        self.stats['batches'] += 1
+
+    async def monitor_connection(self, sources_getter, interval: float = 5):
+        """检测断线重连，重连后触发补发"""
+        was_connected = True
+        while True:
+            await asyncio.sleep(interval)
+            connected = self.tg_client.is_connected()
+            if connected and not was_connected:
+                print("🔌 已重新连接，开始补发漏掉的消息")
+                self.start(sources_getter(), self.replay)
+            was_connected = connected
+
+    def summary(self) -> str:
+        """补发统计"""
+        return (f"补发 {self.stats['runs']} 轮，{self.stats['messages']} 条/{self.stats['batches']} 批，"
+                f"进行中 {len(self.holds)} 个源，检查点 {sum(map(len, self.checkpoints.positions.values()))} 个")
+
+
+catch_up_manager = CatchUpManager(client, forward_scheduler, checkpoint_store, duplicate_filter,
+                                  config_store.snapshot)
+catch_up_manager.client_for = shard_manager.client_for
+config_store.listeners.append(catch_up_manager.update_config)
+
+
+class BackfillManager:
+    """历史回填 - 分页拉取源的历史消息批量转发，可暂停、可断点续传"""
+
+    # 回填任务在调度器中的权重，低于实时转发
+    WEIGHT = 0.25
+    PAGE_SIZE = 100
+
+    def __init__(self, tg_client, scheduler: ForwardScheduler, dedupe: DuplicateFilter,
+                 resolver: EntityResolver, state_file: str, targets_getter):
+        self.tg_client = tg_client
+        self.scheduler = scheduler
+        self.dedupe = dedupe
+        self.resolver = resolver
+        self.state_file = state_file
+        self.targets_getter = targets_getter
+        # str(source_id) -> 任务状态
+        self.jobs = self._load()
+        self.tasks = {}
+        self.resume_events = {}
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"⚠️ 回填进度读取失败: {e}")
+            return {}
+
+    def save(self):
+        """保存回填进度"""
+        try:
+            atomic_write(self.state_file, json.dumps(self.jobs, ensure_ascii=False, indent=4))
+        except Exception as e:
+            print(f"❌ 回填进度保存失败: {e}")
+
+    async def source_key(self, source: str) -> str:
+        """源聊天参数转为任务 key"""
+        return str(utils.get_peer_id(await self.resolver.resolve(source)))
+
+    async def start(self, source: str, start_from: str, limit: int) -> dict:
+        """创建并启动回填任务，start_from 为起始消息ID或 YYYY-MM-DD 日期"""
+        key = await self.source_key(source)
+        if key in self.tasks and not self.tasks[key].done():
+            raise ValueError("该源已有回填任务在运行")
+        if not self.targets_getter(int(key)):
+            raise ValueError("该源没有转发目标，请先使用 /add_listen 添加监听")
+
+        job = {
+            'source': source,
+            'source_id': int(key),
+            'cursor': None,
+            'from_date': None,
+            'limit': limit,
+            'forwarded': 0,
+            'active_seconds': 0.0,
+            'status': 'running',
+            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        try:
+            job['cursor'] = max(int(start_from) - 1, 0)
+        except ValueError:
+            job['from_date'] = datetime.strptime(start_from, '%Y-%m-%d').isoformat()
+
+        self.jobs[key] = job
+        self.save()
+        self._launch(key)
+        return job
+
+    def resume_unfinished(self):
+        """启动时继续上次未完成的回填"""
+        for key, job in self.jobs.items():
+            if job['status'] == 'running':
+                print(f"🔁 继续回填 {job['source']}（已转发 {job['forwarded']}/{job['limit']}）")
+                self._launch(key)
+
+    def _launch(self, key: str):
+        event = asyncio.Event()
+        if self.jobs[key]['status'] == 'running':
+            event.set()
+        self.resume_events[key] = event
+        self.tasks[key] = asyncio.create_task(self._run(key))
+
+    def pause(self, key: str) -> bool:
+        job = self.jobs.get(key)
+        if not job or job['status'] != 'running':
+            return False
+        job['status'] = 'paused'
+        self.resume_events[key].clear()
+        self.save()
+        return True
+
+    def resume(self, key: str) -> bool:
+        job = self.jobs.get(key)
+        if not job or job['status'] != 'paused':
+            return False
+        job['status'] = 'running'
+        self.save()
+        if key in self.resume_events and key in self.tasks and not self.tasks[key].done():
+            self.resume_events[key].set()
+        else:
+            self._launch(key)
+        return True
+
+    def stop(self, key: str) -> bool:
+        job = self.jobs.get(key)
+        if not job or job['status'] in ('done', 'stopped'):
+            return False
+        job['status'] = 'stopped'
+        if key in self.resume_events:
+            self.resume_events[key].set()
+        self.save()
+        return True
+
+    async def _fetch_page(self, peer, job: dict, limit: int) -> list:
+        """拉取下一页历史消息（按时间正序），末尾的媒体组补齐到完整再返回"""
+        kwargs = {'reverse': True, 'limit': limit}
+        if job['cursor'] is not None:
+            kwargs['min_id'] = job['cursor']
+        elif job['from_date']:
+            kwargs['offset_date'] = datetime.fromisoformat(job['from_date'])
+        page = list(await self.tg_client.get_messages(peer, **kwargs))
+
+        if len(page) == limit and page[-1].grouped_id:
+            trailing = page[-1].grouped_id
+            rest = await self.tg_client.get_messages(peer, min_id=page[-1].id, reverse=True,
+                                                     limit=MediaGroupAggregator.ALBUM_LIMIT - 1)
+            for message in rest:
+                if message.grouped_id != trailing:
+                    break
+                page.append(message)
+        return page
+
+    async def _run(self, key: str):
+        job = self.jobs[key]
+        try:
+            peer = await self.resolver.resolve(job['source'])
+            while job['forwarded'] < job['limit']:
+                await self.resume_events[key].wait()
+                if job['status'] == 'stopped':
+                    return
+
+                targets = self.targets_getter(job['source_id'])
+                if not targets:
+                    print(f"⚠️ 回填 {job['source']} 暂停：该源已没有转发目标")
+                    self.pause(key)
+                    continue
+
+                batch_started = time.monotonic()
+                page = await self._fetch_page(peer, job, min(self.PAGE_SIZE, job['limit'] - job['forwarded']))
+                if not page:
+                    break
+
+                messages = [m for m in page if not getattr(m, 'action', None)]
+                for batch in pack_message_batches(messages):
+                    await forward_message_batch(self.scheduler, self.dedupe, job['source_id'], targets, batch,
+                                                weight=self.WEIGHT)
+
+                job['cursor'] = page[-1].id
+                job['forwarded'] += len(messages)
+                job['active_seconds'] += time.monotonic() - batch_started
+                self.save()
+
+            job['status'] = 'done'
+            print(f"✅ 回填完成 {job['source']}: {job['forwarded']} 条")
+        except Exception as e:
+            job['status'] = 'paused'
+            print(f"❌ 回填失败 {job['source']}: {e}")
+        finally:
+            self.save()
+
+    def summary(self) -> str:
+        """回填任务状态和吞吐量"""
+        if not self.jobs:
+            return "暂无回填任务"
+        status_names = {'running': '运行中', 'paused': '已暂停', 'done': '已完成', 'stopped': '已停止'}
+        lines = []
+        for job in self.jobs.values():
+            rate = job['forwarded'] / job['active_seconds'] * 60 if job['active_seconds'] else 0
+            lines.append(f"• `{job['source']}` {status_names.get(job['status'], job['status'])} "
+                         f"{job['forwarded']}/{job['limit']} 条，{rate:.0f} 条/分钟，游标 {job['cursor']}")
+        return "\n".join(lines)
+
+
+backfill_manager = BackfillManager(client, forward_scheduler, duplicate_filter, entity_resolver,
+                                   BACKFILL_STATE_FILE, lambda source_id: forwarding_map.get(source_id))
+
+
+# 活跃度统计保留的最长时间窗口（分钟）
+ACTIVITY_WINDOW_MINUTES = 60
+
+
+class HyperLogLog:
+    """HyperLogLog 基数估计"""
+
+    def __init__(self, precision: int = 10):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'little')
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog'):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def copy(self) -> 'HyperLogLog':
+        clone = HyperLogLog(self.precision)
+        clone.registers = bytearray(self.registers)
+        return clone
+
+    def count(self) -> int:
+        m = self.size
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # 小基数时用线性计数修正
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class ActivityCounter:
+    """按分钟分桶的发言者统计 - 查询最近 N 分钟的不同发言者数，大群的桶自动改用 HyperLogLog"""
+
+    # 单个桶的发言者超过此数量后改为 HyperLogLog 估计
+    EXACT_LIMIT = 256
+
+    def __init__(self, window_minutes: int = ACTIVITY_WINDOW_MINUTES):
+        self.window_minutes = window_minutes
+        # [分钟序号, 发言者集合或 HyperLogLog]，按时间顺序
+        self.buckets = deque()
+
+    def add(self, sender_id: int, now: float = None):
+        minute = int((time.time() if now is None else now) // 60)
+        if not self.buckets or self.buckets[-1][0] != minute:
+            self.buckets.append([minute, set()])
+            while self.buckets[0][0] <= minute - self.window_minutes:
+                self.buckets.popleft()
+        bucket = self.buckets[-1]
+        senders = bucket[1]
+        senders.add(sender_id)
+        if isinstance(senders, set) and len(senders) > self.EXACT_LIMIT:
+            sketch = HyperLogLog()
+            for sid in senders:
+                sketch.add(sid)
+            bucket[1] = sketch
+
+    def count(self, minutes: int, now: float = None) -> int:
+        """最近 minutes 分钟（含当前分钟）的不同发言者数"""
+        minute = int((time.time() if now is None else now) // 60)
+        cutoff = minute - min(minutes, self.window_minutes) + 1
+        exact = set()
+        sketch = None
+        for bucket_minute, senders in reversed(self.buckets):
+            if bucket_minute < cutoff:
+                break
+            if isinstance(senders, set):
+                exact |= senders
+            elif sketch is None:
+                sketch = senders.copy()
+            else:
+                sketch.merge(senders)
+        if sketch is None:
+            return len(exact)
+        for sid in exact:
+            sketch.add(sid)
+        return sketch.count()
+
+
+# 每个群保留的报警记录和人工消息条数
+ALERT_HISTORY_SIZE = 10
+MANUAL_QUEUE_SIZE = 20
+
+
+class ChatState:
+    """单个群的 AI 炒群状态，上下文和报警记录都是定长环形缓冲"""
+
+    __slots__ = ('context', 'last_reply_time', 'senders', 'alert_triggered', 'alerts',
+                 'manual_queue', 'last_seen', 'size')
+
+    def __init__(self, context_limit: int):
+        # (发言人, 内容, 时间)
+        self.context = deque(maxlen=context_limit)
+        self.last_reply_time = datetime.min
+        self.senders = ActivityCounter()
+        self.alert_triggered = False
+        self.alerts = deque(maxlen=ALERT_HISTORY_SIZE)
+        self.manual_queue = deque(maxlen=MANUAL_QUEUE_SIZE)
+        self.last_seen = time.monotonic()
+        self.size = 0
+
+    @property
+    def pinned(self) -> bool:
+        """报警中或有待发人工消息的群不会被淘汰"""
+        return self.alert_triggered or bool(self.manual_queue)
+
+    def approx_bytes(self) -> int:
+        """估算占用内存（字节）"""
+        size = 400
+        for role, content, _ in self.context:
+            size += 150 + sys.getsizeof(role) + sys.getsizeof(content)
+        for _, senders in self.senders.buckets:
+            size += 120 + (len(senders) * 60 if isinstance(senders, set) else len(senders.registers) + 100)
+        for alert in self.alerts:
+            size += 400 + sys.getsizeof(alert['message'])
+        for item in self.manual_queue:
+            size += 250 + sys.getsizeof(item['message'])
+        return size
+
+
+class ChatStateStore:
+    """群状态存储 - LRU 顺序，按群数上限、闲置时间和总内存上限淘汰"""
+
+    def __init__(self, cfg: dict):
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.stats = {'created': 0, 'evicted': 0}
+        self.update_config(cfg)
+
+    def update_config(self, cfg: dict):
+        ai_config = cfg.get('ai_chat', {})
+        self.context_limit = ai_config.get('context_limit', 20)
+        self.max_chats = ai_config.get('state_max_chats', 2000)
+        self.idle_seconds = ai_config.get('state_idle_minutes', 120) * 60
+        self.max_bytes = ai_config.get('state_max_mb', 32) * 1024 * 1024
+
+    def get(self, chat_id: int):
+        """只读查询，不创建、不更新 LRU 顺序"""
+        return self.entries.get(chat_id)
+
+    def state(self, chat_id: int) -> ChatState:
+        """获取或创建群状态，并标记为最近使用"""
+        state = self.entries.get(chat_id)
+        if state is None:
+            state = ChatState(self.context_limit)
+            self.entries[chat_id] = state
+            self.stats['created'] += 1
+        else:
+            self.entries.move_to_end(chat_id)
+            if state.context.maxlen != self.context_limit:
+                state.context = deque(state.context, maxlen=self.context_limit)
+        state.last_seen = time.monotonic()
+        return state
+
+    def updated(self, state: ChatState):
+        """状态修改后重新估算内存并执行淘汰"""
+        size = state.approx_bytes()
+        self.bytes += size - state.size
+        state.size = size
+        self._evict()
+
+    def discard(self, chat_id: int):
+        state = self.entries.pop(chat_id, None)
+        if state:
+            self.bytes -= state.size
+
+    def _evict(self):
+        now = time.monotonic()
+        # 最多检查一轮，避免全部被固定时空转
+        for _ in range(len(self.entries) - 1):
+            chat_id, state = next(iter(self.entries.items()))
+            over_limit = len(self.entries) > self.max_chats or self.bytes > self.max_bytes
+            if not over_limit and now - state.last_seen < self.idle_seconds:
+                break
+            if state.pinned:
+                self.entries.move_to_end(chat_id)
+                continue
+            self.discard(chat_id)
+            self.stats['evicted'] += 1
+
+    def alerted(self) -> list:
+        return [chat_id for chat_id, state in self.entries.items() if state.alert_triggered]
+
+    def summary(self) -> str:
+        """状态统计"""
+        contexts = sum(len(state.context) for state in self.entries.values())
+        pinned = sum(1 for state in self.entries.values() if state.pinned)
+        return (f"{len(self.entries)} 个群（固定 {pinned}），上下文 {contexts} 条，"
+                f"约 {self.bytes / 1024:.1f}KB，已淘汰 {self.stats['evicted']}")
+
+
+# 影响连接池的配置项，变化时需要重建客户端
+LLM_HTTP_KEYS = ('http_max_connections', 'http_max_keepalive', 'http_keepalive_seconds',
+                 'http_timeout_seconds', 'http_connect_timeout_seconds', 'http_max_retries')
+
+
+def build_llm_client(api_key: str, base_url: str, settings: dict, max_retries: int = None) -> AsyncOpenAI:
+    """创建带连接池的 AsyncOpenAI 客户端，长连接在请求之间复用，省去重复的 TLS 握手
+
+    max_retries 默认取 http_max_retries；由 LLMRouter 管理的客户端传 0，重试交给路由层
+    """
+    timeout = httpx.Timeout(settings.get('http_timeout_seconds', 30),
+                            connect=settings.get('http_connect_timeout_seconds', 5))
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=settings.get('http_max_connections', 20),
+                            max_keepalive_connections=settings.get('http_max_keepalive', 10),
+                            keepalive_expiry=settings.get('http_keepalive_seconds', 60)),
+        timeout=timeout,
+    )
+    if max_retries is None:
+        max_retries = settings.get('http_max_retries', 2)
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, timeout=timeout,
+                       max_retries=max_retries)
+
+
+async def close_llm_client(client: AsyncOpenAI, delay: float = 0):
+    """等进行中的请求结束后关闭旧客户端的连接池"""
+    await asyncio.sleep(delay)
+    try:
+        await client.close()
+    except Exception as e:
+        print(f"⚠️ 关闭 LLM 客户端失败: {e}")
+
+
+class LLMEndpoint:
+    """单个 OpenAI 兼容端点及其健康状态"""
+
+    def __init__(self, name: str, client, model: str, key: tuple = None):
+        self.name = name
+        self.client = client
+        self.model = model
+        # (api_key, base_url, 连接池配置)，相同时沿用客户端
+        self.key = key
+        # 最近成功请求的耗时和最近请求的成败
+        self.latencies = deque(maxlen=50)
+        self.outcomes = deque(maxlen=20)
+        self.consecutive_failures = 0
+        # 熔断截止时间，之后放行试探请求，失败则再次熔断
+        self.open_until = 0.0
+
+    def p90(self, default: float) -> float:
+        if len(self.latencies) < 5:
+            return default
+        ordered = sorted(self.latencies)
+        return ordered[int(0.9 * (len(ordered) - 1))]
+
+    def score(self, default: float) -> float:
+        """健康分，越小越好：典型耗时按近期失败率放大"""
+        if self.latencies:
+            ordered = sorted(self.latencies)
+            typical = ordered[len(ordered) // 2]
+        else:
+            typical = default
+        error_rate = self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0
+        return typical * (1 + 4 * error_rate)
+
+    def tripped(self, failures: int) -> bool:
+        return self.consecutive_failures >= failures
+
+    def status(self, failures: int, default: float) -> str:
+        now = time.monotonic()
+        if self.tripped(failures) and now < self.open_until:
+            return f"{self.name} ⚡熔断 {int(self.open_until - now)}秒"
+        state = "🟡试探" if self.tripped(failures) else "✅"
+        error_rate = self.outcomes.count(False) / len(self.outcomes) * 100 if self.outcomes else 0
+        return f"{self.name} {state} p90 {self.p90(default):.1f}秒，失败率 {error_rate:.0f}%"
+
+
+def llm_endpoint_specs(ai_config: dict) -> list:
+    """主端点（ai_chat.api_key/base_url/model）加上 ai_chat.endpoints 中的备用端点"""
+    invalid = ['', 'your_api_key', 'put your api key here']
+    api_key = ai_config.get('api_key', '')
+    base_url = ai_config.get('base_url', 'https://api.deepseek.com')
+    model = ai_config.get('model', 'deepseek-chat')
+    specs = []
+    if api_key not in invalid:
+        specs.append({'name': 'primary', 'api_key': api_key, 'base_url': base_url, 'model': model})
+    for i, endpoint in enumerate(ai_config.get('endpoints', [])):
+        endpoint_key = endpoint.get('api_key') or api_key
+        if endpoint_key in invalid:
+            continue
+        specs.append({
+            'name': endpoint.get('name') or f"endpoint{i + 1}",
+            'api_key': endpoint_key,
+            'base_url': endpoint.get('base_url', base_url),
+            'model': endpoint.get('model', model),
+        })
+    return specs
+
+
+class LLMRouter:
+    """多端点路由 - 按健康分选端点，首选端点超过其 p90 仍未返回时向下一个端点发对冲请求，
+    先返回的结果生效、另一路取消；连续失败的端点熔断一段时间
+
+    端点客户端不做自动重试（否则一次失败在客户端内部重试期间既不会切换也不会计入熔断），
+    失败后先切换到其他端点，都失败后再按 http_max_retries 退避重试可重试的错误。
+    """
+
+    # 可重试的 HTTP 状态码（其余 4xx 重试也不会成功）
+    RETRYABLE_STATUS = (408, 409, 429)
+
+    def __init__(self, cfg: dict):
+        self.endpoints = []
+        self.configured = None
+        self.stats = {'requests': 0, 'hedges': 0, 'hedge_wins': 0, 'failovers': 0, 'retries': 0}
+        self.update_config(cfg)
+
+    def update_config(self, cfg: dict):
+        """按配置增删端点，凭据和连接池配置不变的端点沿用原客户端及健康数据"""
+        ai_config = cfg.get('ai_chat', {})
+        self.hedge_enabled = ai_config.get('hedge_enabled', True)
+        self.hedge_min = ai_config.get('hedge_min_seconds', 1.0)
+        self.hedge_default = ai_config.get('hedge_default_seconds', 3.0)
+        self.breaker_failures = ai_config.get('breaker_failures', 3)
+        self.breaker_cooldown = ai_config.get('breaker_cooldown_seconds', 60)
+        self.max_retries = ai_config.get('http_max_retries', 2)
+
+        http_settings = tuple(ai_config.get(key) for key in LLM_HTTP_KEYS)
+        existing = {(endpoint.name, endpoint.key): endpoint for endpoint in self.endpoints}
+        endpoints = []
+        for spec in llm_endpoint_specs(ai_config):
+            key = (spec['api_key'], spec['base_url'], http_settings)
+            endpoint = existing.pop((spec['name'], key), None)
+            if endpoint is None:
+                client = build_llm_client(spec['api_key'], spec['base_url'], ai_config, max_retries=0)
+                endpoint = LLMEndpoint(spec['name'], client, spec['model'], key)
+                print(f"✅ AI 聊天客户端已初始化: {spec['name']} ({spec['base_url']})")
+            endpoint.model = spec['model']
+            endpoints.append(endpoint)
+        if not endpoints and self.configured is not False:
+            print("ℹ️ AI 聊天 API Key 未配置")
+        self.configured = bool(endpoints)
+        self.endpoints = endpoints
+
+        # 进行中的请求仍在使用被替换的客户端，超时时间过后再关闭
+        for endpoint in existing.values():
+            if endpoint.key is None:
+                continue
+            try:
+                asyncio.get_running_loop().create_task(
+                    close_llm_client(endpoint.client, ai_config.get('http_timeout_seconds', 30)))
+            except RuntimeError:
+                pass
+
+    @property
+    def client(self):
+        """首个端点的客户端，未配置时为 None"""
+        return self.endpoints[0].client if self.endpoints else None
+
+    def ranked(self) -> list:
+        """可用端点按健康分排序，熔断中的排除；全部熔断时仍按原顺序尝试"""
+        now = time.monotonic()
+        available = [e for e in self.endpoints if not (e.tripped(self.breaker_failures) and now < e.open_until)]
+        if not available:
+            return list(self.endpoints)
+        # 熔断到期的端点放在最后，只在前面的都失败或对冲时试探
+        return sorted(available, key=lambda e: (e.tripped(self.breaker_failures), e.score(self.hedge_default)))
+
+    async def call(self, attempt, scheduler: 'LLMScheduler' = None, direct: bool = True):
+        """attempt(endpoint) 为发起一次请求的协程函数，返回最先成功的结果
+
+        传入 scheduler 时，首个请求的许可由调用方持有，对冲、故障切换和重试的每个请求另占一个许可：
+        对冲只在有空闲许可时发出，切换和重试按 direct 的优先级排队等待许可。
+        """
+        candidates = self.ranked()
+        if not candidates:
+            raise RuntimeError("没有可用的 LLM 端点")
+        self.stats['requests'] += 1
+        first = candidates[0]
+        hedge_after = max(self.hedge_min, first.p90(self.hedge_default))
+        started = time.monotonic()
+        pending = {}
+        errors = []
+        next_index = 0
+        hedged = False
+
+        def launch(extra: bool = False):
+            nonlocal next_index
+            # 超出端点数后为重试，依次轮回各端点
+            endpoint = candidates[next_index % len(candidates)]
+            next_index += 1
+            task = asyncio.create_task(self._attempt(endpoint, attempt))
+            if extra and scheduler:
+                task.add_done_callback(lambda _: scheduler.release())
+            pending[task] = endpoint
+
+        launch()
+        try:
+            while True:
+                timeout = None
+                if self.hedge_enabled and not hedged and next_index < len(candidates):
+                    timeout = max(0.0, hedge_after - (time.monotonic() - started))
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    # 预算紧张时不对冲，继续等首选端点
+                    if scheduler and not scheduler.try_acquire():
+                        continue
+                    self.stats['hedges'] += 1
+                    metrics.inc('tg_llm_hedges_total', result='sent')
+                    launch(extra=True)
+                    continue
+                winner = None
+                for task in done:
+                    endpoint = pending.pop(task)
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                    elif winner is None:
+                        winner = (task, endpoint)
+                if winner:
+                    task, endpoint = winner
+                    if hedged and endpoint is not first:
+                        self.stats['hedge_wins'] += 1
+                        metrics.inc('tg_llm_hedges_total', result='won')
+                    return task.result()
+                if not pending:
+                    if next_index < len(candidates):
+                        # 当前端点全部失败，立即换下一个
+                        self.stats['failovers'] += 1
+                    elif next_index < len(candidates) + self.max_retries and self._retryable(errors[-1]):
+                        self.stats['retries'] += 1
+                        await asyncio.sleep(min(0.5 * 2 ** (next_index - len(candidates)), 8))
+                    else:
+                        raise errors[-1]
+                    if scheduler and not await scheduler.acquire(direct):
+                        raise errors[-1]
+                    launch(extra=True)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @classmethod
+    def _retryable(cls, error: Exception) -> bool:
+        """连接错误、超时、限流和 5xx 可以重试"""
+        status = getattr(error, 'status_code', None)
+        return status is None or status in cls.RETRYABLE_STATUS or status >= 500
+
+    async def _attempt(self, endpoint: LLMEndpoint, attempt):
+        started = time.monotonic()
+        try:
+            result = await attempt(endpoint)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record_failure(endpoint, e)
+            raise
+        endpoint.latencies.append(time.monotonic() - started)
+        endpoint.outcomes.append(True)
+        endpoint.consecutive_failures = 0
+        return result
+
+    def _record_failure(self, endpoint: LLMEndpoint, error: Exception):
+        endpoint.outcomes.append(False)
+        endpoint.consecutive_failures += 1
+        metrics.inc('tg_llm_endpoint_errors_total', endpoint=endpoint.name)
+        print(f"⚠️ LLM 端点 {endpoint.name} 请求失败: {error}")
+        if endpoint.tripped(self.breaker_failures):
+            endpoint.open_until = time.monotonic() + self.breaker_cooldown
+            metrics.inc('tg_llm_breaker_open_total', endpoint=endpoint.name)
+            print(f"⚡ LLM 端点 {endpoint.name} 连续失败 {endpoint.consecutive_failures} 次，"
+                  f"熔断 {self.breaker_cooldown} 秒")
+
+    async def close(self):
+        """关闭全部端点的连接池"""
+        for endpoint in self.endpoints:
+            if endpoint.key is not None:
+                await close_llm_client(endpoint.client)
+        self.endpoints = []
+
+    def summary(self) -> str:
+        if not self.endpoints:
+            return "未配置"
+        lines = [endpoint.status(self.breaker_failures, self.hedge_default) for endpoint in self.endpoints]
+        lines.append(f"请求 {self.stats['requests']}，对冲 {self.stats['hedges']}（胜出 {self.stats['hedge_wins']}），"
+                     f"故障切换 {self.stats['failovers']}，重试 {self.stats['retries']}")
+        return "\n• ".join(lines)
+
+
+# 人设之后的固定要求，和人设一起构成每次请求都相同的前缀，便于服务端缓存
+CHAT_INSTRUCTIONS = """你现在在一个群聊中。聊天记录按顺序给出，别人的消息格式是“[时间] 昵称: 内容”，assistant 消息是你自己之前说的话。
+
+请你根据上下文，像一个真人一样回复最后一条消息。要求：
+1. 回复要自然、口语化，像真人聊天
+2. 回复要简短，通常1-2句话，最多不超过50字
+3. 可以适当使用网络用语
+4. 有时候可以不直接回答问题，而是聊相关的话题
+5. 偶尔可以调侃一下，但不要过分
+6. 不要暴露自己是AI
+7. 如果话题无聊或者你觉得没必要回复，可以回复 [SKIP] 表示跳过
+
+只需要输出回复内容，不要加任何前缀或解释。"""
+
+
+def cached_prompt_tokens(usage) -> int:
+    """服务端提示缓存命中的 token 数，兼容 OpenAI（prompt_tokens_details）和 DeepSeek（prompt_cache_hit_tokens）"""
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None) if details else None
+    if cached is None:
+        cached = getattr(usage, 'prompt_cache_hit_tokens', None)
+    return cached or 0
+
+
+class ReplyCache:
+    """相似触发语的回复缓存 - 群聊里的问候、“哈哈”、“在吗”高度重复，命中时复用已生成过的回复
+
+    键为规范化后的触发文本加粗粒度的上下文特征，每个键保存多条不同的回复，
+    凑够 MIN_VARIANTS 条后才开始命中，并避开该群最近已经发过的回复。
+    """
+
+    MIN_VARIANTS = 2
+    # 同一群最近几条自己的回复不再复用
+    RECENT_OWN_REPLIES = 3
+
+    def __init__(self, cfg: dict):
+        # key -> [(回复, 生成时间), ...]
+        self.entries = OrderedDict()
+        # key -> 写入该键的群，chat_id -> 该群写入的键（按时间顺序）
+        self.owners = {}
+        self.chat_keys = defaultdict(OrderedDict)
+        self.stats = {'hits': 0, 'misses': 0}
+        self.update_config(cfg)
+
+    def update_config(self, cfg: dict):
+        ai_config = cfg.get('ai_chat', {})
+        self.enabled = ai_config.get('reply_cache_enabled', False)
+        self.ttl = ai_config.get('reply_cache_ttl_seconds', 1800)
+        self.max_entries = ai_config.get('reply_cache_max_entries', 500)
+        self.per_chat = ai_config.get('reply_cache_per_chat', 100)
+        self.variants = ai_config.get('reply_cache_variants', 4)
+        self.max_trigger_len = ai_config.get('reply_cache_max_trigger_len', 12)
+        if not self.enabled:
+            self.clear()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """去掉 @、标点、空白和表情，连续重复的字压缩为两个（哈哈哈哈 -> 哈哈）"""
+        text = re.sub(r'@\w+', '', text.lower())
+        text = ''.join(ch for ch in text if ch.isalnum())
+        return re.sub(r'(.)\1{2,}', r'\1\1', text)
+
+    def key(self, text: str, is_direct_reply: bool, context) -> tuple:
+        """只缓存短触发语，长消息内容相关性强，不复用"""
+        normalized = self.normalize(text)
+        if not normalized or len(normalized) > self.max_trigger_len:
+            return None
+        # 粗粒度上下文：是否在跟我说话、上一条是否是我发的
+        last_is_me = len(context) >= 2 and context[-2][0] == "我"
+        return normalized, is_direct_reply, last_is_me
+
+    def lookup(self, key: tuple, context):
+        """返回一条该群最近没说过的缓存回复，没有时返回 None"""
+        if not self.enabled or key is None:
+            return None
+        variants = self._live(key)
+        # 上下文里是加过表情的回复，按包含关系判断是否刚说过
+        recent = [content for role, content, _ in context if role == "我"][-self.RECENT_OWN_REPLIES:]
+        candidates = [reply for reply, _ in variants if not any(reply in own for own in recent)]
+        if len(variants) < self.MIN_VARIANTS or not candidates:
+            self.stats['misses'] += 1
+            metrics.inc('tg_llm_reply_cache_total', result='miss')
+            return None
+        self.entries.move_to_end(key)
+        self.stats['hits'] += 1
+        metrics.inc('tg_llm_reply_cache_total', result='hit')
+        return random.choice(candidates)
+
+    def store(self, chat_id: int, key: tuple, reply: str):
+        if not self.enabled or key is None:
+            return
+        variants = self._live(key)
+        if any(existing == reply for existing, _ in variants):
+            return
+        variants.append((reply, time.monotonic()))
+        del variants[:-self.variants]
+        self.entries[key] = variants
+        self.entries.move_to_end(key)
+        previous = self.owners.get(key)
+        if previous is not None and previous != chat_id:
+            self.chat_keys[previous].pop(key, None)
+        self.owners[key] = chat_id
+        keys = self.chat_keys[chat_id]
+        keys[key] = None
+        keys.move_to_end(key)
+        while len(keys) > self.per_chat:
+            self._remove(next(iter(keys)))
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def _live(self, key: tuple) -> list:
+        """未过期的回复，过期的顺带清理"""
+        variants = self.entries.get(key)
+        if not variants:
+            return []
+        now = time.monotonic()
+        live = [(reply, created) for reply, created in variants if now - created < self.ttl]
+        if not live:
+            self._remove(key)
+        elif len(live) != len(variants):
+            self.entries[key] = live
+        return live
+
+    def _remove(self, key: tuple):
+        self.entries.pop(key, None)
+        owner = self.owners.pop(key, None)
+        if owner is not None:
+            keys = self.chat_keys.get(owner)
+            if keys is not None:
+                keys.pop(key, None)
+                if not keys:
+                    del self.chat_keys[owner]
+
+    def clear(self):
+        self.entries.clear()
+        self.owners.clear()
+        self.chat_keys.clear()
+
+    def summary(self) -> str:
+        if not self.enabled:
+            return "未启用"
+        lookups = self.stats['hits'] + self.stats['misses']
+        rate = self.stats['hits'] / lookups * 100 if lookups else 0
+        return (f"{len(self.entries)}/{self.max_entries} 个触发语，命中 {self.stats['hits']}/{lookups}"
+                f"（{rate:.1f}%）")
+
+
+class LLMScheduler:
+    """LLM 请求调度器 - 全局并发上限和每分钟请求预算，被@/回复优先，排队过久的普通回复直接放弃"""
+
+    def __init__(self, cfg: dict, shares: int = 1, index: int = 0):
+        # shares: 预算由几个进程平分（AI 工作进程各自持有一个调度器），index: 本进程的编号
+        self.shares = shares
+        self.index = index
+        self.inflight = 0
+        # (优先级, 序号, 入队时间, future)，优先级 0 为直接回复，1 为普通插话
+        self.waiters = []
+        self.seq = 0
+        # 最近一分钟内发出请求的时间
+        self.sent = deque()
+        self.timer = None
+        self.stats = {'granted': 0, 'expired': 0}
+        self.update_config(cfg)
+
+    def update_config(self, cfg: dict):
+        ai_config = cfg.get('ai_chat', {})
+        max_inflight = ai_config.get('llm_max_inflight', 4)
+        per_minute = ai_config.get('llm_requests_per_minute', 60)
+        if self.shares > min(max_inflight, per_minute):
+            print(f"⚠️ AI 工作进程数 {self.shares} 超过 LLM 并发上限 {max_inflight} 或每分钟预算 {per_minute}，"
+                  f"每个进程至少保留 1 个名额，实际用量会超出配置")
+        self.max_inflight = max(1, self._share(max_inflight))
+        self.per_minute = max(1, self._share(per_minute))
+        self.ambient_ttl = ai_config.get('llm_ambient_ttl_seconds', 15)
+        self._pump()
+
+    def _share(self, total: int) -> int:
+        """本进程分到的份额：平分后余数分给编号靠前的进程，各进程合计等于全局上限"""
+        base, extra = divmod(total, self.shares)
+        return base + (1 if self.index < extra else 0)
+
+    async def acquire(self, direct: bool) -> bool:
+        """等待发送许可，普通插话排队超过 ambient_ttl 秒时返回 False"""
+        loop = asyncio.get_running_loop()
+        priority = 0 if direct else 1
+        future = loop.create_future()
+        self.seq += 1
+        heapq.heappush(self.waiters, (priority, self.seq, time.monotonic(), future))
+        expiry = None if direct else loop.call_later(self.ambient_ttl, self._expire, future)
+        self._pump()
+        try:
+            granted = await future
+        except asyncio.CancelledError:
+            # 已获得许可但调用方被取消，归还名额
+            if future.done() and not future.cancelled() and future.result():
+                self.release()
+            raise
+        finally:
+            if expiry:
+                expiry.cancel()
+        return granted
+
+    def try_acquire(self) -> bool:
+        """有空闲许可且没有排队的请求时立即占用一个（不排队），用于对冲请求"""
+        self._pump()
+        if self.inflight >= self.max_inflight or len(self.sent) >= self.per_minute:
+            return False
+        self.inflight += 1
+        self.sent.append(time.monotonic())
+        self.stats['granted'] += 1
+        return True
+
+    def release(self):
+        self.inflight -= 1
+        self._pump()
+
+    def _expire(self, future):
+        if not future.done():
+            future.set_result(False)
+            self.stats['expired'] += 1
+            metrics.inc('tg_llm_queue_expired_total')
+
+    def _pump(self):
+        """按优先级发放许可，受并发上限和每分钟预算限制"""
+        now = time.monotonic()
+        while self.sent and now - self.sent[0] >= 60:
+            self.sent.popleft()
+        while self.waiters and self.inflight < self.max_inflight:
+            priority, _, queued_at, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if len(self.sent) >= self.per_minute:
+                # 预算用完，等最早的一次请求滑出窗口再发放
+                if self.timer is None:
+                    self.timer = asyncio.get_running_loop().call_later(60 - (now - self.sent[0]), self._on_timer)
+                return
+            heapq.heappop(self.waiters)
+            self.inflight += 1
+            self.sent.append(now)
+            self.stats['granted'] += 1
+            metrics.observe('tg_llm_queue_seconds', now - queued_at,
+                            priority='direct' if priority == 0 else 'ambient')
+            future.set_result(True)
+
+    def _on_timer(self):
+        self.timer = None
+        self._pump()
+
+    def summary(self) -> str:
+        """调度状态"""
+        queued = sum(1 for *_, future in self.waiters if not future.done())
+        return (f"进行中 {self.inflight}/{self.max_inflight}，排队 {queued}，"
+                f"近一分钟 {len(self.sent)}/{self.per_minute} 次，过期 {self.stats['expired']}")
+
+
+def llm_queue_wait_summary() -> str:
+    """LLM 排队等待时间（汇总本进程和各 AI 工作进程上报的指标）"""
+    totals = {}
+    for labels, (_, total, count) in list(metrics.values.get('tg_llm_queue_seconds', {}).items()):
+        priority = dict(labels).get('priority')
+        current = totals.get(priority, (0.0, 0))
+        totals[priority] = (current[0] + total, current[1] + count)
+    parts = []
+    for priority, name in (('direct', '直接回复'), ('ambient', '普通插话')):
+        total, count = totals.get(priority, (0.0, 0))
+        parts.append(f"{name} {total / count:.2f}秒" if count else f"{name} -")
+    return "平均排队 " + "，".join(parts)
+
+
+def llm_prompt_cache_summary() -> str:
+    """服务端提示缓存命中的 token 占比"""
+    totals = defaultdict(float)
+    for labels, value in list(metrics.values.get('tg_llm_tokens_total', {}).items()):
+        totals[dict(labels).get('kind')] += value
+    if not totals['prompt']:
+        return "提示缓存命中 -"
+    return f"提示缓存命中 {totals['cached'] / totals['prompt'] * 100:.1f}%（{int(totals['cached'])}/{int(totals['prompt'])} tokens）"
+
+
+# 每个群邮箱最多暂存的消息数，突发时丢弃最旧的
+ACTOR_MAILBOX_SIZE = 50
+
+
+class ChatActor:
+    """单个群的 AI 回复协程 - 生成和发送期间到达的消息合并到下一轮，同一群同时只有一条回复在途"""
+
+    def __init__(self, chat_id: int, manager: 'AIChatManager', deliver):
+        self.chat_id = chat_id
+        self.manager = manager
+        self.deliver = deliver
+        self.mailbox = deque(maxlen=ACTOR_MAILBOX_SIZE)
+        self.task = None
+
+    def post(self, record: dict):
+        self.mailbox.append(record)
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while self.mailbox:
+                batch = list(self.mailbox)
+                self.mailbox.clear()
+                try:
+                    async with self.manager.generation_slots():
+                        instruction = await self.manager.decide_batch(batch)
+                    if instruction:
+                        await self.deliver(instruction)
+                except Exception as e:
+                    print(f"❌ AI 处理失败 [{self.chat_id}]: {e}")
+        finally:
+            self.task = None
+            # 空闲的 actor 不常驻，下次有消息时重新创建
+            if not self.mailbox and self.manager.actors.get(self.chat_id) is self:
+                del self.manager.actors[self.chat_id]
+
 
 class AIChatManager:
     """AI 炒群管理器"""
 
     def __init__(self, cfg: dict):
         self.config = cfg
-        self.client = None
-        self.chat_contexts = defaultdict(list)
-        self.last_reply_time = defaultdict(lambda: datetime.min)
         self.my_user_id = None
-        
-        # 活跃度追踪 - 记录每个群组最近发言的用户
-        self.recent_senders = defaultdict(lambda: deque(maxlen=50))
-        
-        # 报警状态
-        self.alert_triggered = defaultdict(bool)
-        self.alert_messages = defaultdict(list)
-        
-        # 待发送的人工消息队列
-        self.manual_message_queue = defaultdict(list)
+
+        # 每个群的上下文、活跃度、报警和人工消息队列
+        self.states = ChatStateStore(cfg)
+        # 只追踪已配置炒群的群组的发言者
+        self.tracked_chats = set(cfg.get('ai_chat', {}).get('chats', []))
+
+        # chat_id -> ChatActor，只保留有待处理消息的群
+        self.actors = {}
+        self._generation_semaphore = None
+        self._generation_size = None
+        self.actor_stats = {'messages': 0, 'generations': 0, 'coalesced': 0}
+        # 所有群共用的 LLM 请求调度
+        self.scheduler = LLMScheduler(cfg)
+        self.reply_cache = ReplyCache(cfg)
+        # 流式生成出首个有效内容时调用，参数为 chat_id，用于提前显示输入状态
+        self.on_typing = None
 
         self.emojis = ['😂', '🤣', '😊', '😄', '👍', '🔥', '💪', '😎', '🤔', '😏',
                        '🙃', '😜', '🤭', '😁', '👀', '💯', '✨', '🎉', '😋', '🥰',
                        '😤', '🤷', '😅', '🙈', '💀', '😭', '🤡', '👏', '🤝', '😌']
 
-        self._init_client()
+        # LLM 端点（主端点加备用端点），凭据和连接池配置不变时沿用客户端及其长连接
+        self.router = LLMRouter(cfg)
 
-    def _init_client(self):
-        """初始化 OpenAI 客户端"""
-        ai_config = self.config.get('ai_chat', {})
-        api_key = ai_config.get('api_key', '')
-        base_url = ai_config.get('base_url', 'https://api.deepseek.com')
+    @property
+    def client(self):
+        """首选端点的客户端，未配置 API Key 时为 None"""
+        return self.router.client
 
-        if api_key and api_key not in ['', 'your_api_key', 'put your api key here']:
-            self.client = AsyncOpenAI(
-                api_key=api_key,
-                base_url=base_url
-            )
-            print("✅ AI 聊天客户端已初始化")
-        else:
-            self.client = None
-            print("ℹ️ AI 聊天 API Key 未配置")
+    async def close(self):
+        """关闭客户端连接池"""
+        await self.router.close()
 
     def update_config(self, cfg: dict):
-        """更新配置"""
+        """更新配置（cfg 为只读快照），端点凭据或连接池配置变化时才重建对应客户端"""
+        new_ai_config = cfg.get('ai_chat', {})
         self.config = cfg
-        self._init_client()
+        self.states.update_config(cfg)
+        self.tracked_chats = set(new_ai_config.get('chats', []))
+        self.scheduler.update_config(cfg)
+        self.reply_cache.update_config(cfg)
+        self.router.update_config(cfg)
+        # 并发生成数变化时下次取用重建信号量；进行中的生成仍在旧信号量上释放，过渡期间可能短暂超出新上限
+        if self._generation_size != cfg.get('pipeline', {}).get('ai_workers', 2):
+            self._generation_semaphore = None
 
     def is_enabled(self, chat_id: int) -> bool:
         """检查是否在指定群组启用了AI聊天"""
@@ -258,32 +3155,24 @@ class AIChatManager:
         return False, None
 
     def track_sender(self, chat_id: int, sender_id: int):
-        """追踪发言者"""
-        now = datetime.now()
-        self.recent_senders[chat_id].append({
-            'sender_id': sender_id,
-            'time': now
-        })
+        """追踪发言者（仅限已配置的炒群群组）"""
+        if chat_id not in self.tracked_chats:
+            return
+        state = self.states.state(chat_id)
+        state.senders.add(sender_id)
+        self.states.updated(state)
 
     def get_active_users_count(self, chat_id: int) -> int:
-        """获取指定时间段内的活跃用户数"""
+        """获取指定时间段内的活跃用户数（最长 ACTIVITY_WINDOW_MINUTES 分钟）"""
         ai_config = self.config.get('ai_chat', {})
         check_minutes = ai_config.get('active_check_minutes', 10)
-        cutoff_time = datetime.now() - timedelta(minutes=check_minutes)
-        
-        # 获取时间范围内的不同发送者
-        unique_senders = set()
-        for record in self.recent_senders[chat_id]:
-            if record['time'] >= cutoff_time:
-                unique_senders.add(record['sender_id'])
-        
-        return len(unique_senders)
+        state = self.states.get(chat_id)
+        return state.senders.count(check_minutes) if state else 0
 
-    def should_skip_due_to_low_activity(self, chat_id: int) -> bool:
+    def should_skip_due_to_low_activity(self, active_count: int) -> bool:
         """检查是否因活跃度过低而跳过回复"""
         ai_config = self.config.get('ai_chat', {})
         min_users = ai_config.get('min_active_users', 3)
-        active_count = self.get_active_users_count(chat_id)
         return active_count < min_users
 
     def should_reply(self, chat_id: int, message_text: str) -> bool:
@@ -295,7 +3184,8 @@ class AIChatManager:
             return False
 
         cooldown = ai_config.get('cooldown_seconds', 30)
-        last_time = self.last_reply_time[chat_id]
+        state = self.states.get(chat_id)
+        last_time = state.last_reply_time if state else datetime.min
         if datetime.now() - last_time < timedelta(seconds=cooldown):
             return False
 
@@ -304,18 +3194,10 @@ class AIChatManager:
 
     def add_context(self, chat_id: int, sender_name: str, message: str, is_self: bool = False):
         """添加上下文消息"""
-        ai_config = self.config.get('ai_chat', {})
-        context_limit = ai_config.get('context_limit', 20)
-
         role = "我" if is_self else sender_name
-        self.chat_contexts[chat_id].append({
-            'role': role,
-            'content': message,
-            'time': datetime.now().strftime('%H:%M')
-        })
-
-        if len(self.chat_contexts[chat_id]) > context_limit:
-            self.chat_contexts[chat_id] = self.chat_contexts[chat_id][-context_limit:]
+        state = self.states.state(chat_id)
+        state.context.append((role, message, datetime.now().strftime('%H:%M')))
+        self.states.updated(state)
 
     def _add_personality(self, text: str) -> str:
         """给回复添加个性化元素"""
@@ -330,63 +3212,134 @@ class AIChatManager:
 
         return text
 
-    async def generate_reply(self, chat_id: int, trigger_message: str, sender_name: str) -> str:
-        """生成AI回复"""
-        if not self.client:
-            return None
-
-        ai_config = self.config.get('ai_chat', {})
-        personality = ai_config.get('personality', '')
-        model = ai_config.get('model', 'deepseek-chat')
-
-        context_messages = self.chat_contexts[chat_id][-15:]
-
-        context_str = ""
-        for msg in context_messages:
-            context_str += f"[{msg['time']}] {msg['role']}: {msg['content']}\n"
+    async def generate_reply(self, chat_id: int, trigger_message: str, sender_name: str,
+                             is_direct_reply: bool = False) -> str:
+        """生成AI回复，请求经调度器排队，普通插话排队过久时放弃"""
+        reply, _ = await self._generate(chat_id, trigger_message, sender_name, is_direct_reply)
+        return self._add_personality(reply) if reply else reply
+
+    def build_messages(self, chat_id: int, trigger_message: str, sender_name: str) -> list:
+        """组装请求消息：固定的人设和要求放在最前面作为可复用的前缀，聊天记录按轮次追加在后面
+
+        触发消息通常已是上下文的最后一条，不再重复发送。
+        """
+        personality = self.config.get('ai_chat', {}).get('personality', '')
+        messages = [{"role": "system", "content": f"{personality}\n\n{CHAT_INSTRUCTIONS}"}]
+
+        state = self.states.get(chat_id)
+        context_messages = list(state.context)[-15:] if state else []
+        for role, content, sent_at in context_messages:
+            if role == "我":
+                messages.append({"role": "assistant", "content": content})
+            else:
+                messages.append({"role": "user", "content": f"[{sent_at}] {role}: {content}"})
 
-        system_prompt = f"""{personality}
+        # 合并处理时要回应的消息可能不在最后，或调用方没有把它加入上下文
+        last = context_messages[-1] if context_messages else None
+        if not last or last[0] != sender_name or last[1] != trigger_message:
+            messages.append({"role": "user", "content": f"[{datetime.now().strftime('%H:%M')}] {sender_name}: {trigger_message}"})
+        return messages
 
-你现在在一个群聊中，以下是最近的聊天记录：
-{context_str}
+    async def _generate(self, chat_id: int, trigger_message: str, sender_name: str,
+                        is_direct_reply: bool = False, typing: bool = False) -> tuple:
+        """生成回复，返回 (回复, 开始显示输入状态的时间)，未提前显示时后者为 None"""
+        if not self.client:
+            return None, None
 
-现在 {sender_name} 说了: "{trigger_message}"
+        ai_config = self.config.get('ai_chat', {})
 
-请你根据上下文，像一个真人一样回复这条消息。要求：
-1. 回复要自然、口语化，像真人聊天
-2. 回复要简短，通常1-2句话，最多不超过50字
-3. 可以适当使用网络用语
-4. 有时候可以不直接回答问题，而是聊相关的话题
-5. 偶尔可以调侃一下，但不要过分
-6. 不要暴露自己是AI
-7. 如果话题无聊或者你觉得没必要回复，可以回复 [SKIP] 表示跳过
+        if not await self.scheduler.acquire(is_direct_reply):
+            print(f"⏭️ 群组 {chat_id} 的 AI 请求排队超时，放弃回复")
+            return None, None
+        # 模型随端点而定
+        request = {
+            'messages': self.build_messages(chat_id, trigger_message, sender_name),
+            'max_tokens': 100,
+            'temperature': 0.9,
+        }
+        started = time.monotonic()
+        first_content = {}
 
-只需要输出回复内容，不要加任何前缀或解释。"""
+        def on_content():
+            # 对冲时两路都可能流式输出，只在最早出内容的一路触发一次
+            if first_content:
+                return
+            first_content['at'] = time.monotonic()
+            metrics.observe('tg_llm_first_token_seconds', first_content['at'] - started)
+            if typing and self.on_typing:
+                first_content['typing'] = first_content['at']
+                self.on_typing(chat_id)
 
         try:
-            response = await self.client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": trigger_message}
-                ],
-                max_tokens=100,
-                temperature=0.9,
-            )
-
-            reply = response.choices[0].message.content.strip()
+            if ai_config.get('stream_replies', False):
+                reply, usage = await self.router.call(
+                    lambda endpoint: self._stream_completion(endpoint, request, on_content),
+                    self.scheduler, is_direct_reply)
+            else:
+                reply, usage = await self.router.call(lambda endpoint: self._complete(endpoint, request),
+                                                      self.scheduler, is_direct_reply)
+            typing_started = first_content.get('typing')
+            metrics.observe('tg_llm_request_seconds', time.monotonic() - started)
+            if usage:
+                metrics.inc('tg_llm_tokens_total', usage.prompt_tokens or 0, kind='prompt')
+                metrics.inc('tg_llm_tokens_total', usage.completion_tokens or 0, kind='completion')
+                cached = cached_prompt_tokens(usage)
+                metrics.inc('tg_llm_tokens_total', cached, kind='cached')
+                if usage.prompt_tokens:
+                    metrics.observe('tg_llm_prompt_cached_ratio', cached / usage.prompt_tokens)
+
+            reply = (reply or '').strip()
 
             if '[SKIP]' in reply or reply == '':
-                return None
+                return None, None
 
             reply = reply.replace('[SKIP]', '').strip()
-            reply = self._add_personality(reply)
 
-            return reply
+            return reply, typing_started
 
         except Exception as e:
             print(f"❌ AI 生成回复失败: {e}")
-            return None
+            return None, None
+        finally:
+            self.scheduler.release()
+
+    @staticmethod
+    async def _complete(endpoint: LLMEndpoint, request: dict) -> tuple:
+        """一次性请求，返回 (回复文本, token 用量)"""
+        response = await endpoint.client.chat.completions.create(model=endpoint.model, **request)
+        return response.choices[0].message.content, getattr(response, 'usage', None)
+
+    @staticmethod
+    async def _stream_completion(endpoint: LLMEndpoint, request: dict, on_content) -> tuple:
+        """流式读取回复，开头是 [SKIP] 时立即中止；一旦确定不是跳过就调用 on_content 开始显示输入状态
+
+        返回 (回复文本, token 用量)。
+        """
+        stream = await endpoint.client.chat.completions.create(
+            model=endpoint.model, **request, stream=True, stream_options={'include_usage': True})
+        parts = []
+        decided = False
+        usage = None
+        try:
+            async for chunk in stream:
+                if getattr(chunk, 'usage', None):
+                    usage = chunk.usage
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                parts.append(chunk.choices[0].delta.content)
+                if decided:
+                    continue
+                head = ''.join(parts).lstrip()
+                if head.startswith('[SKIP]'):
+                    metrics.inc('tg_llm_stream_aborted_total')
+                    return '[SKIP]', usage
+                if head and not '[SKIP]'.startswith(head):
+                    decided = True
+                    on_content()
+        finally:
+            # 提前中止或对冲落败被取消时关闭连接，服务端停止生成
+            await stream.close()
+        return ''.join(parts), usage
 
     async def simulate_typing(self, text: str, is_direct_reply: bool = False) -> float:
         """模拟打字延迟"""
@@ -404,120 +3357,643 @@ class AIChatManager:
         delay = base_delay + random.uniform(0.5, 2.0)
         return min(delay, 5.0)
 
+    def submit(self, record: dict, deliver):
+        """把消息交给该群的 actor 处理，deliver 为发送回复指令的协程函数"""
+        self.actor_stats['messages'] += 1
+        actor = self.actors.get(record['chat_id'])
+        if actor is None:
+            actor = self.actors[record['chat_id']] = ChatActor(record['chat_id'], self, deliver)
+        actor.post(record)
+
+    def generation_slots(self) -> asyncio.Semaphore:
+        """限制同时进行的生成数（各群 actor 共用）"""
+        if self._generation_semaphore is None:
+            self._generation_size = self.config.get('pipeline', {}).get('ai_workers', 2)
+            self._generation_semaphore = asyncio.Semaphore(self._generation_size)
+        return self._generation_semaphore
+
+    async def decide_batch(self, records: list):
+        """合并一批消息：全部按顺序进入上下文，只对最需要回应的一条做一次决策"""
+        self.actor_stats['generations'] += 1
+        self.actor_stats['coalesced'] += len(records) - 1
+        trigger = next((r for r in reversed(records) if r['is_mentioned'] or r['is_reply_to_me']), records[-1])
+        for record in records:
+            self.add_context(record['chat_id'], record['sender_name'], record['text'])
+        return await self.decide(trigger, in_context=True)
+
+    def actor_summary(self) -> str:
+        """actor 统计"""
+        return (f"活跃 {len(self.actors)} 个群，消息 {self.actor_stats['messages']} 条，"
+                f"决策 {self.actor_stats['generations']} 次（合并 {self.actor_stats['coalesced']} 条）")
+
+    async def decide(self, record: dict, in_context: bool = False):
+        """根据消息记录决定是否回复，返回回复指令，不回复时返回 None
+
+        record 由监听进程生成，只含可序列化的字段，可在本进程或 AI 工作进程中处理。
+        """
+        chat_id = record['chat_id']
+        message_text = record['text']
+        if not in_context:
+            self.add_context(chat_id, record['sender_name'], message_text)
+
+        is_direct_reply = record['is_mentioned'] or record['is_reply_to_me']
+        if is_direct_reply:
+            should_reply = random.randint(1, 100) <= 90
+        else:
+            # 检查活跃度
+            if self.should_skip_due_to_low_activity(record['active_users']):
+                print(f"⏸️ 群组 {chat_id} 活跃用户过少，跳过回复")
+                return None
+            should_reply = self.should_reply(chat_id, message_text)
+
+        if not should_reply:
+            return None
+
+        # 重复度高的短触发语优先用缓存的回复，省掉一次 LLM 请求
+        state = self.states.get(chat_id)
+        context = list(state.context) if state else []
+        cache_key = self.reply_cache.key(message_text, is_direct_reply, context)
+        reply = self.reply_cache.lookup(cache_key, context)
+        typing_started = None
+        if reply is None:
+            typing = self.config.get('ai_chat', {}).get('typing_simulation', True)
+            reply, typing_started = await self._generate(chat_id, message_text, record['sender_name'],
+                                                         is_direct_reply, typing)
+            if reply:
+                self.reply_cache.store(chat_id, cache_key, reply)
+        if not reply:
+            return None
+        # 缓存里是模型原文，表情每次使用时再随机加，命中缓存的回复不会带着同一个表情重复出现
+        reply = self._add_personality(reply)
+
+        # 根据是否是直接回复决定延迟时间，流式生成时已经显示输入状态的时间计入其中
+        typing_delay = await self.simulate_typing(reply, is_direct_reply)
+        if typing_started:
+            typing_delay = max(0.0, typing_delay - (time.monotonic() - typing_started))
+        # 决定回复时即记录，打字延迟期间不会重复回复
+        self.states.state(chat_id).last_reply_time = datetime.now()
+        self.add_context(chat_id, "我", reply, is_self=True)
+
+        quote = record['is_reply_to_me'] or (record['is_mentioned'] and random.random() < 0.7)
+        return {
+            'chat_id': chat_id,
+            'reply': reply,
+            'reply_to': record['msg_id'] if quote else None,
+            'typing_delay': typing_delay,
+        }
+
     def trigger_alert(self, chat_id: int, keyword: str, message_text: str, sender_name: str):
         """触发报警"""
-        self.alert_triggered[chat_id] = True
-        self.alert_messages[chat_id].append({
+        state = self.states.state(chat_id)
+        state.alert_triggered = True
+        state.alerts.append({
             'keyword': keyword,
             'message': message_text,
             'sender': sender_name,
             'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         })
+        self.states.updated(state)
 
     def clear_alert(self, chat_id: int):
         """清除报警状态"""
-        self.alert_triggered[chat_id] = False
-        self.alert_messages[chat_id] = []
+        state = self.states.get(chat_id)
+        if state:
+            state.alert_triggered = False
+            state.alerts.clear()
+            self.states.updated(state)
+
+    def is_alerted(self, chat_id: int) -> bool:
+        """该群是否处于报警暂停状态"""
+        state = self.states.get(chat_id)
+        return bool(state and state.alert_triggered)
+
+    def last_alert(self, chat_id: int):
+        """最近一次报警记录"""
+        state = self.states.get(chat_id)
+        return state.alerts[-1] if state and state.alerts else None
 
     def add_manual_message(self, chat_id: int, message: str, reply_to: int = None):
         """添加人工消息到队列"""
-        self.manual_message_queue[chat_id].append({
+        state = self.states.state(chat_id)
+        state.manual_queue.append({
             'message': message,
             'reply_to': reply_to
         })
+        self.states.updated(state)
 
     def get_manual_message(self, chat_id: int):
         """获取并移除队列中的第一条人工消息"""
-        if self.manual_message_queue[chat_id]:
-            return self.manual_message_queue[chat_id].pop(0)
+        state = self.states.get(chat_id)
+        if state and state.manual_queue:
+            item = state.manual_queue.popleft()
+            self.states.updated(state)
+            return item
         return None
 
 
 # 创建 AI 聊天管理器
-ai_manager = AIChatManager(config)
+ai_manager = AIChatManager(config_store.snapshot)
+config_store.listeners.append(ai_manager.update_config)
+
+# 工作进程回传给监听进程的 LLM 指标
+AI_WORKER_METRICS = ('tg_llm_request_seconds', 'tg_llm_tokens_total', 'tg_llm_queue_seconds',
+                     'tg_llm_queue_expired_total', 'tg_llm_first_token_seconds', 'tg_llm_stream_aborted_total',
+                     'tg_llm_reply_cache_total', 'tg_llm_prompt_cached_ratio',
+                     'tg_llm_hedges_total', 'tg_llm_endpoint_errors_total', 'tg_llm_breaker_open_total')
+
+
+class AIProcessPool:
+    """AI 工作进程池 - 监听进程发布消息记录，工作进程做回复决策并回传回复指令"""
+
+    def __init__(self, cfg: dict):
+        self.config = cfg
+        self.processes = []
+        self.inboxes = []
+        self.outbox = None
+        # 正在发送回复的群，以及等待发送的最新一条回复（旧的被替换）
+        self.delivering = set()
+        self.waiting = {}
+        self.stats = {'published': 0, 'instructions': 0, 'dropped': 0, 'superseded': 0}
+
+    @property
+    def running(self) -> bool:
+        return bool(self.processes)
+
+    def start(self):
+        """在事件循环启动前创建工作进程，fork 出的子进程不会带走运行中的循环和连接"""
+        pipeline_config = self.config.get('pipeline', {})
+        count = pipeline_config.get('ai_processes', 0)
+        if count <= 0 or self.processes:
+            return
+        # 全局 LLM 预算由各进程分摊，进程数超过并发上限时多出的进程分不到名额
+        ai_config = self.config.get('ai_chat', {})
+        limit = max(1, min(ai_config.get('llm_max_inflight', 4), ai_config.get('llm_requests_per_minute', 60)))
+        if count > limit:
+            print(f"⚠️ ai_processes={count} 超过 LLM 并发上限/每分钟预算，按 {limit} 个进程启动")
+            count = limit
+        start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+        ctx = multiprocessing.get_context(start_method)
+        self.outbox = ctx.Queue()
+        for worker_id in range(count):
+            inbox = ctx.Queue(maxsize=pipeline_config.get('ai_queue_size', 100))
+            process = ctx.Process(target=ai_worker_main, name=f"ai-worker-{worker_id}", daemon=True,
+                                  args=(worker_id, count, thaw(self.config), inbox, self.outbox))
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+        print(f"🧠 已启动 {count} 个 AI 工作进程（{start_method}）")
+
+    def publish(self, record: dict):
+        """按群组分配到固定的工作进程，同一群的上下文始终在同一进程，满载时丢弃"""
+        inbox = self.inboxes[record['chat_id'] % len(self.inboxes)]
+        try:
+            inbox.put_nowait(('message', record))
+            self.stats['published'] += 1
+        except queue.Full:
+            self.stats['dropped'] += 1
+
+    def update_config(self, cfg: dict):
+        """配置变化时同步给工作进程"""
+        self.config = cfg
+        for inbox in self.inboxes:
+            try:
+                inbox.put_nowait(('config', thaw(cfg)))
+            except queue.Full:
+                print("⚠️ AI 工作进程队列已满，配置更新未送达")
+
+    async def run_reader(self, deliver, typing=None):
+        """读取工作进程回传的回复指令、输入状态通知和指标"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                kind, worker_id, payload = await loop.run_in_executor(None, self.outbox.get, True, 1)
+            except queue.Empty:
+                continue
+            if kind == 'reply':
+                self.stats['instructions'] += 1
+                self._dispatch(payload, deliver)
+            elif kind == 'typing':
+                if typing:
+                    typing(payload)
+            elif kind == 'metrics':
+                for name, series in payload.items():
+                    for labels, value in series.items():
+                        metrics.values[name][labels + (('worker', str(worker_id)),)] = value
+
+    def _dispatch(self, instruction: dict, deliver):
+        """每个群同时只发送一条回复，发送期间到达的只保留最新一条"""
+        chat_id = instruction['chat_id']
+        if chat_id in self.delivering:
+            if chat_id in self.waiting:
+                self.stats['superseded'] += 1
+            self.waiting[chat_id] = instruction
+            return
+        self.delivering.add(chat_id)
+        asyncio.create_task(self._deliver_chat(chat_id, instruction, deliver))
+
+    async def _deliver_chat(self, chat_id: int, instruction: dict, deliver):
+        try:
+            while instruction:
+                await deliver(instruction)
+                instruction = self.waiting.pop(chat_id, None)
+        finally:
+            self.delivering.discard(chat_id)
+
+    def stop(self):
+        """通知工作进程退出"""
+        for inbox in self.inboxes:
+            try:
+                inbox.put_nowait(None)
+            except queue.Full:
+                pass
+        for process in self.processes:
+            process.join(timeout=3)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+    def summary(self) -> str:
+        """工作进程状态"""
+        if not self.running:
+            return "未启用（在主进程中处理）"
+        alive = sum(1 for p in self.processes if p.is_alive())
+        return (f"{alive}/{len(self.processes)} 个进程，已发布 {self.stats['published']}，"
+                f"回复指令 {self.stats['instructions']}（被替换 {self.stats['superseded']}），"
+                f"丢弃 {self.stats['dropped']}")
+
+
+def ai_worker_main(worker_id: int, worker_count: int, cfg: dict, inbox, outbox):
+    """AI 工作进程入口"""
+    # Ctrl+C 由主进程处理，子进程随主进程的通知退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_ai_worker_loop(worker_id, worker_count, cfg, inbox, outbox))
+
+
+async def _ai_worker_loop(worker_id: int, worker_count: int, cfg: dict, inbox, outbox):
+    manager = AIChatManager(cfg)
+    # 全局 LLM 预算由各工作进程分摊
+    manager.scheduler.shares = worker_count
+    manager.scheduler.index = worker_id
+    manager.scheduler.update_config(cfg)
+    for name in AI_WORKER_METRICS:
+        metrics.values[name] = {}
+    loop = asyncio.get_running_loop()
+    last_report = time.monotonic()
+
+    async def send_back(instruction: dict):
+        outbox.put(('reply', worker_id, instruction))
+
+    manager.on_typing = lambda chat_id: outbox.put(('typing', worker_id, chat_id))
+
+    while True:
+        try:
+            item = await loop.run_in_executor(None, inbox.get, True, 1)
+        except queue.Empty:
+            item = ()
+        if item is None:
+            break
+        if item:
+            kind, payload = item
+            if kind == 'config':
+                manager.update_config(payload)
+            else:
+                manager.submit(payload, send_back)
+        if time.monotonic() - last_report >= 5:
+            last_report = time.monotonic()
+            outbox.put(('metrics', worker_id, {name: dict(metrics.values[name]) for name in AI_WORKER_METRICS}))
+
+
+ai_process_pool = AIProcessPool(config_store.snapshot)
+config_store.listeners.append(ai_process_pool.update_config)
 
 
 def update_config_file(new_bot_mappings):
     """更新配置文件"""
     global bot_mappings, forwarding_map, config
+    old_bot_mappings = bot_mappings
     bot_mappings = new_bot_mappings
     config['bot_mappings'] = new_bot_mappings
     save_config(config)
     print("✅ config.json 已更新！")
-    asyncio.create_task(rebuild_forwarding_map())
+    asyncio.create_task(apply_mapping_changes(old_bot_mappings, new_bot_mappings))
+
+
+def mapping_key(mapping: dict) -> tuple:
+    """映射的唯一标识（去重开关变化也视为变更）"""
+    return str(mapping['source_chat']), str(mapping['target_bot']), mapping.get('dedupe', True)
+
+
+async def apply_mapping_changes(old_mappings: list, new_mappings: list):
+    """按差异增量更新转发映射：只解析新增或变更的映射，构建完成后整体替换"""
+    global forwarding_map
+
+    async with mapping_lock:
+        old_keys = {mapping_key(m) for m in old_mappings}
+        new_keys = {mapping_key(m) for m in new_mappings}
+        removed = old_keys - new_keys
+        added = [m for m in new_mappings if mapping_key(m) not in old_keys]
+
+        # 已在缓存中的直接使用，其余并发解析
+        uncached = [m for m in added
+                    if not (entity_resolver.cached(m['source_chat']) and entity_resolver.cached(m['target_bot']))]
+        resolved = await resolve_mappings(uncached) if uncached else {}
+
+        # 在最新的映射副本上修改，最后一次性替换
+        new_map = {source_id: list(targets) for source_id, targets in forwarding_map.items()}
+        for source_key, target_key, _ in removed:
+            source_peer = entity_resolver.cached(source_key)
+            target_peer = entity_resolver.cached(target_key)
+            if not (source_peer and target_peer):
+                continue
+            source_id = utils.get_peer_id(source_peer)
+            target_id = utils.get_peer_id(target_peer)
+            remaining = [t for t in new_map.get(source_id, []) if utils.get_peer_id(t) != target_id]
+            if remaining:
+                new_map[source_id] = remaining
+            else:
+                new_map.pop(source_id, None)
+            duplicate_filter.set_opt_out(source_id, target_id, False)
+
+        for mapping in added:
+            source_peer = entity_resolver.cached(mapping['source_chat'])
+            target_peer = entity_resolver.cached(mapping['target_bot'])
+            if source_peer and target_peer:
+                add_target(new_map, utils.get_peer_id(source_peer), target_peer, str(mapping['target_bot']),
+                           mapping.get('dedupe', True))
+        for source_id, targets in resolved.items():
+            for target_peer in targets:
+                add_target(new_map, source_id, target_peer)
+
+        forwarding_map = new_map
+        entity_resolver.save()
+        print(f"🔄 转发映射已增量更新: +{len(added)} / -{len(removed)}，共 {len(forwarding_map)} 个源")
+        if added and shard_manager.sharded:
+            await shard_manager.refresh_access(forward_source_keys())
+
+
+def forward_source_keys() -> dict:
+    """转发源 ID -> 配置中的源写法，供分片账号确认访问范围"""
+    keys = {}
+    for mapping in bot_mappings:
+        source_peer = entity_resolver.cached(mapping['source_chat'])
+        if source_peer:
+            keys[utils.get_peer_id(source_peer)] = str(mapping['source_chat'])
+    return keys
+
+
+def add_target(mapping_dict: dict, source_id: int, target_peer, target_key: str = None, dedupe: bool = None):
+    """向映射中添加一个目标（同一源可对应多个目标）"""
+    target_id = utils.get_peer_id(target_peer)
+    if target_key:
+        forward_scheduler.target_labels[target_id] = target_key
+    if dedupe is not None:
+        duplicate_filter.set_opt_out(source_id, target_id, not dedupe)
+    targets = mapping_dict.setdefault(source_id, [])
+    if all(utils.get_peer_id(t) != target_id for t in targets):
+        targets.append(target_peer)
+
+
+async def resolve_mappings(mappings: list, quiet: bool = False) -> dict:
+    """并发解析映射，每个源和目标只解析一次"""
+    keys = []
+    for mapping in mappings:
+        for key in (str(mapping['source_chat']), str(mapping['target_bot'])):
+            if key not in keys:
+                keys.append(key)
+
+    results = await asyncio.gather(*(entity_resolver.resolve(k) for k in keys), return_exceptions=True)
+    resolved = dict(zip(keys, results))
+
+    new_map = {}
+    for mapping in mappings:
+        source_key = str(mapping['source_chat'])
+        target_key = str(mapping['target_bot'])
+        source_peer = resolved[source_key]
+        target_peer = resolved[target_key]
+        error = next((r for r in (source_peer, target_peer) if isinstance(r, Exception)), None)
+        if error:
+            # 解析失败时沿用缓存，避免临时错误导致映射丢失
+            source_peer = entity_resolver.cached(source_key)
+            target_peer = entity_resolver.cached(target_key)
+            if not (source_peer and target_peer):
+                print(f"❌ 映射失败: {source_key}, 错误: {error}")
+                continue
+        add_target(new_map, utils.get_peer_id(source_peer), target_peer, target_key, mapping.get('dedupe', True))
+        if not quiet:
+            print(f"✅ 映射成功: {source_key} -> {target_key}")
+
+    entity_resolver.save()
+    return new_map
+
+
+async def revalidate_forwarding_map():
+    """后台重新解析所有映射，刷新过期的缓存
+
+    持有 mapping_lock 期间提交的 /add_listen、/remove_listen 会排在其后，按差异应用到校验结果上
+    """
+    global forwarding_map
+    async with mapping_lock:
+        forwarding_map = await resolve_mappings(list(bot_mappings), quiet=True)
+    print(f"🔄 转发映射后台校验完成: {len(forwarding_map)} 个")
 
 
 async def rebuild_forwarding_map():
-    """重新构建转发映射"""
+    """重新构建转发映射：缓存命中的立即生效，缺失的并发解析，其余后台校验"""
     global forwarding_map
-    forwarding_map = {}
 
+    new_map = {}
+    missing = []
     for mapping in bot_mappings:
-        source_chat_id_from_config = mapping['source_chat']
-        target_bot_username_or_id = mapping['target_bot']
+        source_peer = entity_resolver.cached(mapping['source_chat'])
+        target_peer = entity_resolver.cached(mapping['target_bot'])
+        if source_peer and target_peer:
+            add_target(new_map, utils.get_peer_id(source_peer), target_peer, str(mapping['target_bot']),
+                       mapping.get('dedupe', True))
+        else:
+            missing.append(mapping)
+    forwarding_map = new_map
+    if new_map:
+        print(f"⚡ 已从缓存恢复 {len(new_map)} 个转发映射")
+
+    if missing:
+        resolved = await resolve_mappings(missing)
+        merged = {source_id: list(targets) for source_id, targets in forwarding_map.items()}
+        for source_id, targets in resolved.items():
+            for target_peer in targets:
+                add_target(merged, source_id, target_peer)
+        forwarding_map = merged
+
+    if len(missing) < len(bot_mappings):
+        asyncio.create_task(revalidate_forwarding_map())
+
+
+class EventPipeline:
+    """消息处理流水线 - 接收、转发、AI 三个阶段，各自有界队列和独立协程"""
+
+    def __init__(self, cfg: dict, forward_filter, forward_handler, ai_filter, ai_handler, forward_gate=None):
+        pipeline_config = cfg.get('pipeline', {})
+        self.config = pipeline_config
+        self.forward_filter = forward_filter
+        self.forward_handler = forward_handler
+        # 转发前等待下游有空位（调度队列满时暂停，压力逐级传回接收队列）
+        self.forward_gate = forward_gate
+        self.ai_filter = ai_filter
+        self.ai_handler = ai_handler
+        self.intake_queue = asyncio.Queue(maxsize=pipeline_config.get('intake_queue_size', 1000))
+        self.forward_queue = asyncio.Queue(maxsize=pipeline_config.get('forward_queue_size', 5000))
+        self.ai_queue = asyncio.Queue(maxsize=pipeline_config.get('ai_queue_size', 100))
+        self.workers = []
+        self.forward_worker_count = 0
+        self.ai_worker_count = 0
+        self.stats = {
+            'received': 0,
+            'forwarded': 0,
+            'ai_processed': 0,
+            'ai_dropped': 0,
+            'ai_expired': 0,
+        }
+
+    def start(self):
+        """启动各阶段协程"""
+        if self.workers:
+            return
+        self.workers.append(asyncio.create_task(self._intake_worker()))
+        self._add_workers()
+
+    def update_config(self, cfg: dict):
+        """更新流水线配置：工作协程只增不减，队列容量重启后生效"""
+        self.config = cfg.get('pipeline', {})
+        if self.workers:
+            self._add_workers()
+
+    def _add_workers(self):
+        while self.forward_worker_count < self.config.get('forward_workers', 1):
+            self.workers.append(asyncio.create_task(self._forward_worker()))
+            self.forward_worker_count += 1
+        while self.ai_worker_count < self.config.get('ai_workers', 2):
+            self.workers.append(asyncio.create_task(self._ai_worker()))
+            self.ai_worker_count += 1
+
+    async def submit(self, event):
+        """接收新消息，队列满时等待（向上游施加背压）"""
+        self.stats['received'] += 1
+        metrics.inc('tg_updates_received_total')
+        await self.intake_queue.put(event)
+
+    def _offer_ai(self, event):
+        """AI 阶段满载时丢弃最旧的消息，保证转发不受影响且内存有界"""
+        item = (time.monotonic(), event)
         try:
+            self.ai_queue.put_nowait(item)
+        except asyncio.QueueFull:
             try:
-                source_chat_id_processed = int(source_chat_id_from_config)
-            except ValueError:
-                source_chat_id_processed = source_chat_id_from_config
+                self.ai_queue.get_nowait()
+                self.ai_queue.task_done()
+                self.stats['ai_dropped'] += 1
+            except asyncio.QueueEmpty:
+                pass
+            self.ai_queue.put_nowait(item)
 
-            source_entity = await client.get_entity(source_chat_id_processed)
-            target_bot_entity = await client.get_entity(str(target_bot_username_or_id))
+    async def _intake_worker(self):
+        while True:
+            event = await self.intake_queue.get()
+            try:
+                if self.forward_filter(event):
+                    await self.forward_queue.put(event)
+                if self.ai_filter(event):
+                    self._offer_ai(event)
+            except Exception as e:
+                print(f"❌ 消息分发失败: {e}")
+            finally:
+                self.intake_queue.task_done()
 
-            peer_id_for_map = await client.get_peer_id(source_entity)
-            forwarding_map[peer_id_for_map] = target_bot_entity
-            print(f"✅ 映射成功: {source_chat_id_from_config} -> {target_bot_username_or_id}")
-        except Exception as e:
-            print(f"❌ 映射失败: {source_chat_id_from_config}, 错误: {e}")
+    async def _forward_worker(self):
+        while True:
+            event = await self.forward_queue.get()
+            try:
+                if self.forward_gate:
+                    await self.forward_gate()
+                self.forward_handler(event)
+                self.stats['forwarded'] += 1
+            except Exception as e:
+                print(f"❌ 转发处理失败: {e}")
+            finally:
+                self.forward_queue.task_done()
+
+    async def _ai_worker(self):
+        while True:
+            received_at, event = await self.ai_queue.get()
+            try:
+                if time.monotonic() - received_at > self.config.get('ai_max_age_seconds', 60):
+                    self.stats['ai_expired'] += 1
+                    continue
+                await self.ai_handler(event)
+                self.stats['ai_processed'] += 1
+            except Exception as e:
+                print(f"❌ AI 处理失败: {e}")
+            finally:
+                self.ai_queue.task_done()
+
+    def summary(self) -> str:
+        """流水线统计"""
+        return (f"接收 {self.stats['received']}（排队 {self.intake_queue.qsize()}），"
+                f"转发 {self.stats['forwarded']}（排队 {self.forward_queue.qsize()}），"
+                f"AI {self.stats['ai_processed']}（排队 {self.ai_queue.qsize()}，"
+                f"丢弃 {self.stats['ai_dropped']}，过期 {self.stats['ai_expired']}）")
 
 
 @client.on(NewMessage())
 async def handler(event):
-    """消息处理器 - 转发消息 + AI炒群"""
+    """消息处理器 - 交给流水线分别处理转发和 AI 炒群"""
     global bot_running
 
     if not bot_running:
         return
 
-    # 转发逻辑
-    if event.chat_id in forwarding_map:
-        target_bot_entity = forwarding_map[event.chat_id]
-
-        if event.message.grouped_id:
-            async with media_group_lock:
-                if event.message.grouped_id not in media_group_cache:
-                    media_group_cache[event.message.grouped_id] = {
-                        'messages': [],
-                        'task': None,
-                        'target_bot': target_bot_entity
-                    }
-                media_group_cache[event.message.grouped_id]['messages'].append(event.message.id)
-
-                if media_group_cache[event.message.grouped_id]['task']:
-                    media_group_cache[event.message.grouped_id]['task'].cancel()
-
-                media_group_cache[event.message.grouped_id]['task'] = asyncio.create_task(
-                    process_media_group(event.message.grouped_id, event.chat_id)
-                )
-        else:
-            try:
-                await client.forward_messages(target_bot_entity, event.message.id, from_peer=event.chat_id)
-            except Exception as e:
-                print(f"❌ 转发失败: {e}")
+    await event_pipeline.submit(event)
+
 
-    # AI 炒群逻辑
-    await handle_ai_chat(event)
+def is_forward_source(event) -> bool:
+    """是否为监听的转发源（多账号时只处理负责该源的账号收到的消息）"""
+    return event.chat_id in forwarding_map and shard_manager.accepts(event)
+
+
+def route_forward(event):
+    """转发阶段：单条消息交给合并器，媒体组交给聚合器"""
+    targets = forwarding_map.get(event.chat_id)
+    if not targets:
+        return
+    if catch_up_manager.hold(event):
+        return
+
+    fingerprint = duplicate_filter.fingerprint(event.message)
+    if event.message.grouped_id:
+        forward_coalescer.flush_source(event.chat_id)
+        media_group_aggregator.add(event.message.grouped_id, event.chat_id, targets, event.message.id, fingerprint)
+    else:
+        for target_bot_entity in targets:
+            target_id = utils.get_peer_id(target_bot_entity)
+            checkpoint_store.track(event.chat_id, target_id, [event.message.id])
+            if duplicate_filter.is_duplicate(event.chat_id, target_id, fingerprint):
+                checkpoint_store.resolve(event.chat_id, target_id, [event.message.id])
+                continue
+            forward_coalescer.add(event.chat_id, target_bot_entity, event.message.id)
+
+
+def needs_ai_chat(event) -> bool:
+    """追踪发言者（无论是否启用AI），并判断是否进入 AI 阶段（仅主账号）"""
+    if not shard_manager.is_primary_event(event):
+        return False
+    if event.sender_id:
+        ai_manager.track_sender(event.chat_id, event.sender_id)
+    return ai_manager.is_enabled(event.chat_id)
 
 
 async def handle_ai_chat(event):
     """处理 AI 炒群"""
     global config
     
-    me = await client.get_me()
-    
-    # 先追踪发言者（无论是否启用AI）
-    if event.sender_id:
-        ai_manager.track_sender(event.chat_id, event.sender_id)
+    me = await identity_cache.get_me()
     
     # 检查是否是其他AI的消息，避免互相扯皮
     if ai_manager.is_other_ai(event.sender_id):
@@ -534,13 +4010,7 @@ async def handle_ai_chat(event):
     if not message_text:
         return
 
-    try:
-        sender = await event.get_sender()
-        sender_name = sender.first_name if sender else "某人"
-        if hasattr(sender, 'last_name') and sender.last_name:
-            sender_name += f" {sender.last_name}"
-    except:
-        sender_name = "某人"
+    sender_name = await identity_cache.get_sender_name(event)
 
     # 检查报警关键词
     has_alert, keyword = ai_manager.check_alert_keywords(message_text)
@@ -561,93 +4031,85 @@ async def handle_ai_chat(event):
 或使用 `/manual on` 切换到人工模式
 """
             await client.send_message(master_account_id, alert_msg, parse_mode='Markdown')
+            metrics.inc('tg_alerts_sent_total')
             print(f"🚨 报警触发: 群组 {event.chat_id}, 关键词: {keyword}")
         except Exception as e:
             print(f"❌ 发送报警通知失败: {e}")
         return
 
     # 检查该群是否已触发报警
-    if ai_manager.alert_triggered.get(event.chat_id, False):
+    if ai_manager.is_alerted(event.chat_id):
         return
 
-    ai_manager.add_context(event.chat_id, sender_name, message_text)
-
     is_mentioned = False
     is_reply_to_me = False
-    is_direct_reply = False
 
     my_username = me.username or ""
 
     if my_username and f"@{my_username}" in message_text:
         is_mentioned = True
-        is_direct_reply = True
 
     if event.message.reply_to_msg_id:
         try:
             replied_msg = await event.message.get_reply_message()
             if replied_msg and replied_msg.sender_id == me.id:
                 is_reply_to_me = True
-                is_direct_reply = True
         except:
             pass
 
-    should_reply = False
-
-    if is_mentioned or is_reply_to_me:
-        should_reply = random.randint(1, 100) <= 90
-    else:
-        # 检查活跃度
-        if ai_manager.should_skip_due_to_low_activity(event.chat_id):
-            print(f"⏸️ 群组 {event.chat_id} 活跃用户过少，跳过回复")
-            return
-        should_reply = ai_manager.should_reply(event.chat_id, message_text)
+    record = {
+        'chat_id': event.chat_id,
+        'msg_id': event.message.id,
+        'sender_name': sender_name,
+        'text': message_text,
+        'is_mentioned': is_mentioned,
+        'is_reply_to_me': is_reply_to_me,
+        'active_users': ai_manager.get_active_users_count(event.chat_id),
+    }
 
-    if not should_reply:
+    # 启用 AI 工作进程时交给子进程决策，回复指令由 ai_process_pool 回传
+    if ai_process_pool.running:
+        ai_process_pool.publish(record)
         return
 
-    reply = await ai_manager.generate_reply(event.chat_id, message_text, sender_name)
+    # 同一群的消息由该群的 actor 串行处理，生成期间到达的消息合并到下一轮
+    ai_manager.submit(record, deliver_ai_reply)
+
+
+def show_typing(chat_id: int):
+    """流式生成时提前显示一次输入状态（约 5 秒有效），剩余的打字时间由 deliver_ai_reply 补足"""
+    async def send():
+        try:
+            peer = await client.get_input_entity(chat_id)
+            await client(SetTypingRequest(peer, SendMessageTypingAction()))
+        except Exception as e:
+            print(f"⚠️ 发送输入状态失败 [{chat_id}]: {e}")
+    asyncio.create_task(send())
 
-    if not reply:
-        return
 
-    # 根据是否是直接回复决定延迟时间
-    typing_delay = await ai_manager.simulate_typing(reply, is_direct_reply)
+async def deliver_ai_reply(instruction: dict):
+    """执行回复指令：模拟打字后发送"""
+    chat_id = instruction['chat_id']
+    reply = instruction['reply']
+
+    typing_delay = instruction.get('typing_delay', 0)
     if typing_delay > 0:
         try:
-            async with client.action(event.chat_id, 'typing'):
+            async with client.action(chat_id, 'typing'):
                 await asyncio.sleep(typing_delay)
         except:
             await asyncio.sleep(typing_delay)
 
     try:
-        if is_reply_to_me or (is_mentioned and random.random() < 0.7):
-            await event.reply(reply)
-        else:
-            await client.send_message(event.chat_id, reply)
-
-        ai_manager.last_reply_time[event.chat_id] = datetime.now()
-        ai_manager.add_context(event.chat_id, "我", reply, is_self=True)
-
-        print(f"🤖 AI回复 [{event.chat_id}]: {reply}")
+        await client.send_message(chat_id, reply, reply_to=instruction.get('reply_to'))
+        print(f"🤖 AI回复 [{chat_id}]: {reply}")
     except Exception as e:
         print(f"❌ 发送AI回复失败: {e}")
 
 
-async def process_media_group(grouped_id, from_peer):
-    """处理媒体组"""
-    await asyncio.sleep(1.5)
-    async with media_group_lock:
-        if grouped_id in media_group_cache:
-            group_info = media_group_cache[grouped_id]
-            message_ids = group_info['messages']
-            target_bot = group_info['target_bot']
-
-            try:
-                await client.forward_messages(target_bot, message_ids, from_peer=from_peer)
-            except Exception as e:
-                print(f"❌ 媒体组转发失败: {e}")
-            finally:
-                del media_group_cache[grouped_id]
+event_pipeline = EventPipeline(config_store.snapshot, is_forward_source, route_forward, needs_ai_chat,
+                               handle_ai_chat, forward_gate=forward_scheduler.wait_for_space)
+config_store.listeners.append(event_pipeline.update_config)
 
 
 async def join_chat(chat_entity):
@@ -704,9 +4166,12 @@ def get_help_text():
 • `/leave <链接或ID>` - 退出群组/频道
 
 🔗 *转发监听:*
-• `/add_listen <源聊天> <@目标>` - 添加监听
-• `/remove_listen <源聊天>` - 移除监听
+• `/add_listen <源聊天>[,源聊天2,...] <@目标> [nodedupe]` - 添加监听（支持逗号分隔批量添加，同一源可添加多个目标，nodedupe 表示不去重）
+• `/remove_listen <源聊天> [@目标]` - 移除监听（不指定目标则移除全部）
 • `/list_listen` - 列出所有监听
+• `/backfill <源聊天> <起始消息ID|YYYY-MM-DD> [数量]` - 回填历史消息
+• `/backfill pause/resume/stop <源聊天>` - 暂停/继续/停止回填
+• `/backfill status` - 查看回填进度
 
 🤖 *AI炒群:*
 • `/ai on` - 全局开启AI炒群
@@ -743,6 +4208,8 @@ def get_help_text():
 • `/ai minusers <数量>` - 设置最少活跃用户数
 • `/ai checktime <分钟>` - 设置活跃检查时间
 • `/ai delay <最小秒> <最大秒>` - 设置回复延迟
+• `/ai stream on/off` - 流式生成（边生成边显示输入中）
+• `/ai cache on/off` - 重复短消息复用已生成的回复
 
 👤 *账号管理:*
 • `/profile name <名字>` - 修改名字
@@ -774,7 +4241,6 @@ async def handle_ai_command(event, args: str):
         ai_config['enabled'] = True
         config['ai_chat'] = ai_config
         save_config(config)
-        ai_manager.update_config(config)
         await event.reply("✅ AI炒群已全局开启")
 
     elif sub_cmd == 'off':
@@ -795,7 +4261,6 @@ async def handle_ai_command(event, args: str):
                 ai_config['chats'].append(chat_id)
                 config['ai_chat'] = ai_config
                 save_config(config)
-                ai_manager.update_config(config)
                 await event.reply(f"✅ 已添加炒群群组: `{chat_id}`", parse_mode='Markdown')
             else:
                 await event.reply("❌ 该群组已在列表中")
@@ -812,7 +4277,6 @@ async def handle_ai_command(event, args: str):
                 ai_config['chats'].remove(chat_id)
                 config['ai_chat'] = ai_config
                 save_config(config)
-                ai_manager.update_config(config)
                 await event.reply(f"✅ 已移除炒群群组: `{chat_id}`", parse_mode='Markdown')
             else:
                 await event.reply("❌ 该群组不在列表中")
@@ -824,7 +4288,7 @@ async def handle_ai_command(event, args: str):
         if chats:
             text = "🤖 *AI炒群群组列表:*\n\n"
             for i, cid in enumerate(chats, 1):
-                alert_status = "🚨" if ai_manager.alert_triggered.get(cid, False) else "✅"
+                alert_status = "🚨" if ai_manager.is_alerted(cid) else "✅"
                 active_count = ai_manager.get_active_users_count(cid)
                 text += f"{i}. `{cid}` {alert_status} (活跃: {active_count}人)\n"
             await event.reply(text, parse_mode='Markdown')
@@ -894,6 +4358,19 @@ async def handle_ai_command(event, args: str):
         delay_max = ai_config.get('reply_delay_max', 5)
         other_ais = len(ai_config.get('other_ai_ids', []))
         alert_keywords = ai_config.get('alert_keywords', [])
+        stream = "✅ 开启" if ai_config.get('stream_replies', False) else "❌ 关闭"
+        if ai_process_pool.running:
+            reply_cache = "在 AI 工作进程中（命中率见指标 tg_llm_reply_cache_total）"
+        else:
+            reply_cache = ai_manager.reply_cache.summary()
+        if ai_process_pool.running:
+            llm_schedule = "在 AI 工作进程中调度（预算按进程平分）"
+            llm_endpoints = "端点状态在 AI 工作进程中（见指标 tg_llm_endpoint_errors_total）"
+        else:
+            llm_schedule = ai_manager.scheduler.summary()
+            llm_endpoints = ai_manager.router.summary()
+        llm_queue_wait = llm_queue_wait_summary()
+        llm_prompt_cache = llm_prompt_cache_summary()
 
         status_text = f"""
 🤖 *AI炒群状态*
@@ -914,10 +4391,18 @@ async def handle_ai_command(event, args: str):
 • 最少活跃用户: {min_users}人
 • 检查时间: {check_time}分钟
 • 回复延迟: {delay_min}-{delay_max}秒
+• 流式生成: {stream}
+• 回复缓存: {reply_cache}
 
 🤖 *防扯皮:*
 • 其他AI数量: {other_ais}
 
+🚦 *LLM 调度:*
+• {llm_schedule}
+• {llm_queue_wait}
+• {llm_prompt_cache}
+• {llm_endpoints}
+
 📝 *当前人设:*
 {personality}... 
 """
@@ -938,14 +4423,14 @@ async def handle_ai_command(event, args: str):
         ai_manager.add_context(test_chat_id, "测试用户", "大家好啊")
         ai_manager.add_context(test_chat_id, "另一个人", "你好呀")
 
-        reply = await ai_manager.generate_reply(test_chat_id, sub_args, "测试用户")
+        reply = await ai_manager.generate_reply(test_chat_id, sub_args, "测试用户", is_direct_reply=True)
 
         if reply:
             await event.reply(f"🤖 AI回复:\n{reply}")
         else:
             await event.reply("❌ AI选择不回复或生成失败")
 
-        ai_manager.chat_contexts[test_chat_id] = []
+        ai_manager.states.discard(test_chat_id)
 
     elif sub_cmd == 'apikey':
         if not sub_args:
@@ -955,7 +4440,6 @@ async def handle_ai_command(event, args: str):
         ai_config['api_key'] = sub_args
         config['ai_chat'] = ai_config
         save_config(config)
-        ai_manager.update_config(config)
         await event.reply("✅ API Key 已更新")
 
     elif sub_cmd == 'baseurl':
@@ -966,7 +4450,6 @@ async def handle_ai_command(event, args: str):
         ai_config['base_url'] = sub_args
         config['ai_chat'] = ai_config
         save_config(config)
-        ai_manager.update_config(config)
         await event.reply(f"✅ API地址已设置为: {sub_args}")
 
     elif sub_cmd == 'model':
@@ -1044,7 +4527,7 @@ async def handle_ai_command(event, args: str):
             return
         try:
             chat_id = int(sub_args)
-            if ai_manager.alert_triggered.get(chat_id, False):
+            if ai_manager.is_alerted(chat_id):
                 ai_manager.clear_alert(chat_id)
                 await event.reply(f"✅ 已恢复群组 `{chat_id}` 的AI炒群", parse_mode='Markdown')
             else:
@@ -1065,7 +4548,6 @@ async def handle_ai_command(event, args: str):
                 ai_config['other_ai_ids'] = other_ais
                 config['ai_chat'] = ai_config
                 save_config(config)
-                ai_manager.update_config(config)
                 await event.reply(f"✅ 已添加其他AI: `{bot_id}`", parse_mode='Markdown')
             else:
                 await event.reply("❌ 该ID已在列表中")
@@ -1084,7 +4566,6 @@ async def handle_ai_command(event, args: str):
                 ai_config['other_ai_ids'] = other_ais
                 config['ai_chat'] = ai_config
                 save_config(config)
-                ai_manager.update_config(config)
                 await event.reply(f"✅ 已移除其他AI: `{bot_id}`", parse_mode='Markdown')
             else:
                 await event.reply("❌ 该ID不在列表中")
@@ -1160,10 +4641,75 @@ async def handle_ai_command(event, args: str):
         except ValueError:
             await event.reply("❌ 请输入有效的数字")
 
+    elif sub_cmd == 'stream':
+        if sub_args not in ('on', 'off'):
+            current = "✅ 开启" if ai_config.get('stream_replies', False) else "❌ 关闭"
+            await event.reply(f"当前流式生成: {current}\n用法: `/ai stream on/off`", parse_mode='Markdown')
+            return
+        ai_config['stream_replies'] = sub_args == 'on'
+        config['ai_chat'] = ai_config
+        save_config(config)
+        await event.reply("✅ 流式生成已开启" if sub_args == 'on' else "✅ 流式生成已关闭")
+
+    elif sub_cmd == 'cache':
+        if sub_args not in ('on', 'off'):
+            await event.reply(f"回复缓存: {ai_manager.reply_cache.summary()}\n用法: `/ai cache on/off`",
+                              parse_mode='Markdown')
+            return
+        ai_config['reply_cache_enabled'] = sub_args == 'on'
+        config['ai_chat'] = ai_config
+        save_config(config)
+        await event.reply("✅ 回复缓存已开启" if sub_args == 'on' else "✅ 回复缓存已关闭")
+
     else:
         await event.reply("❌ 未知命令，使用 `/help` 查看帮助", parse_mode='Markdown')
 
 
+async def handle_backfill_command(event, args: str):
+    """处理历史回填命令"""
+    parts = args.split()
+    usage = "❌ 用法: `/backfill <源聊天> <起始消息ID|YYYY-MM-DD> [数量]`\n或: `/backfill pause/resume/stop <源聊天>`、`/backfill status`"
+
+    if not parts:
+        await event.reply(usage, parse_mode='Markdown')
+        return
+
+    sub_cmd = parts[0].lower()
+
+    if sub_cmd == 'status':
+        await event.reply(f"📚 *回填任务:*\n\n{backfill_manager.summary()}", parse_mode='Markdown')
+
+    elif sub_cmd in ('pause', 'resume', 'stop'):
+        if len(parts) != 2:
+            await event.reply(usage, parse_mode='Markdown')
+            return
+        try:
+            key = await backfill_manager.source_key(parts[1])
+        except Exception as e:
+            await event.reply(f"❌ 失败: {e}")
+            return
+        action = getattr(backfill_manager, sub_cmd)
+        names = {'pause': '暂停', 'resume': '继续', 'stop': '停止'}
+        if action(key):
+            await event.reply(f"✅ 已{names[sub_cmd]}回填: `{parts[1]}`", parse_mode='Markdown')
+        else:
+            await event.reply(f"❌ 无法{names[sub_cmd]}，请用 `/backfill status` 查看任务状态", parse_mode='Markdown')
+
+    else:
+        if len(parts) not in (2, 3):
+            await event.reply(usage, parse_mode='Markdown')
+            return
+        try:
+            limit = int(parts[2]) if len(parts) == 3 else 1000
+            if limit <= 0:
+                raise ValueError("数量必须大于0")
+            await backfill_manager.start(parts[0], parts[1], limit)
+            await event.reply(f"⏳ 已开始回填 `{parts[0]}`，共 {limit} 条，使用 `/backfill status` 查看进度",
+                              parse_mode='Markdown')
+        except Exception as e:
+            await event.reply(f"❌ 回填启动失败: {e}")
+
+
 async def handle_manual_command(event, args: str):
     """处理人工干预命令"""
     global config
@@ -1177,14 +4723,12 @@ async def handle_manual_command(event, args: str):
         ai_config['manual_mode'] = True
         config['ai_chat'] = ai_config
         save_config(config)
-        ai_manager.update_config(config)
         await event.reply("✅ 已切换到人工干预模式，AI将暂停自动回复")
     
     elif sub_cmd == 'off':
         ai_config['manual_mode'] = False
         config['ai_chat'] = ai_config
         save_config(config)
-        ai_manager.update_config(config)
         await event.reply("✅ 已关闭人工干预模式，AI恢复自动回复")
     
     elif sub_cmd == 'send':
@@ -1250,7 +4794,7 @@ async def handle_manual_command(event, args: str):
         manual_mode = "✅ 开启" if ai_config.get('manual_mode', False) else "❌ 关闭"
         
         # 列出已触发报警的群组
-        alert_chats = [cid for cid, triggered in ai_manager.alert_triggered.items() if triggered]
+        alert_chats = ai_manager.states.alerted()
         
         status_text = f"""
 🖐️ *人工干预状态*
@@ -1261,9 +4805,8 @@ async def handle_manual_command(event, args: str):
         if alert_chats:
             status_text += "\n🚨 *已报警群组:*\n"
             for cid in alert_chats:
-                alerts = ai_manager.alert_messages.get(cid, [])
-                if alerts:
-                    last_alert = alerts[-1]
+                last_alert = ai_manager.last_alert(cid)
+                if last_alert:
                     status_text += f"• `{cid}` - {last_alert['keyword']} ({last_alert['time']})\n"
         
         await event.reply(status_text, parse_mode='Markdown')
@@ -1280,7 +4823,7 @@ async def handle_profile_command(event, args: str):
     
     if sub_cmd == 'name':
         if not sub_args:
-            me = await client.get_me()
+            me = await identity_cache.get_me()
             current = f"{me.first_name or ''} {me.last_name or ''}".strip()
             await event.reply(f"当前名字: {current}\n用法: `/profile name <名字>` 或 `/profile name <名字> <姓氏>`", parse_mode='Markdown')
             return
@@ -1294,6 +4837,7 @@ async def handle_profile_command(event, args: str):
                 first_name=first_name,
                 last_name=last_name
             ))
+            await identity_cache.get_me(refresh=True)
             await event.reply(f"✅ 名字已修改为: {first_name} {last_name}".strip())
         except Exception as e:
             await event.reply(f"❌ 修改失败: {e}")
@@ -1429,12 +4973,32 @@ async def main():
     print("✅ 客户端已启动！")
     print(f"📅 启动时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
-    me = await client.get_me()
+    me = await identity_cache.get_me(refresh=True)
     ai_manager.my_user_id = me.id
     print(f"👤 当前账号: {me.first_name} (@{me.username}) [ID: {me.id}]")
+    await shard_manager.start_accounts(config.get('accounts', []), handler)
 
     await rebuild_forwarding_map()
     print(f"📋 已加载 {len(forwarding_map)} 个转发映射")
+    if shard_manager.sharded:
+        await shard_manager.refresh_access(forward_source_keys())
+        # 迁移到其他账号的源按检查点补发断线期间漏掉的消息
+        shard_manager.rebalance_callbacks.append(lambda moved: catch_up_manager.start(
+            {source_id: forwarding_map[source_id] for source_id in moved if source_id in forwarding_map},
+            route_forward))
+        asyncio.create_task(shard_manager.monitor())
+    forward_scheduler.start()
+    media_group_aggregator.start()
+    catch_up_manager.start(forwarding_map, route_forward)
+    backfill_manager.resume_unfinished()
+    event_pipeline.start()
+    ai_manager.on_typing = show_typing
+    if ai_process_pool.running:
+        asyncio.create_task(ai_process_pool.run_reader(deliver_ai_reply, show_typing))
+    await metrics.start(config.get('metrics', {}))
+    asyncio.create_task(duplicate_filter.run_persistence())
+    asyncio.create_task(checkpoint_store.run_persistence(config['forwarding'].get('checkpoint_interval', 5)))
+    asyncio.create_task(catch_up_manager.monitor_connection(lambda: forwarding_map))
 
     ai_status = "开启" if config.get('ai_chat', {}).get('enabled', False) else "关闭"
     ai_chats = len(config.get('ai_chat', {}).get('chats', []))
@@ -1516,7 +5080,7 @@ async def main():
 📊 *机器人状态*
 
 🔄 运行状态: {'✅ 运行中' if bot_running else '⏸️ 已暂停'}
-📋 转发映射数: {len(forwarding_map)}
+📋 转发映射数: {len(forwarding_map)} 个源 / {sum(len(t) for t in forwarding_map.values())} 个目标
 ⏰ 当前时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 
 🤖 *AI炒群状态:*
@@ -1525,6 +5089,21 @@ async def main():
 • 回复概率: {ai_prob}%
 • 冷却时间: {ai_cooldown}秒
 • API配置: {'✅' if ai_manager.client else '❌'}
+
+📤 *转发调度:* {forward_scheduler.summary()}
+📦 *转发合并:* {forward_coalescer.summary()}
+🖼️ *媒体组:* {media_group_aggregator.summary()}
+🚦 *流水线:* {event_pipeline.summary()}
+🧠 *AI工作进程:* {ai_process_pool.summary()}
+💬 *AI群状态:* {ai_manager.states.summary()}
+🎭 *AI回复协程:* {ai_manager.actor_summary()}
+♻️ *去重:* {duplicate_filter.summary()}
+🔁 *断线补发:* {catch_up_manager.summary()}
+🎯 *各目标投递:*
+{forward_scheduler.target_summary()}
+🪪 *身份缓存:* {identity_cache.summary()}
+🧭 *账号分片:* {shard_manager.summary()}
+🗂️ *配置版本:* v{config_store.version}（已落盘 v{config_store.written_version}）
 """
             await event.reply(status_text, parse_mode='Markdown')
 
@@ -1574,40 +5153,71 @@ async def main():
                 await event.reply(f"❌ 错误: {e}")
 
         elif cmd == '/add_listen':
-            parts = args.split(' ', 1)
-            if len(parts) != 2:
-                await event.reply("❌ 用法: `/add_listen <源聊天> <@目标>`", parse_mode='Markdown')
+            parts = args.split()
+            if len(parts) not in (2, 3) or (len(parts) == 3 and parts[2].lower() != 'nodedupe'):
+                await event.reply("❌ 用法: `/add_listen <源聊天>[,源聊天2,...] <@目标> [nodedupe]`",
+                                  parse_mode='Markdown')
                 return
 
-            source_chat_arg = parts[0]
+            source_args = [src for src in parts[0].split(',') if src]
             target_bot = parts[1].strip()
+            dedupe = len(parts) == 2
 
             if not target_bot.startswith('@'):
                 await event.reply("❌ 目标必须以 '@' 开头")
                 return
 
             try:
-                await client.get_entity(target_bot)
-                existing = next((m for m in bot_mappings if str(m['source_chat']) == str(source_chat_arg)), None)
-
-                if existing:
-                    new_mappings = [m for m in bot_mappings if str(m['source_chat']) != str(source_chat_arg)]
-                    new_mappings.append({'source_chat': source_chat_arg, 'target_bot': target_bot})
-                    update_config_file(new_mappings)
-                    await event.reply("✅ 已更新监听")
-                else:
-                    new_mappings = bot_mappings + [{'source_chat': source_chat_arg, 'target_bot': target_bot}]
-                    update_config_file(new_mappings)
-                    await event.reply("✅ 已添加监听")
+                await entity_resolver.resolve(target_bot)
             except Exception as e:
                 await event.reply(f"❌ 失败: {e}")
+                return
+
+            # 并发校验所有源
+            results = await asyncio.gather(*(entity_resolver.resolve(src) for src in source_args),
+                                           return_exceptions=True)
+            new_mappings = []
+            existing_count = 0
+            failed = []
+            for source_chat_arg, result in zip(source_args, results):
+                if isinstance(result, Exception):
+                    failed.append(f"`{source_chat_arg}`: {result}")
+                    continue
+                existing = next((m for m in bot_mappings if str(m['source_chat']) == str(source_chat_arg)
+                                 and str(m['target_bot']) == target_bot), None)
+                if existing or any(m['source_chat'] == source_chat_arg for m in new_mappings):
+                    existing_count += 1
+                    continue
+                new_mapping = {'source_chat': source_chat_arg, 'target_bot': target_bot}
+                if not dedupe:
+                    new_mapping['dedupe'] = False
+                new_mappings.append(new_mapping)
+
+            if new_mappings:
+                update_config_file(bot_mappings + new_mappings)
+
+            if len(source_args) == 1 and not failed:
+                if new_mappings:
+                    await event.reply("✅ 已添加监听" + ("" if dedupe else "（不去重）"))
+                else:
+                    await event.reply("❌ 该监听已存在")
+            else:
+                text = f"✅ 已添加 {len(new_mappings)} 个监听，已存在 {existing_count} 个，失败 {len(failed)} 个"
+                if failed:
+                    text += "\n\n" + "\n".join(failed[:20])
+                await event.reply(text, parse_mode='Markdown')
 
         elif cmd == '/remove_listen':
             if not args:
-                await event.reply("❌ 用法: `/remove_listen <源聊天>`", parse_mode='Markdown')
+                await event.reply("❌ 用法: `/remove_listen <源聊天> [@目标]`", parse_mode='Markdown')
                 return
 
-            new_mappings = [m for m in bot_mappings if str(m['source_chat']) != str(args)]
+            remove_parts = args.split()
+            source_chat_arg = remove_parts[0]
+            target_bot = remove_parts[1] if len(remove_parts) > 1 else None
+            new_mappings = [m for m in bot_mappings
+                            if not (str(m['source_chat']) == source_chat_arg
+                                    and (target_bot is None or str(m['target_bot']) == target_bot))]
             if len(new_mappings) < len(bot_mappings):
                 update_config_file(new_mappings)
                 await event.reply("✅ 已移除监听")
@@ -1618,11 +5228,15 @@ async def main():
             if bot_mappings:
                 text = "📋 *监听列表:*\n\n"
                 for i, m in enumerate(bot_mappings, 1):
-                    text += f"{i}. `{m['source_chat']}` → `{m['target_bot']}`\n"
+                    no_dedupe = " (不去重)" if m.get('dedupe', True) is False else ""
+                    text += f"{i}. `{m['source_chat']}` → `{m['target_bot']}`{no_dedupe}\n"
                 await event.reply(text, parse_mode='Markdown')
             else:
                 await event.reply("📋 暂无监听配置")
 
+        elif cmd == '/backfill':
+            await handle_backfill_command(event, args)
+
         elif cmd == '/ai':
             await handle_ai_command(event, args)
 
@@ -1637,8 +5251,17 @@ async def main():
 
     # 保持运行
     print("🚀 开始监听消息...")
-    await client.run_until_disconnected()
+    try:
+        await client.run_until_disconnected()
+    finally:
+        duplicate_filter.save_bloom()
+        checkpoint_store.save()
+        config_store.flush_now()
+        ai_process_pool.stop()
+        await ai_manager.close()
 
 
 if __name__ == '__main__':
+    # 工作进程需在事件循环启动前创建
+    ai_process_pool.start()
     asyncio.run(main())